@@ -0,0 +1,195 @@
+import math
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+from serving import SERVING_MODE
+
+# ====== ADMISSION CONTROL ======
+# Each expensive endpoint class gets its own concurrency pool with a short bounded wait
+# queue. When a class is saturated, new requests are refused right away with 429 and
+# Retry-After instead of parking on one of gunicorn's few threads, so /healthz and cheap
+# endpoints always have a thread left to run on.
+
+# Flask endpoint name -> endpoint class. Endpoints not listed are never throttled.
+ENDPOINT_CLASSES = {
+    "ask_doc": "ask",
+    # Many generate calls per request; queued with the other heavy endpoints.
+    "ask_batch": "generate",
+    "quiz.generate_quiz": "generate",
+    "quiz.generate_quiz_stream": "generate",
+    "flashcard.generate_flashcards": "generate",
+    "flashcard.generate_flashcards_stream": "generate",
+    "summarize.summarize_endpoint": "summarize",
+    "index_from_atlas": "indexing",
+    "replace_text_index": "indexing",
+    "set_consent": "indexing",
+    "preview_word_as_pdf": "preview",
+    "convert_word_to_pdf": "preview",
+}
+
+# (concurrency, queue) per class. Keep the sum of both columns below gunicorn --threads so
+# at least one thread is always free for unthrottled endpoints. Override with
+# ADMISSION_<CLASS>=<concurrency>/<queue>, e.g. ADMISSION_GENERATE=3/2.
+DEFAULT_LIMITS = {
+    "ask": (4, 2),
+    "generate": (2, 1),
+    "summarize": (1, 1),
+    "indexing": (1, 1),
+    "preview": (1, 1),
+}
+if SERVING_MODE == "gevent":
+    # Waiting requests are greenlets, not OS threads, so the I/O-bound classes can admit far
+    # more; indexing and preview stay small because their work is CPU-bound.
+    DEFAULT_LIMITS = {
+        "ask": (200, 100),
+        "generate": (40, 20),
+        "summarize": (40, 20),
+        "indexing": (4, 4),
+        "preview": (2, 2),
+    }
+ADMISSION_MAX_WAIT_SEC = float(os.environ.get("ADMISSION_MAX_WAIT_SEC", "10"))
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, pool: str, retry_after: int):
+        super().__init__(f"Too many concurrent '{pool}' requests")
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class AdmissionPool:
+    def __init__(self, name: str, concurrency: int, queue_size: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._avg_hold_sec = 5.0
+        self._cond = threading.Condition()
+
+    def acquire(self, max_wait: float = ADMISSION_MAX_WAIT_SEC) -> float:
+        """Take a slot, waiting at most max_wait in the bounded queue. Returns the start time."""
+        with self._cond:
+            if self.active < self.concurrency:
+                self.active += 1
+                return time.monotonic()
+            if self.waiting >= self.queue_size or max_wait <= 0:
+                self.rejected += 1
+                raise AdmissionRejected(self.name, self.retry_after())
+            self.waiting += 1
+            try:
+                end = time.monotonic() + max_wait
+                while self.active >= self.concurrency:
+                    left = end - time.monotonic()
+                    if left <= 0:
+                        self.rejected += 1
+                        raise AdmissionRejected(self.name, self.retry_after())
+                    self._cond.wait(left)
+                self.active += 1
+                return time.monotonic()
+            finally:
+                self.waiting -= 1
+
+    def release(self, started_at: float):
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            held = time.monotonic() - started_at
+            self._avg_hold_sec = 0.8 * self._avg_hold_sec + 0.2 * held
+            self._cond.notify()
+
+    def retry_after(self) -> int:
+        """Rough seconds until a slot frees up: queue depth times the average hold time."""
+        return max(1, int(math.ceil(self._avg_hold_sec * (self.waiting + 1) / self.concurrency)))
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue": self.queue_size,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+def _limits_for(name: str, default: tuple) -> tuple:
+    raw = os.environ.get(f"ADMISSION_{name.upper()}", "")
+    if "/" in raw:
+        try:
+            conc, queue = raw.split("/", 1)
+            return int(conc), int(queue)
+        except ValueError:
+            print(f"[Admission] Ignoring invalid ADMISSION_{name.upper()}={raw!r}")
+    return default
+
+
+POOLS = {name: AdmissionPool(name, *_limits_for(name, lim)) for name, lim in DEFAULT_LIMITS.items()}
+
+
+def pool_for_endpoint(endpoint: str):
+    cls = ENDPOINT_CLASSES.get(endpoint or "")
+    return POOLS.get(cls) if cls else None
+
+
+def admission_stats() -> dict:
+    return {name: pool.snapshot() for name, pool in POOLS.items()}
+
+
+def _collect_metrics() -> list:
+    stats = admission_stats()
+    return [
+        ("smartdoc_admission_active", "gauge", "Requests holding an admission slot.",
+         [({"pool": n}, s["active"]) for n, s in stats.items()]),
+        ("smartdoc_admission_waiting", "gauge", "Requests queued for an admission slot.",
+         [({"pool": n}, s["waiting"]) for n, s in stats.items()]),
+        ("smartdoc_admission_rejected_total", "counter", "Requests refused with 429.",
+         [({"pool": n}, s["rejected"]) for n, s in stats.items()]),
+    ]
+
+
+REGISTRY.add_collector(_collect_metrics)
+
+
+# ---- Outbound rate limiting ----
+class TokenBucket:
+    """Thread-safe token bucket. rate_per_sec <= 0 disables limiting."""
+
+    def __init__(self, rate_per_sec: float, burst: float):
+        self.rate = rate_per_sec
+        self.capacity = max(1.0, burst)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+    def acquire(self, timeout: float) -> bool:
+        """Block until a token is available or timeout elapses."""
+        if self.rate <= 0:
+            return True
+        end = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return True
+                wait = (1.0 - self._tokens) / self.rate
+            if time.monotonic() + wait > end:
+                return False
+            time.sleep(wait)
@@ -0,0 +1,113 @@
+"""Micro-benchmark for the pre-LLM query guard (guard.classify_question).
+
+Usage (from backend/):
+    python bench/bench_guard.py [--iterations 2000]
+
+Prints the mean per-question overhead in microseconds for short, typical and long
+questions. When better_profanity is installed, the legacy check
+(profanity.contains_profanity) is timed on the same inputs for comparison, and
+guard.contains_profanity is checked against it over a generated corpus of listed
+words, leetspeak variants, multi-word phrases and ordinary sentences; any
+disagreement is printed and the script exits with status 1.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import guard  # noqa: E402
+
+SAMPLES = {
+    "greeting": "hello there",
+    "short": "What are the objectives of the project?",
+    "typical": "Can you explain how the methodology section describes data collection, "
+               "sampling, and the statistical tests used to validate the results?",
+    "long": " ".join(["Please summarize the discussion of limitations and future work"] * 40) + "?",
+}
+
+
+def _time_us(fn, text: str, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(text)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+ORDINARY = [
+    "What does the report say about the budget?",
+    "lol that was a vivid lecture on level sets",
+    "Explain the role of the liver in metabolism.",
+    "Is Scunthorpe mentioned in chapter 3?",
+    "assess the classic assumptions, e.g. homoscedasticity",
+    "x", "a ", " ", "", "?!", "1v1 @ 5pm $5",
+]
+
+
+def _corpus(size: int, seed: int = 7) -> list:
+    """Listed words as-is, with random CHARS_MAPPING substitutions and case changes, glued to
+    neighbours or split by separators, embedded in ordinary sentences."""
+    rng = random.Random(seed)
+    words = sorted(guard._CENSOR_WORDS)
+    texts = list(ORDINARY) + words
+    for _ in range(size):
+        w = rng.choice(words)
+        chars = []
+        for ch in w:
+            variants = guard.CHARS_MAPPING.get(ch)
+            if variants and rng.random() < 0.4:
+                ch = rng.choice(variants)
+            elif ch == " " and rng.random() < 0.3:
+                ch = rng.choice(["_", "-", "  ", ""])
+            chars.append(ch.upper() if rng.random() < 0.1 else ch)
+        w = "".join(chars)
+        if rng.random() < 0.2:
+            w = rng.choice(["s", "x", "ed", "1"]) + w if rng.random() < 0.5 else w + rng.choice(["s", "y", "ing", "!"])
+        base = rng.choice(ORDINARY).split(" ")
+        base.insert(rng.randrange(len(base) + 1), w)
+        texts.append(" ".join(base))
+    return texts
+
+
+def check_equivalence(legacy, size: int) -> int:
+    mismatches = 0
+    corpus = _corpus(size)
+    for text in corpus:
+        expected, got = legacy(text), guard.contains_profanity(text)
+        if expected != got:
+            mismatches += 1
+            if mismatches <= 20:
+                print(f"MISMATCH legacy={expected} guard={got}: {text!r}")
+    print(f"equivalence: {len(corpus) - mismatches}/{len(corpus)} agree")
+    return mismatches
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--iterations", type=int, default=2000)
+    ap.add_argument("--corpus", type=int, default=5000, help="generated texts for the equivalence check")
+    args = ap.parse_args()
+
+    legacy = None
+    try:
+        from better_profanity import profanity
+        profanity.load_censor_words()
+        legacy = profanity.contains_profanity
+    except Exception:
+        pass
+
+    print(f"trie nodes: {len(guard.PROFANITY_MATCHER)}")
+    print(f"{'sample':<10} {'chars':>6} {'guard us':>10} {'legacy us':>10}")
+    for name, text in SAMPLES.items():
+        new_us = _time_us(guard.classify_question, text, args.iterations)
+        old_us = _time_us(legacy, text, max(1, args.iterations // 20)) if legacy else float("nan")
+        print(f"{name:<10} {len(text):>6} {new_us:>10.1f} {old_us:>10.1f}")
+
+    if legacy and check_equivalence(legacy, args.corpus):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
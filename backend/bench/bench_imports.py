@@ -0,0 +1,75 @@
+"""Import-time breakdown for `import main`, the work a worker does before /healthz can answer.
+
+Usage (from backend/):
+    python bench/bench_imports.py [--top 15] [--out imports.json] [--max-sec 2.0]
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter with WARMUP=false (so
+the background warm-up thread does not race the measurement) and sums the cumulative time
+per top-level package. Heavy packages (chromadb, google, PyPDF2, docx, better_profanity)
+should not appear; if one does, something on the import path uses it eagerly again.
+With --max-sec the script exits 1 when the total exceeds the budget, for use in CI.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("chromadb", "google", "PyPDF2", "docx", "better_profanity")
+
+
+def measure() -> dict:
+    env = dict(os.environ, WARMUP="false", STATE_STORE="memory")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise SystemExit("import main failed:\n" + proc.stderr[-2000:])
+
+    per_package = defaultdict(int)
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cumulative_us, raw_name = line.split(":", 1)[1].split("|")
+        # One leading space, plus two per nesting level.
+        depth = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        name = raw_name.strip()
+        if depth == 0:
+            # Top-level entries: their cumulative times add up to the whole import.
+            per_package[name.split(".")[0]] += int(cumulative_us)
+            total_us += int(cumulative_us)
+
+    packages = sorted(per_package.items(), key=lambda kv: kv[1], reverse=True)
+    return {
+        "total_sec": round(total_us / 1e6, 4),
+        "packages_sec": {name: round(us / 1e6, 4) for name, us in packages},
+        "heavy_loaded": [name for name in HEAVY if name in per_package],
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--top", type=int, default=15)
+    ap.add_argument("--out", default="")
+    ap.add_argument("--max-sec", type=float, default=0.0)
+    args = ap.parse_args()
+
+    result = measure()
+    result["packages_sec"] = dict(list(result["packages_sec"].items())[: args.top])
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    if args.max_sec and result["total_sec"] > args.max_sec:
+        print(f"import main took {result['total_sec']}s, over the {args.max_sec}s budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Startup time and per-worker memory for the gunicorn deployment.
+
+Usage (from backend/, Linux only because it reads /proc):
+    python bench/bench_startup.py [--workers 4] [--port 5099] [--out startup.json]
+
+Boots `gunicorn main:app -c gunicorn.conf.py` twice, once with PRELOAD_APP=false and once
+with PRELOAD_APP=true. For each run it records the seconds until /healthz answers and the
+RSS and PSS of every worker. PSS splits shared pages between the processes that map them,
+so it shows the copy-on-write saving from preloading and RSS does not.
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _children(pid: int) -> list:
+    kids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[1]) == pid:
+                kids.append(int(entry))
+        except OSError:
+            continue
+    return kids
+
+
+def _mem_kb(pid: int) -> dict:
+    out = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    out[key.lower() + "_kb"] = int(rest.split()[0])
+    except OSError:
+        pass
+    return out
+
+
+def _wait_ready(port: int, timeout: float) -> bool:
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1) as r:
+                if r.status == 200:
+                    return True
+        except Exception:
+            time.sleep(0.1)
+    return False
+
+
+def run(preload: bool, workers: int, port: int) -> dict:
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), PRELOAD_APP="true" if preload else "false")
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"],
+        cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        ready = _wait_ready(port, 120)
+        ready_sec = time.time() - start
+        time.sleep(1.0)  # let every worker finish post_fork
+        workers_mem = [dict(pid=pid, **_mem_kb(pid)) for pid in _children(proc.pid)]
+        return {
+            "preload": preload,
+            "ready": ready,
+            "ready_sec": round(ready_sec, 3),
+            "master": _mem_kb(proc.pid),
+            "workers": workers_mem,
+            "worker_pss_total_kb": sum(w.get("pss_kb", 0) for w in workers_mem),
+        }
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--port", type=int, default=5099)
+    ap.add_argument("--out", default="")
+    args = ap.parse_args()
+    results = [run(False, args.workers, args.port), run(True, args.workers, args.port)]
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Offline stand-ins for the services the Flask backend talks to, used by bench/run_bench.py.
+
+- FakeGenAI: drop-in for the `google.generativeai` module. Deterministic answers (valid quiz /
+  flashcard JSON built from the prompt's context, plain text otherwise), hashed bag-of-words
+  embeddings, configurable latency and injected transient errors.
+- StubNode: threaded HTTP server for the Node API routes the backend calls
+  (/api/document/:id/download, /_meta, /consent and the chunk upsert endpoint).
+- build_pdf / synthetic_pages: small multi-page PDFs that PyPDF2 can extract.
+"""
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VOCAB = (
+    "system data model analysis method result process design network security protocol "
+    "database query index cache latency throughput memory storage cluster node service "
+    "request response client server policy budget schedule risk quality testing review "
+    "requirement architecture module interface component algorithm complexity graph tree "
+    "vector embedding retrieval ranking evaluation metric baseline experiment dataset"
+).split()
+TOPICS = ("Introduction", "Background", "Methodology", "Implementation", "Evaluation", "Results", "Discussion", "Conclusion")
+
+
+# ---- Synthetic documents ----
+def synthetic_pages(seed: int, pages: int, lines_per_page: int = 40) -> list:
+    """Deterministic pages of sentence-like lines with a heading every few pages."""
+    rnd = random.Random(seed)
+    out = []
+    for p in range(pages):
+        lines = []
+        if p % 3 == 0:
+            lines.append(f"{(p // 3) + 1}. {TOPICS[(p // 3) % len(TOPICS)]}")
+            lines.append("")
+        while len(lines) < lines_per_page:
+            words = [rnd.choice(VOCAB) for _ in range(rnd.randint(8, 14))]
+            lines.append(" ".join(words).capitalize() + ".")
+            if rnd.random() < 0.15:
+                lines.append("")
+        out.append(lines)
+    return out
+
+
+def _pdf_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def build_pdf(pages: list) -> bytes:
+    """Minimal PDF 1.4 writer: one Helvetica text block per page, one line per Tj."""
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b"")  # filled in below once the page tree exists
+    pages_obj = add(b"")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    kids = []
+    for lines in pages:
+        ops = ["BT", "/F1 10 Tf", "12 TL", "50 790 Td"]
+        for line in lines:
+            ops.append(f"({_pdf_escape(line)}) Tj T*")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_obj, content, font)
+        ))
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_obj
+    objects[pages_obj - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    return bytes(out)
+
+
+# ---- Fake google.generativeai ----
+class ServiceUnavailable(Exception):
+    """Named like google.api_core's 503 so llm_client treats it as transient."""
+
+
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _Response:
+    def __init__(self, text: str, prompt_chars: int):
+        self.text = text
+        self.usage_metadata = _Usage(prompt_chars // 4, len(text) // 4)
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _StreamResponse:
+    """Iterates a finished _Response in ~80-char chunks, sleeping between them."""
+
+    CHUNK_CHARS = 80
+
+    def __init__(self, resp: _Response, rest_ms: float):
+        self._text = resp.text
+        self.usage_metadata = resp.usage_metadata
+        n = max(1, math.ceil(len(self._text) / self.CHUNK_CHARS))
+        self._delay = rest_ms / 1000.0 / n
+
+    def __iter__(self):
+        for i in range(0, len(self._text), self.CHUNK_CHARS):
+            if i:
+                time.sleep(self._delay)
+            yield _Chunk(self._text[i:i + self.CHUNK_CHARS])
+
+
+def _prompt_text(contents) -> str:
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(str(c) for c in contents)
+    return str(contents)
+
+
+def _context_sentences(prompt: str) -> list:
+    ctx = prompt.split("Document Context:", 1)[-1]
+    return [s.strip() for s in re.split(r"(?<=[.!?])\s+", ctx) if len(s.strip()) > 20]
+
+
+def _requested(prompt: str, pattern: str, default: int) -> int:
+    m = re.search(pattern, prompt)
+    return int(m.group(1)) if m else default
+
+
+class FakeGenAI(types.ModuleType):
+    def __init__(self, latency_ms: float = 300.0, jitter_ms: float = 50.0, embed_latency_ms: float = 40.0,
+                 error_rate: float = 0.0, dim: int = 256, seed: int = 1234):
+        super().__init__("google.generativeai")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.embed_latency_ms = embed_latency_ms
+        self.error_rate = error_rate
+        self.dim = dim
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"generate": 0, "embed": 0, "embed_texts": 0, "errors": 0}
+        fake = self
+
+        class GenerativeModel:
+            def __init__(self, model_name, generation_config=None, **_):
+                self.model_name = model_name
+                self.generation_config = generation_config or {}
+
+            def generate_content(self, contents, stream=False, request_options=None, **_):
+                if stream:
+                    return fake._generate_stream(_prompt_text(contents))
+                return fake._generate(_prompt_text(contents))
+
+            def count_tokens(self, contents, request_options=None, **_):
+                return types.SimpleNamespace(total_tokens=len(_prompt_text(contents)) // 4)
+
+        self.GenerativeModel = GenerativeModel
+
+    def configure(self, **_):
+        pass
+
+    def _sleep_and_maybe_fail(self, base_ms: float, kind: str):
+        with self._lock:
+            delay = max(0.0, self._rnd.gauss(base_ms, self.jitter_ms if kind == "generate" else base_ms * 0.1))
+            fail = self._rnd.random() < self.error_rate
+            self.stats[kind] += 1
+            if fail:
+                self.stats["errors"] += 1
+        time.sleep(delay / 1000.0)
+        if fail:
+            raise ServiceUnavailable(f"injected {kind} failure")
+
+    def _generate(self, prompt: str, latency_ms: float = None) -> _Response:
+        self._sleep_and_maybe_fail(self.latency_ms if latency_ms is None else latency_ms, "generate")
+        sentences = _context_sentences(prompt) or ["The document describes a system and its evaluation."]
+        if '"flashcards"' in prompt:
+            n = _requested(prompt, r"Number of flashcards to generate now:\s*(\d+)", 10)
+            cards = [{
+                "front": f"What does the document say about: {s[:80]}?",
+                "back": s[:300],
+                "category": TOPICS[i % len(TOPICS)],
+                "difficulty": ("Easy", "Medium", "Hard")[i % 3],
+            } for i, s in enumerate(sentences[:n])]
+            text = json.dumps({"flashcards": cards})
+        elif '"questions"' in prompt:
+            n = _requested(prompt, r"Number of questions:\s*(\d+)", 10)
+            qs = []
+            for i, s in enumerate(sentences[:n]):
+                kind = ("mcq", "true_false", "short_answer")[i % 3]
+                q = {"type": kind, "question": f"According to the document, {s[:120]}", "explanation": s[:200]}
+                if kind == "mcq":
+                    q["options"] = ["Option A", "Option B", "Option C", "Option D"]
+                    q["correct_answer"] = "Option A"
+                elif kind == "true_false":
+                    q["correct_answer"] = "true"
+                else:
+                    q["correct_answer"] = s[:80]
+                qs.append(q)
+            text = json.dumps({"questions": qs})
+        else:
+            text = " ".join(sentences[:5])
+        return _Response(text, len(prompt))
+
+    def _generate_stream(self, prompt: str) -> "_StreamResponse":
+        # Time to first chunk is a quarter of the latency; the rest is spread over the chunks.
+        resp = self._generate(prompt, self.latency_ms / 4)
+        return _StreamResponse(resp, self.latency_ms * 0.75)
+
+    def _embed_one(self, text: str) -> list:
+        vec = [0.0] * self.dim
+        for tok in re.findall(r"[a-z0-9]+", (text or "").lower()):
+            h = int.from_bytes(hashlib.md5(tok.encode()).digest()[:4], "little")
+            vec[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+    def embed_content(self, model=None, content=None, task_type=None, request_options=None, **_):
+        texts = content if isinstance(content, (list, tuple)) else [content]
+        self._sleep_and_maybe_fail(self.embed_latency_ms, "embed")
+        with self._lock:
+            self.stats["embed_texts"] += len(texts)
+        vectors = [self._embed_one(t) for t in texts]
+        return {"embedding": vectors if isinstance(content, (list, tuple)) else vectors[0]}
+
+
+# ---- Stub Node API ----
+class StubNode:
+    """Serves registered documents plus the internal endpoints the backend posts to."""
+
+    def __init__(self, latency_ms: float = 5.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency_ms = latency_ms
+        self.docs = {}  # doc_id -> (filename, mimetype, bytes)
+        self.upserted_chunks = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def _send(self, status: int, body: bytes, ctype: str = "application/json", headers: dict = None):
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(stub.latency_ms / 1000.0)
+                m = re.match(r"^/api/document/([^/]+)/(download|_meta)$", self.path)
+                if not m or m.group(1) not in stub.docs:
+                    return self._send(404, b'{"error":"not found"}')
+                filename, mimetype, data = stub.docs[m.group(1)]
+                if m.group(2) == "_meta":
+                    return self._send(200, json.dumps({"sensitiveFound": False, "consentConfirmed": True}).encode())
+                return self._send(200, data, mimetype, {"Content-Disposition": f'attachment; filename="{filename}"'})
+
+            def do_POST(self):
+                time.sleep(stub.latency_ms / 1000.0)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.path.endswith("/chunks/upsert"):
+                    try:
+                        n = len(json.loads(body or b"{}").get("chunks") or [])
+                    except ValueError:
+                        n = 0
+                    with stub._lock:
+                        stub.upserted_chunks += n
+                return self._send(200, b'{"ok":true}')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-node", daemon=True)
+
+    def add_pdf(self, doc_id: str, pages: list):
+        self.docs[doc_id] = (f"{doc_id}.pdf", "application/pdf", build_pdf(pages))
+
+    def add_text(self, doc_id: str, text: str):
+        self.docs[doc_id] = (f"{doc_id}.txt", "text/plain", text.encode("utf-8"))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,318 @@
+"""Offline end-to-end benchmark for the Flask backend.
+
+Usage (from backend/):
+    python bench/run_bench.py [--out results.json] [--scenarios indexing,ask,generate,collection]
+                              [--docs 4] [--pages 20] [--concurrency 1,4,16] [--requests 40]
+                              [--llm-latency-ms 300] [--embed-latency-ms 40] [--error-rate 0]
+                              [--collection-sizes 1000,10000] [--compare previous.json]
+
+Nothing leaves the machine. Gemini is replaced by bench/fakes.FakeGenAI, which gives
+deterministic answers with the configured latency and injected transient errors. A StubNode
+HTTP server on localhost serves the Node API routes. Chroma, PyPDF2 and the rest of the app
+are real, so the numbers reflect this tree's own overhead on top of the simulated service
+latency. Requests go through the Flask test client, with admission limits raised so the
+scenario's concurrency is what gets measured; pass --keep-admission to leave them as configured.
+
+Scenarios:
+  indexing    POST /api/index-from-atlas for synthetic PDFs: pages/sec, chunks/sec, per-doc latency
+  ask         POST /api/document/ask at each concurrency: p50/p90/p99, throughput, status counts
+  generate    quiz, flashcards and summarize latency plus the number of items returned
+  collection  GET /api/document/my and DELETE /api/document/<id> at large collection sizes
+
+Results are one JSON document. --compare prints the change in every numeric field against an
+earlier result file.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeGenAI, StubNode, synthetic_pages  # noqa: E402
+
+QUESTIONS = [
+    "What does the methodology section say about data collection?",
+    "How is the system evaluated?",
+    "Which metrics are reported in the results?",
+    "What are the main risks discussed?",
+    "Summarize the architecture of the service.",
+    "What is said about cache latency and throughput?",
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return round(ordered[k], 2)
+
+
+def latency_summary(latencies_ms: list) -> dict:
+    return {
+        "n": len(latencies_ms),
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 2) if latencies_ms else None,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p90_ms": percentile(latencies_ms, 90),
+        "p99_ms": percentile(latencies_ms, 99),
+        "max_ms": round(max(latencies_ms), 2) if latencies_ms else None,
+    }
+
+
+def timed_call(fn):
+    start = time.perf_counter()
+    resp = fn()
+    return (time.perf_counter() - start) * 1000.0, resp
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+# ---- Scenarios ----
+def run_indexing(client, stub: StubNode, args) -> dict:
+    doc_ids = []
+    for i in range(args.docs):
+        doc_id = f"bench-doc-{i}"
+        stub.add_pdf(doc_id, synthetic_pages(seed=i, pages=args.pages))
+        doc_ids.append(doc_id)
+
+    latencies, chunks, failures = [], 0, 0
+    start = time.perf_counter()
+    for doc_id in doc_ids:
+        ms, resp = timed_call(lambda: client.post("/api/index-from-atlas", json={"doc_id": doc_id}))
+        latencies.append(ms)
+        body = resp.get_json(silent=True) or {}
+        if resp.status_code != 200:
+            failures += 1
+            continue
+        try:
+            chunks += int(str(body.get("message", "")).split()[1])
+        except (IndexError, ValueError):
+            pass
+    wall = time.perf_counter() - start
+    return {
+        "docs": args.docs,
+        "pages_per_doc": args.pages,
+        "failures": failures,
+        "chunks": chunks,
+        "wall_sec": round(wall, 3),
+        "pages_per_sec": round(args.docs * args.pages / wall, 2) if wall else None,
+        "chunks_per_sec": round(chunks / wall, 2) if wall else None,
+        "per_doc": latency_summary(latencies),
+        "doc_ids": doc_ids,
+    }
+
+
+def run_ask(client, doc_ids: list, args) -> dict:
+    out = {}
+    rnd = random.Random(7)
+    for conc in args.concurrency:
+        jobs = [(rnd.choice(doc_ids), rnd.choice(QUESTIONS)) for _ in range(args.requests)]
+
+        def one(job):
+            doc_id, question = job
+            return timed_call(lambda: client.post("/api/document/ask", json={"doc_id": doc_id, "question": question}))
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=conc) as pool:
+            results = list(pool.map(one, jobs))
+        wall = time.perf_counter() - start
+        statuses = {}
+        for _, resp in results:
+            statuses[str(resp.status_code)] = statuses.get(str(resp.status_code), 0) + 1
+        out[f"c{conc}"] = dict(
+            latency_summary([ms for ms, resp in results if resp.status_code == 200]),
+            throughput_rps=round(len(jobs) / wall, 2) if wall else None,
+            statuses=statuses,
+        )
+    return out
+
+
+def run_generate(client, doc_ids: list, args) -> dict:
+    doc_id = doc_ids[0]
+    summary_text = "\n\n".join(" ".join(p) for p in synthetic_pages(seed=99, pages=max(2, args.pages // 4)))
+    cases = {
+        "quiz": ("/api/document/generate-quiz", {"doc_id": doc_id, "num_questions": 10}, "quiz"),
+        "flashcards": ("/api/document/generate-flashcards", {"doc_id": doc_id, "num_cards": 30}, "flashcards"),
+        "summarize": ("/api/summarize", {"doc_id": doc_id, "selectionText": summary_text}, "summary"),
+    }
+    out = {}
+    for name, (path, payload, field) in cases.items():
+        latencies, items, statuses = [], [], {}
+        for _ in range(args.repeat):
+            ms, resp = timed_call(lambda: client.post(path, json=payload))
+            statuses[str(resp.status_code)] = statuses.get(str(resp.status_code), 0) + 1
+            if resp.status_code != 200:
+                continue
+            latencies.append(ms)
+            body = resp.get_json(silent=True) or {}
+            value = body.get(field)
+            if name == "quiz":
+                items.append(len((value or {}).get("questions") or []))
+            elif name == "flashcards":
+                items.append(len(value or []))
+            else:
+                items.append(len(value or ""))
+        out[name] = dict(latency_summary(latencies), statuses=statuses,
+                         items_mean=round(sum(items) / len(items), 2) if items else None)
+    return out
+
+
+def run_collection(client, main, fake: FakeGenAI, args) -> dict:
+    out = {}
+    rnd = random.Random(11)
+    collection = main.get_collection()
+    existing = collection.count()
+    for size in args.collection_sizes:
+        to_add = max(0, size - existing)
+        docs_in_batch = max(1, to_add // 50)
+        batch = 500
+        for start in range(0, to_add, batch):
+            n = min(batch, to_add - start)
+            rows = [existing + start + i for i in range(n)]
+            # Same id scheme as index_bytes (<doc_id>_<chunk>) so delete_doc finds them.
+            owners = [f"scale-doc-{row % docs_in_batch}" for row in rows]
+            collection.add(
+                ids=[f"{doc}_{row}" for doc, row in zip(owners, rows)],
+                embeddings=[[rnd.uniform(-1, 1) for _ in range(fake.dim)] for _ in range(n)],
+                documents=[f"synthetic chunk {row}" for row in rows],
+                metadatas=[{"doc_id": doc, "chunk": row, "filename": "scale.txt"} for doc, row in zip(owners, rows)],
+            )
+        existing = collection.count()
+
+        list_ms = [timed_call(lambda: client.get("/api/document/my"))[0] for _ in range(args.repeat)]
+        delete_ms = []
+        for i in range(min(args.repeat, docs_in_batch)):
+            ms, resp = timed_call(lambda: client.delete(f"/api/document/scale-doc-{i}"))
+            if resp.status_code == 200:
+                delete_ms.append(ms)
+        existing = collection.count()
+        out[f"n{size}"] = {"rows": existing, "list": latency_summary(list_ms), "delete": latency_summary(delete_ms)}
+    return out
+
+
+# ---- Comparison ----
+def _flatten(d: dict, prefix: str = "") -> dict:
+    flat = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            flat.update(_flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[key] = v
+    return flat
+
+
+def compare(previous: dict, current: dict):
+    old, new = _flatten(previous.get("scenarios", {})), _flatten(current.get("scenarios", {}))
+    print(f"{'metric':<48} {'before':>12} {'after':>12} {'change':>9}")
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key], new[key]
+        change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+        print(f"{key:<48} {a:>12} {b:>12} {change:>9}")
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", default="")
+    ap.add_argument("--scenarios", default="indexing,ask,generate,collection")
+    ap.add_argument("--docs", type=int, default=4)
+    ap.add_argument("--pages", type=int, default=20)
+    ap.add_argument("--concurrency", default="1,4,16")
+    ap.add_argument("--requests", type=int, default=40)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--llm-latency-ms", type=float, default=300.0)
+    ap.add_argument("--llm-jitter-ms", type=float, default=50.0)
+    ap.add_argument("--embed-latency-ms", type=float, default=40.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--node-latency-ms", type=float, default=5.0)
+    ap.add_argument("--collection-sizes", default="1000,10000")
+    ap.add_argument("--keep-admission", action="store_true")
+    ap.add_argument("--compare", default="")
+    args = ap.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    args.collection_sizes = [int(c) for c in args.collection_sizes.split(",") if c.strip()]
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    args.out = os.path.abspath(args.out) if args.out else ""
+    args.compare = os.path.abspath(args.compare) if args.compare else ""
+
+    stub = StubNode(latency_ms=args.node_latency_ms).start()
+    fake = FakeGenAI(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms,
+                     embed_latency_ms=args.embed_latency_ms, error_rate=args.error_rate)
+    workdir = tempfile.mkdtemp(prefix="smartdoc-bench-")
+
+    # Everything the app reads at import time has to be in place before `import main`.
+    os.environ.update({
+        "NODE_BASE_URL": stub.base_url,
+        "CHUNK_UPSERT_URL": f"{stub.base_url}/api/search/internal/chunks/upsert",
+        "CHROMA_DB_PATH": os.path.join(workdir, "chroma_db"),
+        "STATE_STORE": "memory",
+        "PROFILE_DIR": os.path.join(workdir, "profiles"),
+        "WARMUP": "false",
+        "GEMINI_API_KEY": "offline-bench",
+        "LLM_BACKOFF_BASE": "0.05",
+        # The fake SDK has no caching module; the local stand-in keeps the code path exercised.
+        "CONTEXT_CACHE": "local",
+    })
+    if not args.keep_admission:
+        for cls in ("ASK", "GENERATE", "SUMMARIZE", "INDEXING", "PREVIEW"):
+            os.environ.setdefault(f"ADMISSION_{cls}", "512/512")
+    sys.modules["google.generativeai"] = fake
+    os.chdir(BACKEND)
+    import main  # noqa: E402
+
+    client = main.app.test_client()
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        "scenarios": {},
+    }
+
+    doc_ids = []
+    if "indexing" in scenarios or "ask" in scenarios or "generate" in scenarios:
+        indexing = run_indexing(client, stub, args)
+        doc_ids = indexing.pop("doc_ids")
+        indexing["node_chunks_upserted"] = stub.upserted_chunks
+        if "indexing" in scenarios:
+            results["scenarios"]["indexing"] = indexing
+    if "ask" in scenarios:
+        results["scenarios"]["ask"] = run_ask(client, doc_ids, args)
+    if "generate" in scenarios:
+        results["scenarios"]["generate"] = run_generate(client, doc_ids, args)
+    if "collection" in scenarios:
+        results["scenarios"]["collection"] = run_collection(client, main, fake, args)
+    results["meta"]["fake_genai_calls"] = dict(fake.stats)
+    stub.stop()
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main_cli()
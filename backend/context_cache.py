@@ -0,0 +1,299 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import llm_client
+from metrics import cache_lookup
+from startup import import_timed
+from state_store import MemoryStateStore, open_store, update_state
+
+# ====== PROVIDER-SIDE CONTEXT CACHING ======
+# Quiz and flashcard prompts are a fixed system instruction, a large document block and a small
+# request. When the same document block is sent again, the system instruction and the block
+# are stored with the provider (Gemini cached content) and later calls only send the request
+# and reference the cache: cached prompt tokens are billed at a discount and the model starts
+# answering sooner. Caches are keyed by (doc_id, hash of model + instruction + block), so a
+# reindex or a different context selection simply yields a new key.
+#
+# CONTEXT_CACHE=gemini (default) uses the provider; =local keeps a per-process stand-in that
+# re-sends the cached parts itself (tests, bench, SDKs without caching); =off disables it.
+# A cache is only created on the CONTEXT_CACHE_MIN_USES-th sighting of a block, lives
+# CONTEXT_CACHE_TTL_SEC (extended while in use) and is deleted when its document is reindexed
+# or removed. The key -> cache name registry is in the shared state store, so every worker
+# reuses the same provider cache.
+
+CONTEXT_CACHE = os.environ.get("CONTEXT_CACHE", "gemini").strip().lower()
+CONTEXT_CACHE_TTL_SEC = float(os.environ.get("CONTEXT_CACHE_TTL_SEC", "900"))
+# The provider rejects caches under its minimum size (1024 tokens for 2.5 Flash).
+CONTEXT_CACHE_MIN_CHARS = int(os.environ.get("CONTEXT_CACHE_MIN_CHARS", "6000"))
+CONTEXT_CACHE_MIN_USES = int(os.environ.get("CONTEXT_CACHE_MIN_USES", "2"))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.environ.get("CONTEXT_CACHE_MAX_ENTRIES", "128"))
+# After a failed create (unsupported model, quota), do not try that model again for this long.
+CONTEXT_CACHE_RETRY_SEC = 600.0
+
+
+class NotFound(LookupError):
+    """Raised by the local backend for an evicted cache; named like the provider's error so
+    llm_client falls back to the full prompt the same way."""
+
+
+class CachedContext:
+    """A document block held by a cache backend. `fallback_contents` is the full prompt to
+    send instead when the cache turns out to be unusable."""
+
+    def __init__(self, key: str, doc_id: str, model_name: str, name: str, expires_at: float, fallback_contents: list):
+        self.key = key
+        self.doc_id = doc_id
+        self.model_name = model_name
+        self.name = name
+        self.expires_at = expires_at
+        self.fallback_contents = fallback_contents
+
+    def model(self, generation_config: dict = None):
+        return _backend().model(self, generation_config)
+
+    def forget(self, error: Exception = None):
+        print(f"[ContextCache] Dropping {self.name} for {self.doc_id}: {error}")
+        _forget(self.key)
+
+
+# ---- Backends ----
+class _GeminiBackend:
+    def __init__(self):
+        self._handles = OrderedDict()  # cache name -> CachedContent
+        self._models = {}  # (cache name, config json) -> GenerativeModel
+        self._lock = threading.Lock()
+
+    def _caching(self):
+        llm_client._ensure_configured()
+        return import_timed("google.generativeai.caching")
+
+    def create(self, model_name: str, system_instruction: str, block: str, doc_id: str) -> str:
+        cached = self._caching().CachedContent.create(
+            model=model_name,
+            display_name=f"smartdoc-{doc_id}"[:120],
+            system_instruction=system_instruction,
+            contents=[block],
+            ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SEC),
+        )
+        self._remember(cached.name, cached)
+        return cached.name
+
+    def _remember(self, name: str, cached):
+        with self._lock:
+            self._handles[name] = cached
+            self._handles.move_to_end(name)
+            while len(self._handles) > CONTEXT_CACHE_MAX_ENTRIES:
+                old, _ = self._handles.popitem(last=False)
+                for key in [k for k in self._models if k[0] == old]:
+                    del self._models[key]
+
+    def _handle(self, name: str):
+        with self._lock:
+            cached = self._handles.get(name)
+        if cached is None:
+            # Created by another worker: one lookup, then kept like our own.
+            cached = self._caching().CachedContent.get(name)
+            self._remember(name, cached)
+        return cached
+
+    def model(self, ctx: CachedContext, generation_config: dict = None):
+        key = (ctx.name, repr(sorted((generation_config or {}).items())))
+        with self._lock:
+            model = self._models.get(key)
+        if model is None:
+            model = llm_client.genai.GenerativeModel.from_cached_content(
+                cached_content=self._handle(ctx.name), generation_config=generation_config)
+            with self._lock:
+                self._models[key] = model
+        return model
+
+    def refresh(self, name: str):
+        self._handle(name).update(ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SEC))
+
+    def delete(self, name: str):
+        with self._lock:
+            cached = self._handles.pop(name, None)
+            for key in [k for k in self._models if k[0] == name]:
+                del self._models[key]
+        (cached or self._caching().CachedContent.get(name)).delete()
+
+
+class _PrefixedModel:
+    """Stand-in for a model bound to cached content: prepends the cached parts to each call."""
+
+    def __init__(self, model, prefix: list):
+        self._model = model
+        self._prefix = prefix
+
+    def generate_content(self, contents, **kwargs):
+        contents = list(contents) if isinstance(contents, (list, tuple)) else [contents]
+        return self._model.generate_content(self._prefix + contents, **kwargs)
+
+
+class _LocalBackend:
+    def __init__(self):
+        self._entries = OrderedDict()  # name -> (model_name, [system_instruction, block])
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def create(self, model_name: str, system_instruction: str, block: str, doc_id: str) -> str:
+        with self._lock:
+            self._seq += 1
+            name = f"local/{os.getpid()}/{self._seq}"
+            self._entries[name] = (model_name, [system_instruction, block])
+            while len(self._entries) > CONTEXT_CACHE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+        return name
+
+    def model(self, ctx: CachedContext, generation_config: dict = None):
+        with self._lock:
+            entry = self._entries.get(ctx.name)
+        if entry is None:
+            raise NotFound(f"local cache {ctx.name} evicted")
+        return _PrefixedModel(llm_client.get_model(entry[0], generation_config), entry[1])
+
+    def refresh(self, name: str):
+        pass
+
+    def delete(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+
+_backend_instance = None
+_registry = None
+_init_lock = threading.Lock()
+_create_locks = {}
+_failed_models = {}  # model name -> retry after (monotonic)
+
+
+def _backend():
+    global _backend_instance, _registry
+    if _backend_instance is None:
+        with _init_lock:
+            if _backend_instance is None:
+                if CONTEXT_CACHE == "local":
+                    # Local cache names mean nothing to other processes; keep the registry here too.
+                    _registry = MemoryStateStore("context_cache")
+                    _backend_instance = _LocalBackend()
+                else:
+                    _registry = open_store("context_cache")
+                    _backend_instance = _GeminiBackend()
+    return _backend_instance
+
+
+def _forget(key: str):
+    _backend()
+    entry = _registry.get(key) or {}
+    _registry.delete(key)
+    if entry.get("name"):
+        try:
+            _backend().delete(entry["name"])
+        except Exception as e:
+            print("[ContextCache] Delete failed for", entry["name"], "=>", e)
+
+
+def _cache_key(doc_id: str, model_name: str, system_instruction: str, block: str) -> str:
+    digest = hashlib.sha256("\x00".join((model_name, system_instruction, block)).encode("utf-8")).hexdigest()[:32]
+    return f"{doc_id}:{digest}"
+
+
+def cached_prompt(doc_id: str, system_instruction: str, block: str, request_text: str, model_name: str = None):
+    """Contents for a prompt of a fixed system instruction, a large document block and a small
+    request. Returns (contents, cached_context): with a cache, contents is just the request and
+    cached_context must be passed to llm_client.generate_content(...); without one (disabled,
+    small block, first sighting, create failed), contents is the full prompt and cached_context
+    is None."""
+    full = [system_instruction, request_text + "\n\n" + block]
+    model_name = model_name or llm_client.TEXT_MODEL
+    if CONTEXT_CACHE not in ("gemini", "local") or not doc_id or len(block) < CONTEXT_CACHE_MIN_CHARS:
+        return full, None
+    if _failed_models.get(model_name, 0) > time.monotonic():
+        return full, None
+
+    backend = _backend()
+    key = _cache_key(doc_id, model_name, system_instruction, block)
+    now = time.time()
+    entry = _registry.get(key) or {}
+    if _usable(entry):
+        cache_lookup("context", True)
+        if entry["expires_at"] - now < CONTEXT_CACHE_TTL_SEC / 3:
+            try:
+                backend.refresh(entry["name"])
+                entry = update_state(_registry, key, lambda st: dict(st, expires_at=time.time() + CONTEXT_CACHE_TTL_SEC),
+                                     ttl=CONTEXT_CACHE_TTL_SEC)
+            except Exception as e:
+                print("[ContextCache] TTL refresh failed for", entry["name"], "=>", e)
+        return [request_text], CachedContext(key, doc_id, model_name, entry["name"], entry["expires_at"], full)
+    if entry.get("name"):
+        # About to expire: extend it, or delete it at the provider before it is replaced.
+        try:
+            backend.refresh(entry["name"])
+            entry = update_state(_registry, key, lambda st: dict(st, expires_at=time.time() + CONTEXT_CACHE_TTL_SEC),
+                                 ttl=CONTEXT_CACHE_TTL_SEC)
+            cache_lookup("context", True)
+            return [request_text], CachedContext(key, doc_id, model_name, entry["name"], entry["expires_at"], full)
+        except Exception as e:
+            print("[ContextCache] Could not extend", entry["name"], "=>", e)
+            try:
+                backend.delete(entry["name"])
+            except Exception:
+                pass
+
+    cache_lookup("context", False)
+    entry = update_state(_registry, key, _count_use, ttl=CONTEXT_CACHE_TTL_SEC)
+    if _usable(entry):
+        # Another worker created it meanwhile.
+        return [request_text], CachedContext(key, doc_id, model_name, entry["name"], entry["expires_at"], full)
+    if entry["uses"] < CONTEXT_CACHE_MIN_USES:
+        return full, None
+
+    with _init_lock:
+        lock = _create_locks.setdefault(key, threading.Lock())
+    with lock:
+        try:
+            current = _registry.get(key) or {}
+            if _usable(current):
+                return [request_text], CachedContext(key, doc_id, model_name, current["name"], current["expires_at"], full)
+            try:
+                name = backend.create(model_name, system_instruction, block, doc_id)
+            except Exception as e:
+                print(f"[ContextCache] Create failed for {model_name}; sending full prompts for a while: {e}")
+                _failed_models[model_name] = time.monotonic() + CONTEXT_CACHE_RETRY_SEC
+                return full, None
+            expires_at = time.time() + CONTEXT_CACHE_TTL_SEC
+            _registry.set(key, {"name": name, "expires_at": expires_at, "uses": entry["uses"]}, ttl=CONTEXT_CACHE_TTL_SEC)
+            update_state(_registry, f"doc:{doc_id}", lambda st: dict(st, keys=sorted(set(st.get("keys", [])) | {key})),
+                         ttl=CONTEXT_CACHE_TTL_SEC * 4)
+        finally:
+            # Only after the registry write: a thread arriving now must find the new cache.
+            with _init_lock:
+                _create_locks.pop(key, None)
+    return [request_text], CachedContext(key, doc_id, model_name, name, expires_at, full)
+
+
+def _usable(entry: dict) -> bool:
+    return bool(entry.get("name")) and entry.get("expires_at", 0) > time.time() + 30
+
+
+def _count_use(entry: dict) -> dict:
+    # A cache another worker just registered is kept; only a stale name is cleared.
+    entry = dict(entry, uses=entry.get("uses", 0) + 1)
+    if not _usable(entry):
+        entry["name"] = None
+    return entry
+
+
+def invalidate_doc_caches(doc_id: str):
+    """Delete every cache created for doc_id (call on reindex/delete)."""
+    if CONTEXT_CACHE not in ("gemini", "local"):
+        return
+    _backend()
+    keys = (_registry.get(f"doc:{doc_id}") or {}).get("keys", [])
+    _registry.delete(f"doc:{doc_id}")
+    for key in keys:
+        _forget(key)
@@ -0,0 +1,306 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from startup import import_timed
+from token_budget import MIN_PARTIAL_TOKENS, SEPARATOR_TOKENS, estimate_tokens, pack, trim_to_tokens
+
+# ====== REPRESENTATIVE CONTEXT SELECTION ======
+# Quiz and flashcard prompts get a fixed token budget. Instead of the first N chunks of the
+# document, pick one representative chunk per topic: k-means over the document's stored chunk
+# embeddings (k sized to the budget), the member nearest each centroid, larger clusters first.
+# Only the chosen chunks' texts are fetched, and they are joined in document order. Callers that
+# fan out over the document (flashcards) ask for several sections, each selected independently.
+
+# index_bytes packs ~1000-char windows (~250 tokens of English); most chunks land near this.
+EST_CHUNK_TOKENS = 250
+KMEANS_ITERATIONS = 8
+SELECTION_CACHE_SIZE = int(os.environ.get("CONTEXT_SELECTION_CACHE_SIZE", "256"))
+SELECTION_CACHE_TTL_SEC = float(os.environ.get("CONTEXT_SELECTION_CACHE_TTL_SEC", "3600"))
+# Unindexed text is not split into sections shorter than this.
+MIN_SECTION_CHARS = 2000
+# Consecutive chunks repeat the previous chunk's last ~200 characters (chunk_text overlap).
+# Overlaps are matched exactly, within this many characters and no shorter than the minimum.
+MAX_OVERLAP_CHARS = 400
+MIN_OVERLAP_CHARS = 20
+# ask_doc: also pull in the chunks right before/after each hit while the token budget allows.
+CONTEXT_NEIGHBOR_EXPANSION = os.environ.get("CONTEXT_NEIGHBOR_EXPANSION", "true").lower() == "true"
+
+_cache = OrderedDict()  # (doc_id, budget, sections) -> (expires_at, [[ids in priority order] per section])
+_cache_lock = threading.Lock()
+
+
+def invalidate_selection(doc_id: str):
+    """Forget cached selections for a document (call on reindex/delete)."""
+    with _cache_lock:
+        for key in [k for k in _cache if k[0] == doc_id]:
+            del _cache[key]
+
+
+def _kmeans_representatives(vectors, k: int) -> list:
+    """Row indices of one representative per cluster, largest clusters first."""
+    np = import_timed("numpy")
+    X = np.asarray(vectors, dtype=np.float32)
+    X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-9)
+    n = X.shape[0]
+    rng = np.random.default_rng(0)
+
+    # k-means++ seeding: spread the initial centres over the document.
+    centres = [X[rng.integers(n)]]
+    dist = 1.0 - X @ centres[0]
+    for _ in range(1, k):
+        weights = np.clip(dist, 0, None).astype(np.float64)
+        total = weights.sum()
+        idx = rng.choice(n, p=weights / total) if total > 0 else rng.integers(n)
+        centres.append(X[idx])
+        dist = np.minimum(dist, 1.0 - X @ X[idx])
+    C = np.stack(centres)
+
+    labels = np.zeros(n, dtype=np.int64)
+    for _ in range(KMEANS_ITERATIONS):
+        labels = np.argmax(X @ C.T, axis=1)
+        for j in range(k):
+            members = X[labels == j]
+            if len(members):
+                c = members.mean(axis=0)
+                C[j] = c / max(float(np.linalg.norm(c)), 1e-9)
+
+    sims = X @ C.T
+    reps = []
+    for j in range(k):
+        members = np.flatnonzero(labels == j)
+        if len(members):
+            best = members[np.argmax(sims[members, j])]
+            reps.append((len(members), int(best)))
+    reps.sort(key=lambda t: (-t[0], t[1]))
+    return [idx for _, idx in reps]
+
+
+def _spread(n: int, k: int) -> list:
+    """k positions spread evenly over n rows (fallback when embeddings are unusable)."""
+    if k >= n:
+        return list(range(n))
+    step = n / k
+    return [int(i * step + step / 2) for i in range(k)]
+
+
+def _select_rows(ids: list, vectors, k: int) -> list:
+    """Up to k of ids, most representative first (k-means, or an even spread as fallback)."""
+    if len(ids) <= k:
+        return list(ids)
+    try:
+        if vectors is None:
+            raise ValueError("no embeddings")
+        return [ids[i] for i in _kmeans_representatives(vectors, k)]
+    except Exception as e:
+        print("[Context] k-means selection failed, spreading evenly:", e)
+        return [ids[i] for i in _spread(len(ids), k)]
+
+
+def select_section_chunk_ids(collection, doc_id: str, budget_tokens: int, sections: int = 1) -> list:
+    """Split doc_id into up to `sections` contiguous runs of chunks (reading order) and pick
+    representative chunk ids within budget_tokens for each. Returns one id list per non-empty
+    section, most representative first."""
+    sections = max(1, sections)
+    key = (doc_id, budget_tokens, sections)
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and hit[0] > now:
+            _cache.move_to_end(key)
+            return [list(ids) for ids in hit[1]]
+
+    res = collection.get(where={"doc_id": doc_id}, include=["embeddings", "metadatas"]) or {}
+    ids = list(res.get("ids") or [])
+    metas = list(res.get("metadatas") or [{}] * len(ids))
+    if not ids:
+        return []
+    # Order rows by position in the document so sections, fallbacks and ties follow reading order.
+    order = sorted(range(len(ids)), key=lambda i: ((metas[i] or {}).get("chunk", i), i))
+    ids = [ids[i] for i in order]
+    embeddings = res.get("embeddings")
+    vectors = [embeddings[i] for i in order] if embeddings is not None and len(embeddings) == len(order) else None
+
+    # A few extra picks so packing can skip chunks that turn out longer than average.
+    k = max(1, budget_tokens // EST_CHUNK_TOKENS + 2)
+    sections = min(sections, len(ids))
+    bounds = [round(i * len(ids) / sections) for i in range(sections + 1)]
+    chosen = [
+        _select_rows(ids[lo:hi], vectors[lo:hi] if vectors is not None else None, k)
+        for lo, hi in zip(bounds, bounds[1:])
+    ]
+
+    with _cache_lock:
+        _cache[key] = (now + SELECTION_CACHE_TTL_SEC, [list(c) for c in chosen])
+        _cache.move_to_end(key)
+        while len(_cache) > SELECTION_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return chosen
+
+
+def select_chunk_ids(collection, doc_id: str, budget_tokens: int) -> list:
+    """Chunk ids to use as context for doc_id, most representative first."""
+    chosen = select_section_chunk_ids(collection, doc_id, budget_tokens, 1)
+    return chosen[0] if chosen else []
+
+
+def _pack(chosen: list, by_id: dict, budget_tokens: int) -> list:
+    """(position, text) of chosen chunks that fit budget_tokens, in document order."""
+    rows = [by_id[cid] for cid in chosen if cid in by_id]
+    picked = pack([text for text, _, _ in rows], budget_tokens, [tokens for _, _, tokens in rows])
+    return sorted((rows[i][1], text) for i, text in picked)
+
+
+def section_chunks(collection, doc_id: str, budget_tokens: int, sections: int = 1) -> list:
+    """Per section of doc_id (see select_section_chunk_ids), the (chunk position, text) pairs
+    that fit budget_tokens, in document order. The chosen chunks of all sections are fetched in
+    a single get; empty sections are left out."""
+    chosen = select_section_chunk_ids(collection, doc_id, budget_tokens, sections)
+    all_ids = [cid for ids in chosen for cid in ids]
+    if not all_ids:
+        return []
+    res = collection.get(ids=all_ids, include=["documents", "metadatas"]) or {}
+    by_id = {
+        # Token counts are stored at index time; chunks indexed before that are estimated.
+        cid: (doc or "", (meta or {}).get("chunk", 0), (meta or {}).get("tokens"))
+        for cid, doc, meta in zip(res.get("ids") or [], res.get("documents") or [], res.get("metadatas") or [])
+    }
+    packed = (_pack(ids, by_id, budget_tokens) for ids in chosen)
+    return [chunks for chunks in packed if any(text.strip() for _, text in chunks)]
+
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of a that b starts with (the repeated window), or 0."""
+    head = b[:MIN_OVERLAP_CHARS]
+    if len(head) < MIN_OVERLAP_CHARS:
+        return 0
+    window = a[-MAX_OVERLAP_CHARS:]
+    i = window.find(head)
+    while i != -1:
+        # The earliest match is the longest overlap.
+        if b.startswith(window[i:]):
+            return len(window) - i
+        i = window.find(head, i + 1)
+    return 0
+
+
+def _shift(position, delta: int):
+    """The chunk delta places away. Positions are chunk indices, or (doc_id, chunk index)
+    pairs when the chunks come from several documents."""
+    if isinstance(position, tuple):
+        return position[0], position[1] + delta
+    return position + delta
+
+
+def merge_spans(chunks: list) -> list:
+    """Merge (position, text) pairs with consecutive positions into contiguous spans, dropping
+    the overlap each chunk repeats from the one before it. Returns (first position, last
+    position, text) per span, ordered by the earliest input index of its chunks (document
+    order for sorted input, best rank first for ranked input)."""
+    by_pos, first_seen = {}, {}
+    for i, (position, text) in enumerate(chunks):
+        if position not in by_pos:
+            by_pos[position], first_seen[position] = text, i
+    spans = []  # [first position, last position, text, earliest input index]
+    for position in sorted(by_pos):
+        text = by_pos[position]
+        if spans and spans[-1][1] == _shift(position, -1):
+            span = spans[-1]
+            k = _overlap(by_pos[span[1]], text)
+            span[2] = span[2] + text[k:] if k else span[2] + "\n\n" + text
+            span[1], span[3] = position, min(span[3], first_seen[position])
+        else:
+            spans.append([position, position, text, first_seen[position]])
+    spans.sort(key=lambda span: span[3])
+    return [(span[0], span[1], span[2]) for span in spans]
+
+
+def neighbor_chunks(collection, doc_id, positions: list) -> list:
+    """(position, text, tokens) of the chunks just before and after each of positions, in that
+    order, leaving out positions already listed. With doc_id None, positions are
+    (doc_id, chunk) pairs. Fetched in one get."""
+    have, want = set(positions), []
+    for p in positions:
+        for q in (_shift(p, -1), _shift(p, 1)):
+            if (q[1] if isinstance(q, tuple) else q) >= 0 and q not in have:
+                have.add(q)
+                want.append(q)
+    if not want:
+        return []
+    ids = [f"{q[0]}_{q[1]}" if doc_id is None else f"{doc_id}_{q}" for q in want]
+    res = collection.get(ids=ids, include=["documents", "metadatas"]) or {}
+    by_pos = {}
+    for doc, meta in zip(res.get("documents") or [], res.get("metadatas") or []):
+        meta = meta or {}
+        key = (meta.get("doc_id"), meta.get("chunk")) if doc_id is None else meta.get("chunk")
+        by_pos[key] = (doc or "", meta.get("tokens"))
+    return [(q,) + by_pos[q] for q in want if q in by_pos]
+
+
+def assemble_context(hits: list, budget_tokens: int, neighbors: list = ()) -> list:
+    """Context spans for ranked retrieval hits. hits and neighbors are (position, text, tokens)
+    with hits in rank order; a neighbor is only added next to a chunk already taken, after all
+    hits, while the budget allows. A chunk costs only the tokens it adds beyond the overlap
+    with chunks already taken, and the last hit that does not fit is cut on a sentence
+    boundary. Returns merge_spans() of the chunks taken, best-ranked span first."""
+    taken, picked, used = {}, [], 0
+    for n, (position, text, tokens) in enumerate(list(hits) + list(neighbors)):
+        is_hit = n < len(hits)
+        before, after = _shift(position, -1), _shift(position, 1)
+        if position in taken or not text or not text.strip():
+            continue
+        if not is_hit and before not in taken and after not in taken:
+            continue
+        cost = (tokens or estimate_tokens(text)) + SEPARATOR_TOKENS
+        for a, b in ((taken.get(before), text), (text, taken.get(after))):
+            k = _overlap(a, b) if a and b else 0
+            if k:
+                cost -= estimate_tokens(b[:k]) + SEPARATOR_TOKENS
+        if used + cost <= budget_tokens:
+            taken[position] = text
+            picked.append((position, text))
+            used += cost
+        elif is_hit and budget_tokens - used - SEPARATOR_TOKENS >= MIN_PARTIAL_TOKENS:
+            part = trim_to_tokens(text, budget_tokens - used - SEPARATOR_TOKENS)
+            if part:
+                taken[position] = part
+                picked.append((position, part))
+                used += estimate_tokens(part) + SEPARATOR_TOKENS
+    return merge_spans(picked)
+
+
+def build_section_contexts(collection, doc_id: str, budget_tokens: int, sections: int = 1) -> list:
+    """One context string per section of doc_id, each within budget_tokens. Chosen chunks that
+    are neighbours in the document are merged without their repeated overlap."""
+    return [
+        "\n\n".join(text for _, _, text in merge_spans(chunks))
+        for chunks in section_chunks(collection, doc_id, budget_tokens, sections)
+    ]
+
+
+def build_context(collection, doc_id: str, budget_tokens: int) -> str:
+    """Representative chunks of doc_id within budget_tokens, joined in document order."""
+    contexts = build_section_contexts(collection, doc_id, budget_tokens, 1)
+    return contexts[0] if contexts else ""
+
+
+def split_text_sections(text: str, sections: int, budget_tokens: int) -> list:
+    """Unindexed fallback: cut text into up to `sections` contiguous parts on paragraph
+    boundaries, each trimmed to budget_tokens on a sentence boundary. Short texts stay in one
+    piece."""
+    text = (text or "").strip()
+    if not text:
+        return []
+    sections = max(1, min(sections, len(text) // MIN_SECTION_CHARS or 1))
+    if sections == 1:
+        return [trim_to_tokens(text, budget_tokens)]
+    target = len(text) / sections
+    parts, start = [], 0
+    for i in range(1, sections):
+        cut = text.rfind("\n\n", start, int(i * target))
+        cut = cut if cut > start else int(i * target)
+        parts.append(text[start:cut])
+        start = cut
+    parts.append(text[start:])
+    return [trim_to_tokens(p, budget_tokens) for p in parts if p.strip()]
@@ -0,0 +1,120 @@
+import functools
+import os
+import time
+
+from flask import g, has_app_context
+
+# ====== END-TO-END REQUEST DEADLINES ======
+# A Deadline is created per request in main.before_request and read back by every stage
+# (Node fetch, extraction, embedding, vector query, LLM) so each stage only gets the budget
+# that is left. Background work (indexing threads) runs without one and keeps its defaults,
+# and so does indexing inside a request (see without_deadline): it replaces a document's
+# chunks, and stopping half way would leave a partial index that looks complete.
+
+DEADLINE_HEADER = "X-Request-Timeout"
+
+# Stay well under gunicorn's --timeout 120 so we answer 504 before the worker is killed.
+REQUEST_DEADLINE_SEC = float(os.environ.get("REQUEST_DEADLINE_SEC", "90"))
+REQUEST_DEADLINE_MAX_SEC = float(os.environ.get("REQUEST_DEADLINE_MAX_SEC", "110"))
+
+# Per-endpoint budgets keyed by Flask endpoint name. Override with
+# REQUEST_DEADLINES="ask_doc=45,quiz.generate_quiz=80".
+ENDPOINT_DEADLINES = {
+    "ask_doc": 60.0,
+    "ask_batch": 110.0,
+    "quiz.generate_quiz": 90.0,
+    "quiz.generate_quiz_stream": 90.0,
+    "flashcard.generate_flashcards": 100.0,
+    "flashcard.generate_flashcards_stream": 100.0,
+    "summarize.summarize_endpoint": 90.0,
+    "index_from_atlas": 110.0,
+    "set_consent": 110.0,
+    "replace_text_index": 110.0,
+    "preview_word_as_pdf": 90.0,
+}
+# Endpoints that index a document; clients may not shorten their budget with the header.
+INDEXING_ENDPOINTS = {"index_from_atlas", "set_consent", "replace_text_index"}
+for _item in os.environ.get("REQUEST_DEADLINES", "").split(","):
+    if "=" in _item:
+        _name, _val = _item.split("=", 1)
+        try:
+            ENDPOINT_DEADLINES[_name.strip()] = float(_val)
+        except ValueError:
+            print("[Deadline] Ignoring invalid REQUEST_DEADLINES entry:", _item)
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of budget; `stage` names the step that could not finish."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Request deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    def __init__(self, budget_sec: float):
+        self.budget_sec = budget_sec
+        self.expires_at = time.monotonic() + budget_sec
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str):
+        if self.expired():
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, stage: str, cap: float = None) -> float:
+        """Remaining budget for a stage, capped at the stage's own default timeout."""
+        self.check(stage)
+        left = self.remaining()
+        return min(cap, left) if cap else left
+
+
+def start_request_deadline(endpoint: str, header_value: str = None) -> Deadline:
+    budget = ENDPOINT_DEADLINES.get(endpoint or "", REQUEST_DEADLINE_SEC)
+    if header_value and endpoint not in INDEXING_ENDPOINTS:
+        try:
+            budget = float(header_value)
+        except ValueError:
+            pass
+    budget = max(1.0, min(budget, REQUEST_DEADLINE_MAX_SEC))
+    deadline = Deadline(budget)
+    g.deadline = deadline
+    return deadline
+
+
+def current_deadline():
+    if not has_app_context():
+        return None
+    return g.get("deadline")
+
+
+def check_deadline(stage: str):
+    d = current_deadline()
+    if d is not None:
+        d.check(stage)
+
+
+def stage_timeout(stage: str, default: float) -> float:
+    """Timeout for a stage: the stage default, shortened to the request's remaining budget."""
+    d = current_deadline()
+    if d is None:
+        return default
+    return d.timeout(stage, default)
+
+
+def without_deadline(fn):
+    """Run fn with the request deadline lifted, for work that must not stop half way."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not has_app_context() or g.get("deadline") is None:
+            return fn(*args, **kwargs)
+        saved = g.pop("deadline")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            g.deadline = saved
+    return wrapper
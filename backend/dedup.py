@@ -0,0 +1,130 @@
+import hashlib
+import math
+import os
+import re
+
+from deadline import DeadlineExceeded
+from llm_client import embed_content
+from metrics import DEDUP_DROPPED
+
+# ====== NEAR-DUPLICATE SUPPRESSION ======
+# Generated flashcard fronts and quiz questions are deduplicated after generation instead of
+# listing earlier items in the prompt. Two passes:
+#   1. MinHash over word unigrams+bigrams: near-verbatim repeats (estimated Jaccard >=
+#      DEDUP_MINHASH_THRESHOLD) are dropped without an API call.
+#   2. The survivors (and the items already kept) are embedded in one batch call and an item
+#      whose cosine similarity to a kept one reaches DEDUP_COSINE_THRESHOLD is dropped, which
+#      catches paraphrases. If embedding is unavailable only the first pass applies.
+
+DEDUP_EMBEDDINGS = os.environ.get("DEDUP_EMBEDDINGS", "true").lower() == "true"
+DEDUP_COSINE_THRESHOLD = float(os.environ.get("DEDUP_COSINE_THRESHOLD", "0.9"))
+DEDUP_MINHASH_THRESHOLD = float(os.environ.get("DEDUP_MINHASH_THRESHOLD", "0.8"))
+MINHASH_PERMUTATIONS = 32
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(b"a%d" % i, digest_size=8).digest(), "little") % _PRIME | 1,
+     int.from_bytes(hashlib.blake2b(b"b%d" % i, digest_size=8).digest(), "little") % _PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+
+def _normalize(text: str) -> list:
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def _shingles(text: str) -> set:
+    words = _normalize(text)
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+def minhash(text: str) -> tuple:
+    """MinHash signature of the text's word unigrams and bigrams."""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+              for s in _shingles(text)]
+    if not hashes:
+        return (0,) * MINHASH_PERMUTATIONS
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def estimated_jaccard(sig_a: tuple, sig_b: tuple) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / MINHASH_PERMUTATIONS
+
+
+def _cosine(u, v) -> float:
+    dot = sum(a * b for a, b in zip(u, v))
+    norm = math.sqrt(sum(a * a for a in u)) * math.sqrt(sum(b * b for b in v))
+    return dot / norm if norm else 0.0
+
+
+class NearDuplicateFilter:
+    """The MinHash pass on its own, one item at a time (used while streaming, where the
+    batch embedding pass cannot wait for the whole set)."""
+
+    def __init__(self, existing: list = (), endpoint: str = ""):
+        self.endpoint = endpoint
+        self._keys = set()
+        self._sigs = []
+        for text in existing:
+            if text:
+                self._remember(" ".join(_normalize(text)), minhash(text))
+
+    def _remember(self, key: str, sig: tuple):
+        self._keys.add(key)
+        self._sigs.append(sig)
+
+    def admit(self, text: str) -> bool:
+        """True (and remembered) unless text nearly repeats an admitted item."""
+        key = " ".join(_normalize(text))
+        sig = minhash(text)
+        if key in self._keys or any(estimated_jaccard(sig, other) >= DEDUP_MINHASH_THRESHOLD for other in self._sigs):
+            DEDUP_DROPPED.inc(endpoint=self.endpoint, method="minhash")
+            return False
+        self._remember(key, sig)
+        return True
+
+
+def suppress_duplicates(texts: list, existing: list = (), endpoint: str = "") -> list:
+    """Indices of `texts` to keep, in order: each kept text is not a near-duplicate of an
+    earlier kept text or of any of `existing` (items already accepted)."""
+    return _suppress(texts, list(existing), [None] * len(existing), endpoint)[0]
+
+
+def suppress_duplicates_with_vectors(texts: list, existing: list, existing_vectors: list, endpoint: str = ""):
+    """suppress_duplicates for callers that store the embeddings of accepted items, so a growing
+    set is not re-embedded on every batch. existing_vectors[i] is the stored vector of existing[i]
+    (None when there is none; those are embedded in the same call). Returns (keep, vectors):
+    vectors maps each text embedded by this call (kept candidates and existing items that had
+    no vector) to its embedding, and is empty when the embedding pass was skipped."""
+    return _suppress(texts, list(existing), list(existing_vectors), endpoint)
+
+
+def _suppress(texts: list, existing: list, existing_vectors: list, endpoint: str):
+    pairs = [(t, v) for t, v in zip(existing, existing_vectors) if t]
+    prefilter = NearDuplicateFilter([t for t, _ in pairs], endpoint)
+    survivors = [i for i, text in enumerate(texts) if prefilter.admit(text)]
+
+    if not DEDUP_EMBEDDINGS or len(survivors) + len(pairs) < 2 or not survivors:
+        return survivors, {}
+    missing = [t for t, v in pairs if v is None]
+    try:
+        result = embed_content(missing + [texts[i] for i in survivors], task_type="semantic_similarity")
+        vectors = result.get("embedding") if isinstance(result, dict) else None
+        if not vectors or len(vectors) != len(missing) + len(survivors):
+            raise ValueError("unexpected embedding response")
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        print("[Dedup] Embedding pass skipped:", e)
+        return survivors, {}
+
+    embedded = dict(zip(missing, vectors[:len(missing)]))
+    kept_vectors = [v if v is not None else embedded[t] for t, v in pairs]
+    keep = []
+    for i, vec in zip(survivors, vectors[len(missing):]):
+        if any(_cosine(vec, other) >= DEDUP_COSINE_THRESHOLD for other in kept_vectors):
+            DEDUP_DROPPED.inc(endpoint=endpoint, method="embedding")
+            continue
+        kept_vectors.append(vec)
+        keep.append(i)
+        embedded[texts[i]] = vec
+    return keep, embedded
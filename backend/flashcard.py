@@ -1,5 +1,20 @@
 from flask import Blueprint, request, jsonify
+import json
+import math
+import os
+import queue
 import re as _re
+import threading
+from context_cache import cached_prompt
+from context_select import build_section_contexts, split_text_sections
+from deadline import DeadlineExceeded, check_deadline
+from dedup import NearDuplicateFilter, suppress_duplicates
+from llm_client import LLMUnavailable, generate_content, generate_content_stream, run_concurrently, submit_in_context
+from streaming import JsonArrayStream, error_event, event_stream_response
+from usage import BudgetExceeded
+from metrics import JSON_REPAIR
+from question_bank import sample_cards
+from token_budget import context_budget
 
 # Dependencies to be initialized from main.py
 collection = None
@@ -7,205 +22,415 @@ has_index = None
 fetch_doc_from_node = None
 extract_text_for_mimetype = None
 TEXT_MODEL = None
-genai = None
 
 
-def init_flashcards(_collection, _has_index, _fetch_doc_from_node, _extract_text_for_mimetype, _TEXT_MODEL, _genai):
-    global collection, has_index, fetch_doc_from_node, extract_text_for_mimetype, TEXT_MODEL, genai
+def init_flashcards(_collection, _has_index, _fetch_doc_from_node, _extract_text_for_mimetype, _TEXT_MODEL):
+    global collection, has_index, fetch_doc_from_node, extract_text_for_mimetype, TEXT_MODEL
     collection = _collection
     has_index = _has_index
     fetch_doc_from_node = _fetch_doc_from_node
     extract_text_for_mimetype = _extract_text_for_mimetype
     TEXT_MODEL = _TEXT_MODEL
-    genai = _genai
 
 
 flashcard_bp = Blueprint("flashcard", __name__)
 
+FLASHCARD_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "temperature": 0.4,
+    "max_output_tokens": 2048,
+}
 
-@flashcard_bp.route("/api/document/generate-flashcards", methods=["POST"])
-def generate_flashcards():
-    """Generate flashcards based on the uploaded document content.
-    Request JSON:
-      - doc_id: string (required)
-      - num_cards: int (default 20)
-    Response JSON: { success, flashcards: [ {front, back, category, difficulty}... ] } or { success: false, error }
-    """
+# Cards are generated in shards of at most FLASHCARD_SHARD_SIZE, each over its own section of
+# the document, all in flight at once: 50 cards take about one model round trip.
+FLASHCARD_SHARD_SIZE = int(os.environ.get("FLASHCARD_SHARD_SIZE", "15"))
+# Shards ask for this share more than their quota to make up for cards dropped as duplicates.
+FLASHCARD_OVERSHOOT = 0.2
+
+
+def merge_shards(shards: list, limit: int, existing: list = ()) -> list:
+    """Drop near-duplicate cards across shards (and against `existing`, which is kept as is,
+    first) and return up to `limit` cards, taking from the shards in turn so every section is
+    represented; new cards keep shard (document) order."""
+    flat = [(i, c) for i, cards in enumerate(shards) for c in cards]
+    keep = suppress_duplicates([c["front"] for _, c in flat], [c["front"] for c in existing], "flashcards")
+    unique = [[] for _ in shards]
+    for j in keep:
+        i, c = flat[j]
+        unique[i].append(c)
+    limit -= len(existing)
+
+    quota = [0] * len(unique)
+    taken = 0
+    while taken < limit and any(quota[i] < len(u) for i, u in enumerate(unique)):
+        for i, u in enumerate(unique):
+            if taken < limit and quota[i] < len(u):
+                quota[i] += 1
+                taken += 1
+    return list(existing) + [c for i, u in enumerate(unique) for c in u[:quota[i]]]
+
+
+# Prompt template for sharded generation
+FLASHCARD_SYS_INSTR = (
+    "You are SmartDoc Flashcard Generator. Given the document context, generate concise study flashcards strictly about the content. "
+    "Return ONLY valid JSON with schema: {\n"
+    "  \"flashcards\": [\n"
+    "    {\n"
+    "      \"front\": string,  // term, concept, or question\n"
+    "      \"back\": string,   // clear answer or explanation\n"
+    "      \"category\": string,  // optional short section/topic name\n"
+    "      \"difficulty\": \"Easy|Medium|Hard\"\n"
+    "    }\n"
+    "  ]\n"
+    "}\n"
+    "Rules:\n"
+    "- Generate exactly the requested number of cards if possible; if not, generate as many as the context supports.\n"
+    "- Each card must be answerable from the context.\n"
+    "- Keep 'front' short (<= 140 chars) and 'back' focused (<= 400 chars).\n"
+    "- Prefer diverse categories and coverage across the document.\n"
+    "- Do not repeat a card with different wording.\n"
+)
+
+
+def _batch_prompt(doc_id: str, context: str, to_generate: int):
+    """(contents, cached_context) for one batch. Duplicates across shards are removed afterwards
+    (dedup.py), not listed in the prompt, so a section's prompt only differs in the count and
+    its document block can be served from the context cache."""
+    return cached_prompt(
+        doc_id,
+        FLASHCARD_SYS_INSTR,
+        "Document Context:\n" + context,
+        f"Number of flashcards to generate now: {to_generate}.",
+        TEXT_MODEL,
+    )
+
+
+def _parse_json_safely(s: str):
+    if not s:
+        return None
+    try:
+        return json.loads(s)
+    except Exception:
+        # Try fenced code blocks ```json ... ```
+        m = _re.search(r"```(?:json)?\s*([\s\S]*?)```", s, _re.IGNORECASE)
+        if m:
+            inner = m.group(1).strip()
+            try:
+                return json.loads(inner)
+            except Exception:
+                pass
+        # Try last {...}
+        m2 = _re.search(r"\{[\s\S]*\}", s)
+        if m2:
+            try:
+                return json.loads(m2.group(0))
+            except Exception:
+                pass
+        return None
+
+
+def _repair_json(raw: str):
+    """Second pass asking the model to strictly convert its own output to JSON."""
+    try:
+        conv_prompt = (
+            "Convert the following content to valid JSON that matches this schema: "
+            "{\n  \"flashcards\": [\n    {\n      \"front\": string,\n      \"back\": string,\n      \"category\": string,\n      \"difficulty\": \"Easy|Medium|Hard\"\n    }\n  ]\n}\n"
+            "Respond with JSON only, no extra text.\n\nContent to convert:\n" + (raw or "")
+        )
+        resp2 = generate_content(conv_prompt, TEXT_MODEL, FLASHCARD_GENERATION_CONFIG)
+        raw2 = (getattr(resp2, "text", "") or "").strip()
+        data = _parse_json_safely(raw2)
+        JSON_REPAIR.inc(endpoint="flashcards", outcome="ok" if data is not None else "unparseable")
+        return data
+    except (LLMUnavailable, DeadlineExceeded, BudgetExceeded):
+        JSON_REPAIR.inc(endpoint="flashcards", outcome="error")
+        raise
+    except Exception:
+        JSON_REPAIR.inc(endpoint="flashcards", outcome="error")
+        return None
+
+
+def sanitize_card(c):
+    """Validate and normalise one model-produced card; None if it is unusable."""
+    if not isinstance(c, dict):
+        return None
+    front = str(c.get("front", "")).strip()
+    back = str(c.get("back", "")).strip()
+    if not front or not back:
+        return None
+    if len(front) > 200:
+        front = front[:200].rstrip() + "…"
+    if len(back) > 600:
+        back = back[:600].rstrip() + "…"
+    category = str(c.get("category", "General")).strip() or "General"
+    diff = str(c.get("difficulty", "Medium")).strip().capitalize()
+    if diff not in ("Easy", "Medium", "Hard"):
+        diff = "Medium"
+    return {
+        "front": front,
+        "back": back,
+        "category": category,
+        "difficulty": diff,
+    }
+
+
+def _generate_batch(doc_id: str, context: str, to_generate: int) -> list:
+    """Ask model for a batch of flashcards over one section and return normalized list."""
+    contents, cached = _batch_prompt(doc_id, context, to_generate)
+    resp_local = generate_content(contents, TEXT_MODEL, FLASHCARD_GENERATION_CONFIG, cached_context=cached)
+    raw_local = (getattr(resp_local, "text", "") or "").strip()
+    data_local = _parse_json_safely(raw_local)
+    if data_local is None:
+        data_local = _repair_json(raw_local)
+
+    out = []
+    if isinstance(data_local, dict) and isinstance(data_local.get("flashcards"), list):
+        for c in data_local.get("flashcards", [])[: to_generate]:
+            card = sanitize_card(c)
+            if card is not None:
+                out.append(card)
+    return out
+
+
+def _stream_batch(doc_id: str, context: str, to_generate: int):
+    """Streaming _generate_batch: yields each sanitized card as soon as its object closes.
+    Falls back to parsing (and if needed repairing) the whole output when nothing streamed."""
+    parser = JsonArrayStream("flashcards")
+    produced = 0
+    contents, cached = _batch_prompt(doc_id, context, to_generate)
+    stream = generate_content_stream(contents, TEXT_MODEL, FLASHCARD_GENERATION_CONFIG, cached_context=cached)
+    for fragment in stream:
+        for c in parser.feed(fragment):
+            card = sanitize_card(c)
+            if card is not None and produced < to_generate:
+                produced += 1
+                yield card
+        if produced >= to_generate or parser.done:
+            stream.close()
+            break
+    if produced == 0:
+        data = _parse_json_safely(parser.text.strip())
+        if data is None:
+            data = _repair_json(parser.text)
+        for c in (data.get("flashcards") if isinstance(data, dict) else None) or []:
+            card = sanitize_card(c)
+            if card is not None and produced < to_generate:
+                produced += 1
+                yield card
+
+
+def _quotas(total: int, shards: int) -> list:
+    """Cards per shard: an even share of total plus the overshoot, capped at the shard size."""
+    base, extra = divmod(total, shards)
+    per = [base + (1 if i < extra else 0) for i in range(shards)]
+    return [min(FLASHCARD_SHARD_SIZE, n + math.ceil(n * FLASHCARD_OVERSHOOT)) if n else 0 for n in per]
+
+
+def _flashcard_params():
     body = request.get_json(silent=True) or {}
     doc_id = (body.get("doc_id") or body.get("documentId") or "").strip()
-    if not doc_id:
-        return jsonify({"success": False, "error": "doc_id is required"}), 400
     try:
         num_cards = int(body.get("num_cards", 20))
     except Exception:
         num_cards = 20
     # Clamp to reasonable bounds
     num_cards = max(3, min(num_cards, 50))
+    return doc_id, num_cards
+
 
-    # Build context from indexed chunks if available; else fetch raw text
-    context = ""
+def _from_bank():
+    """Cards sampled from the document's pre-generated bank, or None to generate live
+    (bank not built yet, too few cards, or `"fresh": true` in the body)."""
+    body = request.get_json(silent=True) or {}
+    doc_id, num_cards = _flashcard_params()
+    if not doc_id or body.get("fresh"):
+        return None
+    return sample_cards(doc_id, num_cards)
+
+
+def _prepare_flashcard_request():
+    """Validate the request body and load one section of the document per shard. Returns a
+    dict with doc_id, num_cards, num_shards and sections, or an error response to return as is."""
+    doc_id, num_cards = _flashcard_params()
+    if not doc_id:
+        return jsonify({"success": False, "error": "doc_id is required"}), 400
+
+    # One section of the document per shard: from indexed chunks if available, else raw text
+    num_shards = math.ceil(num_cards / FLASHCARD_SHARD_SIZE)
+    sections = []
     try:
         if has_index(doc_id):
-            res = collection.get(where={"doc_id": doc_id}, include=["documents"], limit=500)
-            docs = (res or {}).get("documents") or []
-            if docs and isinstance(docs[0], list):
-                docs = docs[0]
-            context = "\n\n".join(docs)
+            # Representative chunks of each contiguous section, each within the budget.
+            sections = build_section_contexts(collection, doc_id, context_budget("flashcard"), num_shards)
         else:
             ok, filename, mimetype, data_bytes = fetch_doc_from_node(doc_id)
             if not ok:
                 return jsonify({"success": False, "error": filename}), 404
-            context = extract_text_for_mimetype(filename, mimetype, data_bytes)
+            text = extract_text_for_mimetype(filename, mimetype, data_bytes)
+            sections = split_text_sections(text, num_shards, context_budget("flashcard"))
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"success": False, "error": f"Failed to load document: {e}"}), 500
 
-    context = (context or "").strip()
-    if not context:
+    sections = [c.strip() for c in sections if c and c.strip()]
+    if not sections:
         return jsonify({"success": False, "error": "Document has no readable text"}), 400
+    return {"doc_id": doc_id, "num_cards": num_cards, "num_shards": num_shards, "sections": sections}
 
-    # Prompt templates for iterative generation
-    sys_instr = (
-        "You are SmartDoc Flashcard Generator. Given the document context, generate concise study flashcards strictly about the content. "
-        "Return ONLY valid JSON with schema: {\n"
-        "  \"flashcards\": [\n"
-        "    {\n"
-        "      \"front\": string,  // term, concept, or question\n"
-        "      \"back\": string,   // clear answer or explanation\n"
-        "      \"category\": string,  // optional short section/topic name\n"
-        "      \"difficulty\": \"Easy|Medium|Hard\"\n"
-        "    }\n"
-        "  ]\n"
-        "}\n"
-        "Rules:\n"
-        "- Generate exactly the requested number of cards if possible; if not, generate as many as the context supports.\n"
-        "- Each card must be answerable from the context.\n"
-        "- Keep 'front' short (<= 140 chars) and 'back' focused (<= 400 chars).\n"
-        "- Prefer diverse categories and coverage across the document.\n"
-        "- Do not duplicate any previously generated cards provided to you.\n"
-    )
 
-    def _build_user_instr(to_generate: int, existing_fronts: list[str]) -> str:
-        # Provide existing fronts to help the model avoid duplicates (trim if long)
-        avoid_list = "\n".join(f"- {f[:120]}" for f in existing_fronts[:50])
-        avoid_block = ("Previously generated (avoid duplicates):\n" + avoid_list + "\n\n") if existing_fronts else ""
-        return (
-            f"Number of flashcards to generate now: {to_generate}.\n\n"
-            + avoid_block +
-            "Document Context:\n" + context[:12000]
-        )
+@flashcard_bp.route("/api/document/generate-flashcards", methods=["POST"])
+def generate_flashcards():
+    """Generate flashcards based on the uploaded document content.
+    Request JSON:
+      - doc_id: string (required)
+      - num_cards: int (default 20)
+      - fresh: bool (default false; skip the question bank)
+    Response JSON: { success, flashcards: [ {front, back, category, difficulty}... ], source: "bank"|"live" } or { success: false, error }
+    """
+    banked = _from_bank()
+    if banked is not None:
+        return jsonify({"success": True, "flashcards": banked, "source": "bank"})
+
+    prepared = _prepare_flashcard_request()
+    if not isinstance(prepared, dict):
+        return prepared
+    doc_id = prepared["doc_id"]
+    num_cards, num_shards, sections = prepared["num_cards"], prepared["num_shards"], prepared["sections"]
 
     try:
-        # Prefer structured JSON responses if supported by the SDK
-        model = None
-        try:
-            model = genai.GenerativeModel(
-                TEXT_MODEL,
-                generation_config={
-                    "response_mime_type": "application/json",
-                    "temperature": 0.4,
-                    "max_output_tokens": 2048,
-                },
-            )
-        except Exception:
-            model = genai.GenerativeModel(TEXT_MODEL)
-
-        import json
-
-        def _parse_json_safely(s: str):
-            if not s:
-                return None
-            try:
-                return json.loads(s)
-            except Exception:
-                # Try fenced code blocks ```json ... ```
-                m = _re.search(r"```(?:json)?\s*([\s\S]*?)```", s, _re.IGNORECASE)
-                if m:
-                    inner = m.group(1).strip()
-                    try:
-                        return json.loads(inner)
-                    except Exception:
-                        pass
-                # Try last {...}
-                m2 = _re.search(r"\{[\s\S]*\}", s)
-                if m2:
-                    try:
-                        return json.loads(m2.group(0))
-                    except Exception:
-                        pass
-                return None
-
-        def _generate_batch(to_generate: int, existing_fronts: list[str]):
-            """Ask model for a batch of flashcards and return normalized list."""
-            prompt = _build_user_instr(to_generate, existing_fronts)
-            resp_local = model.generate_content([sys_instr, prompt], request_options={"timeout": 30})
-            raw_local = (getattr(resp_local, "text", "") or "").strip()
-            data_local = _parse_json_safely(raw_local)
-            if data_local is None:
-                try:
-                    conv_prompt = (
-                        "Convert the following content to valid JSON that matches this schema: "
-                        "{\n  \"flashcards\": [\n    {\n      \"front\": string,\n      \"back\": string,\n      \"category\": string,\n      \"difficulty\": \"Easy|Medium|Hard\"\n    }\n  ]\n}\n"
-                        "Respond with JSON only, no extra text.\n\nContent to convert:\n" + (raw_local or "")
-                    )
-                    resp2 = model.generate_content(conv_prompt, request_options={"timeout": 20})
-                    raw2 = (getattr(resp2, "text", "") or "").strip()
-                    data_local = _parse_json_safely(raw2)
-                except Exception:
-                    data_local = None
-
-            out = []
-            if isinstance(data_local, dict) and isinstance(data_local.get("flashcards"), list):
-                for c in data_local.get("flashcards", [])[: to_generate]:
-                    if not isinstance(c, dict):
-                        continue
-                    front = str(c.get("front", "")).strip()
-                    back = str(c.get("back", "")).strip()
-                    if not front or not back:
-                        continue
-                    if len(front) > 200:
-                        front = front[:200].rstrip() + "…"
-                    if len(back) > 600:
-                        back = back[:600].rstrip() + "…"
-                    category = str(c.get("category", "General")).strip() or "General"
-                    diff = str(c.get("difficulty", "Medium")).strip().capitalize()
-                    if diff not in ("Easy", "Medium", "Hard"):
-                        diff = "Medium"
-                    out.append({
-                        "front": front,
-                        "back": back,
-                        "category": category,
-                        "difficulty": diff,
-                    })
-            return out
-
-        # Iteratively generate until we reach the requested number or exhaust attempts
-        final_cards = []
-        seen_pairs = set()
-        attempts = 3
-        remaining = num_cards
-
-        while remaining > 0 and attempts > 0:
-            attempts -= 1
-            existing_fronts = [c["front"] for c in final_cards]
-            batch = _generate_batch(min(remaining, 15), existing_fronts)
-            added_this_round = 0
-            for c in batch:
-                key = (c["front"], c["back"])
-                if key in seen_pairs:
-                    continue
-                final_cards.append(c)
-                seen_pairs.add(key)
-                added_this_round += 1
-                if len(final_cards) >= num_cards:
-                    break
-            remaining = num_cards - len(final_cards)
-            if added_this_round == 0:
-                # No progress; break to avoid looping
-                break
+        def _run_round(quotas: list) -> list:
+            """Generate every shard concurrently; shard i covers sections[i % len(sections)].
+            A failed shard yields no cards unless every shard failed."""
+            calls = [
+                (lambda i=i, n=n: _generate_batch(doc_id, sections[i % len(sections)], n))
+                for i, n in enumerate(quotas) if n > 0
+            ]
+            results = run_concurrently(calls, return_exceptions=True)
+            for r in results:
+                if isinstance(r, (DeadlineExceeded, BudgetExceeded)):
+                    raise r
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures and len(failures) == len(results):
+                raise failures[0]
+            for e in failures:
+                print("[Flashcards] Shard failed:", e)
+            return [r for r in results if not isinstance(r, Exception)]
+
+        # All shards at once, then merge with a deduplication pass
+        shards = _run_round(_quotas(num_cards, num_shards))
+        final_cards = merge_shards(shards, num_cards)
+
+        # Short after dedup (small document, repetitive sections): one top-up round; its cards
+        # are deduplicated against the ones already kept.
+        remaining = num_cards - len(final_cards)
+        if final_cards and remaining > 0:
+            top_up_shards = min(len(sections), math.ceil(remaining / FLASHCARD_SHARD_SIZE))
+            extra = _run_round(_quotas(remaining, top_up_shards))
+            final_cards = merge_shards(extra, num_cards, final_cards)
 
         if not final_cards:
             return jsonify({"success": False, "error": "Model did not return valid flashcards. Please try again."}), 502
 
-        return jsonify({"success": True, "flashcards": final_cards[: num_cards]})
+        return jsonify({"success": True, "flashcards": final_cards[: num_cards], "source": "live"})
+    except (DeadlineExceeded, BudgetExceeded):
+        raise
+    except LLMUnavailable as e:
+        return jsonify({"success": False, "error": f"Flashcard generation unavailable: {e}"}), 503
     except Exception as e:
         return jsonify({"success": False, "error": f"Flashcard generation failed: {e}"}), 500
+
+
+@flashcard_bp.route("/api/document/generate-flashcards/stream", methods=["POST"])
+def generate_flashcards_stream():
+    """Streaming variant of generate-flashcards (same request body). All shards stream at
+    once and each card is sent as soon as the model has finished writing it, one JSON event
+    per line (SSE when the client sends `Accept: text/event-stream`):
+      {"type": "card", "index": i, "card": {...}}
+      {"type": "done", "count": n}  or  {"type": "error", "status": code, "error": msg}
+    Request errors (missing doc_id, unknown document) are plain JSON responses as before.
+    Banked cards (see generate-flashcards) are all sent at once.
+    """
+    banked = _from_bank()
+    if banked is not None:
+        return event_stream_response(
+            [{"type": "card", "index": i, "card": c} for i, c in enumerate(banked)]
+            + [{"type": "done", "count": len(banked), "source": "bank"}]
+        )
+
+    prepared = _prepare_flashcard_request()
+    if not isinstance(prepared, dict):
+        return prepared
+    return event_stream_response(_flashcard_events(prepared))
+
+
+def _flashcard_events(prepared: dict):
+    doc_id, num_cards, sections = prepared["doc_id"], prepared["num_cards"], prepared["sections"]
+    quotas = _quotas(num_cards, prepared["num_shards"])
+    # Each shard sends its even share right away; overshoot cards wait in `spare` and only
+    # fill in for cards dropped as duplicates once every shard has finished.
+    base, extra = divmod(num_cards, len(quotas))
+    shares = [base + (1 if i < extra else 0) for i in range(len(quotas))]
+    events = queue.Queue()
+    stop = threading.Event()
+
+    def _shard(i: int, n: int):
+        batch = _stream_batch(doc_id, sections[i % len(sections)], n)
+        try:
+            for card in batch:
+                events.put((i, card, None))
+                if stop.is_set():
+                    # Enough cards were sent (or the client went away): stop reading the model.
+                    batch.close()
+                    break
+        except Exception as e:
+            events.put((i, None, e))
+        finally:
+            events.put((i, None, StopIteration))
+
+    # Only the MinHash pass while streaming; the batch embedding pass would hold every line back.
+    seen = NearDuplicateFilter(endpoint="flashcards")
+    sent, spare, errors = 0, [], []
+    per_shard = [0] * len(quotas)
+    running = sum(1 for n in quotas if n > 0)
+    try:
+        for i, n in enumerate(quotas):
+            if n > 0:
+                submit_in_context(lambda i=i, n=n: _shard(i, n))
+        while running and sent < num_cards:
+            check_deadline("llm_generate")
+            try:
+                i, card, err = events.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if err is StopIteration:
+                running -= 1
+            elif err is not None:
+                if isinstance(err, (DeadlineExceeded, BudgetExceeded)):
+                    raise err
+                print("[Flashcards] Shard failed:", err)
+                errors.append(err)
+            elif per_shard[i] >= shares[i]:
+                spare.append(card)
+            elif seen.admit(card["front"]):
+                per_shard[i] += 1
+                yield {"type": "card", "index": sent, "card": card}
+                sent += 1
+
+        for card in spare:
+            if sent >= num_cards:
+                break
+            if seen.admit(card["front"]):
+                yield {"type": "card", "index": sent, "card": card}
+                sent += 1
+
+        if sent == 0:
+            if errors:
+                raise errors[0]
+            yield {"type": "error", "status": 502, "error": "Model did not return valid flashcards. Please try again."}
+        else:
+            yield {"type": "done", "count": sent}
+    except Exception as e:
+        yield error_event(e, "Flashcard generation")
+    finally:
+        stop.set()
@@ -0,0 +1,218 @@
+import importlib.util
+import json
+import os
+import re
+import string
+
+# ====== PRE-LLM QUERY GUARD ======
+# Everything here is compiled once at import: one greeting pattern per length class,
+# the URL pattern, and a variant-aware trie over better_profanity's censor list.
+
+URL_REGEX = re.compile(r"(https?://[^\s]+|www\.[^\s]+|ftp://[^\s]+|mailto:[^\s]+|t\.me/[^\s]+|discord\.gg/[^\s]+)", re.IGNORECASE)
+
+GREET_WORDS = {
+    "hi", "hello", "hey", "yo", "hola", "namaste",
+    "good morning", "good afternoon", "good evening",
+    "gm", "ge", "gn"
+}
+SMALL_TALK = {"how are you", "what's up", "sup", "howdy"}
+WISHES = {"have a nice day", "good day", "good night"}
+
+
+def _alternation(words) -> re.Pattern:
+    alts = "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alts})\b")
+
+
+_GREET_PAT = _alternation(GREET_WORDS)
+_ANY_SMALLTALK_PAT = _alternation(GREET_WORDS | SMALL_TALK | WISHES)
+_WS = re.compile(r"\s+")
+
+
+def _norm(s: str) -> str:
+    return _WS.sub(" ", (s or "").strip().lower())
+
+
+def is_greeting_or_smalltalk(text: str) -> bool:
+    s = _norm(text)
+    if not s:
+        return False
+    # Short, non-question messages may be any small talk; otherwise only a greeting counts.
+    pat = _ANY_SMALLTALK_PAT if len(s) <= 40 and "?" not in s else _GREET_PAT
+    return pat.search(s) is not None
+
+
+# ---- Profanity matcher ----
+# Same results as better_profanity.contains_profanity: text is split into words of its allowed
+# characters, and a word (or a word joined with the next ones, with or without the separators
+# between them) is profane when it spells a listed word under CHARS_MAPPING, letter by letter.
+# The list is kept as one trie walked with those per-letter variants instead of one
+# VaryingString comparison per listed word.
+CHARS_MAPPING = {
+    "a": ("a", "@", "*", "4"),
+    "i": ("i", "*", "l", "1"),
+    "o": ("o", "*", "0", "@"),
+    "u": ("u", "*", "v"),
+    "v": ("v", "*", "u"),
+    "l": ("l", "1"),
+    "e": ("e", "*", "3"),
+    "s": ("s", "$", "5"),
+    "t": ("t", "7"),
+}
+# text character -> listed letters it may stand for
+_VARIANT_OF = {}
+for _letter, _variants in CHARS_MAPPING.items():
+    for _ch in _variants:
+        _VARIANT_OF.setdefault(_ch, set()).add(_letter)
+
+
+class VariantTrie:
+    """Trie of listed words matched under CHARS_MAPPING variants."""
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._end = [False]
+        for w in words:
+            if w:
+                self._add(w)
+
+    def _add(self, word: str):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._end.append(False)
+            node = nxt
+        self._end[node] = True
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def walk(self, nodes, text: str):
+        """Nodes reached from `nodes` after reading text; empty when nothing can match."""
+        goto = self._goto
+        for ch in text:
+            letters = _VARIANT_OF.get(ch)
+            if letters is None:
+                nodes = {goto[n][ch] for n in nodes if ch in goto[n]}
+            else:
+                if ch not in CHARS_MAPPING:
+                    letters = letters | {ch}
+                nodes = {goto[n][c] for n in nodes for c in letters if c in goto[n]}
+            if not nodes:
+                break
+        return nodes
+
+    def is_word(self, nodes) -> bool:
+        return any(self._end[n] for n in nodes)
+
+
+def _package_file(name: str):
+    # Locate better_profanity without importing it; its import builds a Profanity instance we never use.
+    try:
+        spec = importlib.util.find_spec("better_profanity")
+    except Exception:
+        spec = None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return os.path.join(list(spec.submodule_search_locations)[0], name)
+
+
+def _load_censor_words() -> list:
+    """Read better_profanity's bundled word list without building its variant sets."""
+    path = _package_file("profanity_wordlist.txt")
+    if path is None:
+        print("[Guard] better_profanity not available")
+        return []
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [ln.strip().lower() for ln in f if ln.strip()]
+    except Exception as e:
+        print("[Guard] Failed to read censor list", path, "=>", e)
+        return []
+
+
+def _load_allowed_characters() -> frozenset:
+    """better_profanity's word characters: ASCII letters and digits, @$*"' and unicode letters."""
+    allowed = set(string.ascii_letters) | set(string.digits) | set("@$*\"'")
+    path = _package_file("alphabetic_unicode.json")
+    if path is not None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                allowed.update(json.load(f))
+        except Exception as e:
+            print("[Guard] Failed to read", path, "=>", e)
+    return frozenset(allowed)
+
+
+_CENSOR_WORDS = set(_load_censor_words())
+ALLOWED_CHARACTERS = _load_allowed_characters()
+# A listed word with n separators may span n + 1 words of the text.
+_MAX_NEXT_WORDS = max([sum(ch not in ALLOWED_CHARACTERS for ch in w) for w in _CENSOR_WORDS] + [1])
+PROFANITY_MATCHER = VariantTrie(_CENSOR_WORDS)
+
+
+def _split_words(text: str) -> list:
+    """(start, separator before, word) for the runs of allowed characters in text."""
+    out, prev, word_start = [], 0, None
+    for i, ch in enumerate(text):
+        if ch in ALLOWED_CHARACTERS:
+            if word_start is None:
+                word_start = i
+        elif word_start is not None:
+            out.append((word_start, text[prev:word_start], text[word_start:i]))
+            prev, word_start = i, None
+    if word_start is not None:
+        out.append((word_start, text[prev:word_start], text[word_start:]))
+    return out
+
+
+def contains_profanity(text: str) -> bool:
+    if not isinstance(text, str):
+        text = str(text)
+    words = _split_words(text)
+    # better_profanity never looks at a word starting on the last character of the text.
+    cutoff = len(text) - 1
+    if not words or words[0][0] >= cutoff:
+        return False
+    matcher = PROFANITY_MATCHER
+    for i, (_, _, word) in enumerate(words):
+        joined = matcher.walk({0}, word.lower())
+        if matcher.is_word(joined):
+            return True
+        if i == len(words) - 1:
+            break
+        # Following words, joined directly and with the separators in between.
+        separated = joined
+        for start, sep, nxt in words[i + 1:i + 1 + _MAX_NEXT_WORDS]:
+            if start >= cutoff or not (joined or separated):
+                break
+            nxt = nxt.lower()
+            joined = matcher.walk(joined, nxt) if joined else joined
+            separated = matcher.walk(separated, sep.lower() + nxt) if separated else separated
+            if matcher.is_word(joined) or matcher.is_word(separated):
+                return True
+    return False
+
+
+# ---- Combined classification ----
+GUARD_OK = "ok"
+GUARD_GREETING = "greeting"
+GUARD_LINK = "link"
+GUARD_PROFANITY = "profanity"
+
+
+def classify_question(text: str) -> str:
+    """Classify a question before any retrieval/LLM work.
+    Checks run in the order ask_doc has always applied them: greeting, link, profanity.
+    """
+    if is_greeting_or_smalltalk(text):
+        return GUARD_GREETING
+    if URL_REGEX.search(text or ""):
+        return GUARD_LINK
+    if contains_profanity(text):
+        return GUARD_PROFANITY
+    return GUARD_OK
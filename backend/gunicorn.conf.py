@@ -0,0 +1,33 @@
+# Gunicorn settings for the Flask service. Usage: gunicorn main:app -c gunicorn.conf.py
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+timeout = 120
+
+_gevent = os.environ.get("SERVING_MODE", "threads").strip().lower() == "gevent"
+
+# Import the app once in the master so immutable data (guard word lists, compiled patterns,
+# config) is shared copy-on-write. Per-process resources are opened in post_fork below.
+# Off by default under gevent: the worker must monkey-patch before requests/ssl are imported.
+preload_app = os.environ.get("PRELOAD_APP", "false" if _gevent else "true").lower() == "true"
+
+if _gevent:
+    # Cooperative I/O: each in-flight Gemini/Node wait is a greenlet, not an OS thread.
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", "500"))
+else:
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+
+def when_ready(server):
+    # Move everything allocated during preload out of the GC's tracked generations so the
+    # collector does not touch (and un-share) those pages in every worker.
+    import gc
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from main import init_worker
+    init_worker()
@@ -0,0 +1,524 @@
+import concurrent.futures
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from admission import TokenBucket
+from deadline import check_deadline, stage_timeout
+from usage import apply_budget, record_embed, record_generate
+from metrics import (
+    EMBED_BATCH_SIZE, EMBED_FAILURES, EMBED_SECONDS, LLM_GENERATE_SECONDS,
+    REGISTRY, cache_lookup, current_endpoint, outcome_of, timed_stage,
+)
+
+# ====== SHARED GEMINI CLIENT ======
+# One place for model construction, deadlines, retries and fail-fast behaviour so the
+# endpoints stop building a GenerativeModel per request with their own timeouts.
+
+# Dependencies to be initialized from main.py
+genai = None
+TEXT_MODEL = None
+EMBED_MODEL = None
+_API_KEY = ""
+_TRANSPORT = None
+_configured_pid = None
+_configure_lock = threading.Lock()
+
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "30"))
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", "20"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "4"))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SEC = float(os.environ.get("LLM_BREAKER_RESET_SEC", "30"))
+
+# Hedging (opt-in): after HEDGE_DELAY_MS (or the observed p90 when unset) fire a duplicate
+# request and take whichever answers first. HEDGE_BUDGET_PCT caps hedges as a share of calls.
+HEDGE_ENABLED = os.environ.get("LLM_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_DELAY_MS = os.environ.get("LLM_HEDGE_DELAY_MS", "")
+HEDGE_MIN_DELAY_MS = float(os.environ.get("LLM_HEDGE_MIN_DELAY_MS", "300"))
+HEDGE_BUDGET_PCT = float(os.environ.get("LLM_HEDGE_BUDGET_PCT", "10"))
+HEDGE_MAX_WORKERS = int(os.environ.get("LLM_HEDGE_MAX_WORKERS", "16"))
+
+# Fan-out: independent generate calls of one request (e.g. flashcard shards) run side by side
+# on a per-process pool shared by all requests.
+FANOUT_MAX_WORKERS = int(os.environ.get("LLM_FANOUT_MAX_WORKERS", "16"))
+
+# Outbound rate limits (requests per minute, 0 = unlimited) shared by every endpoint in the
+# process. Set them just under the project's Gemini quota so bursts queue briefly here
+# instead of coming back as 429s from the provider.
+LLM_GENERATE_RPM = float(os.environ.get("LLM_GENERATE_RPM", "0"))
+LLM_EMBED_RPM = float(os.environ.get("LLM_EMBED_RPM", "0"))
+LLM_RATE_BURST = float(os.environ.get("LLM_RATE_BURST", "10"))
+
+# google.api_core exception class names worth retrying; matched by name so this module
+# does not need api_core importable to load.
+_TRANSIENT_ERRORS = {
+    "ServiceUnavailable", "DeadlineExceeded", "ResourceExhausted", "TooManyRequests",
+    "InternalServerError", "GatewayTimeout", "BadGateway", "Aborted", "RetryError",
+}
+# Errors meaning a referenced context cache is gone or unusable; the call is resent uncached.
+_CACHE_MISS_ERRORS = {"NotFound", "PermissionDenied", "InvalidArgument", "FailedPrecondition"}
+
+
+def init_llm_client(_genai, _TEXT_MODEL, _EMBED_MODEL, _api_key: str = "", _transport: str = None):
+    """Record configuration only; genai.configure() runs on first use in each process."""
+    global genai, TEXT_MODEL, EMBED_MODEL, _API_KEY, _TRANSPORT
+    genai = _genai
+    TEXT_MODEL = _TEXT_MODEL
+    EMBED_MODEL = _EMBED_MODEL
+    _API_KEY = _api_key
+    _TRANSPORT = _transport
+
+
+def _ensure_configured():
+    global _configured_pid
+    if _configured_pid == os.getpid():
+        return
+    with _configure_lock:
+        if _configured_pid != os.getpid():
+            if _API_KEY:
+                if _TRANSPORT:
+                    genai.configure(api_key=_API_KEY, transport=_TRANSPORT)
+                else:
+                    genai.configure(api_key=_API_KEY)
+            _configured_pid = os.getpid()
+
+
+def reset_after_fork():
+    """Drop state that must not be shared with a parent process (models, thread pools)."""
+    global _hedge_pool, _fanout_pool
+    if _configured_pid == os.getpid():
+        return
+    _models.clear()
+    _hedge_pool = None
+    _fanout_pool = None
+    _ensure_configured()
+
+
+class LLMUnavailable(Exception):
+    """Raised when the provider is failing fast (breaker open) or retries are exhausted."""
+
+
+def is_transient_error(e: Exception) -> bool:
+    return type(e).__name__ in _TRANSIENT_ERRORS or isinstance(e, (TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open after N transient failures,
+    half-open after a cool-down (one trial call), closed again on success."""
+
+    def __init__(self, name: str, threshold: int = BREAKER_FAILURE_THRESHOLD, reset_sec: float = BREAKER_RESET_SEC):
+        self.name = name
+        self.threshold = threshold
+        self.reset_sec = reset_sec
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._failures < self.threshold:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_sec:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_sec or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            self._trial_owner = threading.get_ident()
+            return True
+
+    def release_trial(self):
+        """Give back a trial this thread was granted but never sent (rate limit, deadline), so
+        the next call can try instead of the breaker staying open."""
+        with self._lock:
+            if self._trial_in_flight and self._trial_owner == threading.get_ident():
+                self._trial_in_flight = False
+                self._trial_owner = None
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self._trial_owner = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            self._trial_owner = None
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+                print(f"[LLM] Circuit '{self.name}' open for {self.reset_sec}s after {self._failures} failures")
+
+
+generate_breaker = CircuitBreaker("generate")
+embed_breaker = CircuitBreaker("embed")
+
+rate_limiters = {
+    "generate": TokenBucket(LLM_GENERATE_RPM / 60.0, LLM_RATE_BURST),
+    "embed": TokenBucket(LLM_EMBED_RPM / 60.0, LLM_RATE_BURST),
+}
+
+
+# ---- Model cache ----
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(model_name: str = None, generation_config: dict = None):
+    """Return a cached GenerativeModel for (model, generation_config)."""
+    _ensure_configured()
+    name = model_name or TEXT_MODEL
+    key = (name, json.dumps(generation_config, sort_keys=True) if generation_config else None)
+    model = _models.get(key)
+    cache_lookup("model", model is not None)
+    if model is not None:
+        return model
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            try:
+                model = genai.GenerativeModel(name, generation_config=generation_config) if generation_config else genai.GenerativeModel(name)
+            except Exception:
+                # Older SDKs reject some generation_config keys (e.g. response_mime_type)
+                model = genai.GenerativeModel(name)
+            _models[key] = model
+    return model
+
+
+# ---- Hedged requests ----
+class _Hedger:
+    """Per-operation latency window, hedge budget and win counters."""
+
+    WINDOW = 200
+    MIN_SAMPLES = 20
+
+    def __init__(self, name: str):
+        self.name = name
+        self._latencies = deque(maxlen=self.WINDOW)
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "hedged": 0, "hedge_won": 0, "skipped_budget": 0}
+
+    def record_latency(self, sec: float):
+        with self._lock:
+            self._latencies.append(sec)
+
+    def delay_sec(self) -> float:
+        if HEDGE_DELAY_MS:
+            return float(HEDGE_DELAY_MS) / 1000.0
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        p90 = samples[int(len(samples) * 0.9) - 1]
+        return max(HEDGE_MIN_DELAY_MS / 1000.0, p90)
+
+    def on_call(self):
+        with self._lock:
+            self.stats["calls"] += 1
+            # Each call earns a fraction of a hedge; the bucket never holds more than a few.
+            self._tokens = min(5.0, self._tokens + HEDGE_BUDGET_PCT / 100.0)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self.stats["hedged"] += 1
+                return True
+            self.stats["skipped_budget"] += 1
+            return False
+
+    def on_hedge_won(self):
+        with self._lock:
+            self.stats["hedge_won"] += 1
+
+
+_hedgers = {"generate": _Hedger("generate"), "embed": _Hedger("embed")}
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def _get_hedge_pool():
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_pool_lock:
+            if _hedge_pool is None:
+                _hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="llm-hedge")
+    return _hedge_pool
+
+
+_fanout_pool = None
+
+
+def _get_fanout_pool():
+    global _fanout_pool
+    if _fanout_pool is None:
+        with _hedge_pool_lock:
+            if _fanout_pool is None:
+                _fanout_pool = concurrent.futures.ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="llm-fanout")
+    return _fanout_pool
+
+
+def submit_in_context(fn) -> concurrent.futures.Future:
+    """Start fn() on the fan-out pool in a copy of the caller's context (see run_concurrently)."""
+    return _get_fanout_pool().submit(contextvars.copy_context().run, fn)
+
+
+def run_concurrently(fns, return_exceptions: bool = False) -> list:
+    """Call each fn() on the fan-out pool and return their results in order. Every call runs
+    in a copy of the caller's context, so Flask g (deadline, stage timings) and usage
+    attribution carry over. With return_exceptions, failures are returned in place of results;
+    otherwise the first failure (in order) is raised once all calls have finished."""
+    fns = list(fns)
+    if len(fns) <= 1:
+        if not fns:
+            return []
+        try:
+            return [fns[0]()]
+        except Exception as e:
+            if return_exceptions:
+                return [e]
+            raise
+    futures = [submit_in_context(fn) for fn in fns]
+    concurrent.futures.wait(futures)
+    results = []
+    for fut in futures:
+        if fut.exception() is not None:
+            if not return_exceptions:
+                raise fut.exception()
+            results.append(fut.exception())
+        else:
+            results.append(fut.result())
+    return results
+
+
+def hedge_stats() -> dict:
+    """Snapshot of hedging counters per operation (calls, hedged, hedge_won, skipped_budget)."""
+    return {name: dict(h.stats, delay_sec=h.delay_sec()) for name, h in _hedgers.items()}
+
+
+def _collect_metrics() -> list:
+    hedges = [
+        ({"op": name, "event": event}, value)
+        for name, h in _hedgers.items() for event, value in sorted(h.stats.items())
+    ]
+    breakers = [
+        ({"op": b.name, "state": state}, 1 if b.state == state else 0)
+        for b in (generate_breaker, embed_breaker) for state in ("closed", "half_open", "open")
+    ]
+    return [
+        ("smartdoc_llm_hedge_total", "counter", "Hedging events per operation.", hedges),
+        ("smartdoc_llm_breaker_state", "gauge", "Circuit breaker state (1 = current).", breakers),
+    ]
+
+
+REGISTRY.add_collector(_collect_metrics)
+
+
+def _timed(hedger: _Hedger, fn, attempt_timeout: float):
+    start = time.monotonic()
+    result = fn(attempt_timeout)
+    hedger.record_latency(time.monotonic() - start)
+    return result
+
+
+def _hedged_call(name: str, fn, attempt_timeout: float):
+    """Run fn once, or race it against a delayed duplicate when hedging is enabled."""
+    hedger = _hedgers[name]
+    if not HEDGE_ENABLED:
+        return _timed(hedger, fn, attempt_timeout)
+    hedger.on_call()
+    delay = hedger.delay_sec()
+    if delay is None or delay >= attempt_timeout:
+        return _timed(hedger, fn, attempt_timeout)
+
+    pool = _get_hedge_pool()
+    start = time.monotonic()
+    primary = pool.submit(_timed, hedger, fn, attempt_timeout)
+    done, _ = concurrent.futures.wait([primary], timeout=delay)
+    if done or not hedger.try_spend() or not rate_limiters[name].try_acquire():
+        return primary.result()
+
+    hedge = pool.submit(_timed, hedger, fn, max(1.0, attempt_timeout - delay))
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        remaining = attempt_timeout - (time.monotonic() - start)
+        done, pending = concurrent.futures.wait(pending, timeout=max(0.0, remaining), return_when=concurrent.futures.FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"{name} timed out after {attempt_timeout:.1f}s (hedged)")
+        for fut in done:
+            if fut.exception() is None:
+                if fut is hedge:
+                    hedger.on_hedge_won()
+                return fut.result()
+            first_error = first_error or fut.exception()
+    raise first_error
+
+
+def _call_with_retries(breaker: CircuitBreaker, timeout: float, fn, stage: str):
+    """Run fn(attempt_timeout) under one overall deadline with jittered exponential backoff.
+    The deadline is the shorter of `timeout` and what is left of the request's budget."""
+    timeout = stage_timeout(stage, timeout)
+    if not breaker.allow():
+        raise LLMUnavailable(f"Gemini {breaker.name} temporarily unavailable (circuit open)")
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if not rate_limiters[breaker.name].acquire(remaining - 1.0):
+                check_deadline(stage)
+                raise LLMUnavailable(f"Gemini {breaker.name} rate limit reached; try again shortly")
+            remaining = deadline - time.monotonic()
+            try:
+                result = _hedged_call(breaker.name, fn, max(1.0, remaining))
+                breaker.record_success()
+                return result
+            except Exception as e:
+                if not is_transient_error(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                check_deadline(stage)
+                delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+                attempt += 1
+                if attempt > LLM_MAX_RETRIES or time.monotonic() + delay + 1.0 >= deadline or not breaker.allow():
+                    raise LLMUnavailable(f"Gemini {breaker.name} failed: {e}") from e
+                print(f"[LLM] {breaker.name} transient error ({type(e).__name__}); retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+    finally:
+        # A half-open trial that ended before reaching the provider must not hold the breaker.
+        breaker.release_trial()
+
+
+def _resolve_cached(contents, model_name: str, generation_config: dict, cached_context):
+    """(model, contents) for a call: the model bound to cached_context when it is usable for
+    model_name, otherwise the plain model with the context's full prompt."""
+    if cached_context is None:
+        return get_model(model_name, generation_config), contents
+    if cached_context.model_name == model_name:
+        try:
+            return cached_context.model(generation_config), contents
+        except Exception as e:
+            cached_context.forget(e)
+    # Degraded to another model by a budget, or the cache is gone.
+    return get_model(model_name, generation_config), cached_context.fallback_contents
+
+
+def _call_resolved(call, model, contents, model_name: str, generation_config: dict, cached_context):
+    """call(model, contents); when it fails because the referenced cache is gone, forget the
+    cache and send the full prompt once."""
+    try:
+        return call(model, contents)
+    except Exception as e:
+        if cached_context is None or contents is cached_context.fallback_contents \
+                or type(e).__name__ not in _CACHE_MISS_ERRORS:
+            raise
+        cached_context.forget(e)
+        return call(get_model(model_name, generation_config), cached_context.fallback_contents)
+
+
+def generate_content(contents, model_name: str = None, generation_config: dict = None, timeout: float = None,
+                     cached_context=None, **kwargs):
+    """generate_content on a cached model with the shared deadline/retry/breaker policy.
+    With cached_context (see context_cache.cached_prompt) the call references the provider-side
+    context cache; if the cache turns out to be gone it is resent once with the full prompt."""
+    # Raises usage.BudgetExceeded, or swaps in cheaper settings, once a token budget is spent.
+    model_name, generation_config = apply_budget(model_name or TEXT_MODEL, generation_config)
+    model, contents = _resolve_cached(contents, model_name, generation_config, cached_context)
+    with timed_stage(LLM_GENERATE_SECONDS, endpoint=current_endpoint()):
+        call = lambda m, c: _call_with_retries(
+            generate_breaker,
+            timeout or LLM_TIMEOUT,
+            lambda t: m.generate_content(c, request_options={"timeout": t}, **kwargs),
+            "llm_generate",
+        )
+        resp = _call_resolved(call, model, contents, model_name, generation_config, cached_context)
+    record_generate(resp, model_name)
+    return resp
+
+
+def generate_content_stream(contents, model_name: str = None, generation_config: dict = None, timeout: float = None,
+                            cached_context=None, **kwargs):
+    """Streaming generate_content: yields text fragments as the model produces them.
+    Budget, rate limits, retries and the breaker cover opening the stream (the SDK waits for
+    the first chunk); a failure part-way through is raised to the caller as is. Closing the
+    generator early is timed with outcome "cancelled". cached_context works as in
+    generate_content."""
+    model_name, generation_config = apply_budget(model_name or TEXT_MODEL, generation_config)
+    model, contents = _resolve_cached(contents, model_name, generation_config, cached_context)
+    with timed_stage(LLM_GENERATE_SECONDS, endpoint=current_endpoint()):
+        call = lambda m, c: _call_with_retries(
+            generate_breaker,
+            timeout or LLM_TIMEOUT,
+            lambda t: m.generate_content(c, stream=True, request_options={"timeout": t}, **kwargs),
+            "llm_generate",
+        )
+        resp = _call_resolved(call, model, contents, model_name, generation_config, cached_context)
+        try:
+            for chunk in resp:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without text parts (e.g. the final one carrying only finish_reason).
+                    text = ""
+                if text:
+                    yield text
+        finally:
+            # Also when the caller stops early: charge what the stream reported so far.
+            record_generate(resp, model_name)
+
+
+def count_tokens(contents, model_name: str = None, timeout: float = None) -> int:
+    """The provider's token count for contents (count_tokens API, not billed)."""
+    model = get_model(model_name or TEXT_MODEL)
+    resp = _call_with_retries(
+        generate_breaker,
+        timeout or EMBED_TIMEOUT,
+        lambda t: model.count_tokens(contents, request_options={"timeout": t}),
+        "count_tokens",
+    )
+    return int(getattr(resp, "total_tokens", 0) or 0)
+
+
+def embed_content(content, task_type: str = "retrieval_document", model_name: str = None, timeout: float = None):
+    """embed_content with the shared policy. Returns the raw SDK result dict."""
+    _ensure_configured()
+    EMBED_BATCH_SIZE.observe(len(content) if isinstance(content, (list, tuple)) else 1)
+    start = time.perf_counter()
+    try:
+        result = _call_with_retries(
+            embed_breaker,
+            timeout or EMBED_TIMEOUT,
+            lambda t: genai.embed_content(
+                model=model_name or EMBED_MODEL,
+                content=content,
+                task_type=task_type,
+                request_options={"timeout": t},
+            ),
+            "embed",
+        )
+    except Exception as e:
+        EMBED_SECONDS.observe(time.perf_counter() - start, outcome=outcome_of(e))
+        # Retries wrap the last provider error; report the underlying reason (timeout, error).
+        EMBED_FAILURES.inc(reason=outcome_of(e.__cause__ or e))
+        raise
+    EMBED_SECONDS.observe(time.perf_counter() - start, outcome="ok")
+    record_embed(content, model_name or EMBED_MODEL)
+    return result
@@ -1,25 +1,44 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g
 from werkzeug.exceptions import HTTPException
 from flask_cors import CORS
-import os, io, PyPDF2
-from docx import Document as DocxDocument
-import google.generativeai as genai
+import os, io
 from quiz import quiz_bp, init_quiz
 from flashcard import flashcard_bp, init_flashcards
 from summarize import init_summarizer, summarize_bp
-import chromadb
+from sensitive import cached_scan
+from context_cache import invalidate_doc_caches
+from preview_store import ConverterUnavailable, is_word, preview_store
+from context_select import (
+    CONTEXT_NEIGHBOR_EXPANSION, EST_CHUNK_TOKENS, assemble_context, invalidate_selection, neighbor_chunks,
+)
+from question_bank import drop_bank, init_question_bank, rebuild_bank
+from token_budget import calibrate_estimator, context_budget, estimate_tokens, pack
+import llm_client
+from llm_client import LLMUnavailable, init_llm_client
+from admission import ADMISSION_MAX_WAIT_SEC, AdmissionRejected, pool_for_endpoint
+from deadline import (
+    DEADLINE_HEADER, DeadlineExceeded, check_deadline, start_request_deadline, stage_timeout, without_deadline,
+)
+from serving import genai_transport, run_cpu_bound
+from state_store import open_store, update_state
+from streaming import error_event, event_stream_response
+from metrics import (
+    CHROMA_SECONDS, CHUNKING_SECONDS, CHUNKS_PER_SECTION, CONTENT_TYPE, EXTRACT_SECONDS,
+    NODE_REQUEST_SECONDS, cache_lookup, outcome_of, render_metrics, request_stage, timed_stage,
+)
+import profiler
+from usage import BudgetExceeded, request_doc_id, usage_report, usage_scope
+from startup import WARMUP_ENABLED, LazyModule, import_timed, is_warm, mark_warm, start_warmup, startup_report
+from guard import URL_REGEX, GUARD_GREETING, GUARD_LINK, GUARD_PROFANITY, classify_question
 import requests
 import tempfile, os, importlib
-import hashlib
-from better_profanity import profanity
 import concurrent.futures
+import hmac
 import threading
-profanity.load_censor_words()
+import time
 import re
 
 
-pdf_cache = {}
-
 # ====== CONFIG ======
 app = Flask(__name__)
 
@@ -50,18 +69,25 @@ CORS(app, resources={r"/*": {"origins": _allow_processed}})
 
 app.config["MAX_CONTENT_LENGTH"] = 25 * 1024 * 1024
 
-URL_REGEX = re.compile(r"(https?://[^\s]+|www\.[^\s]+|ftp://[^\s]+|mailto:[^\s]+|t\.me/[^\s]+|discord\.gg/[^\s]+)", re.IGNORECASE)
-
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 NODE_BASE_URL = os.environ.get("NODE_BASE_URL", "http://localhost:5000")
 SERVICE_TOKEN = os.environ.get("SERVICE_TOKEN", "smartdoc-service-token")
+# Shared secret for /api/admin/* (X-Admin-Token header); defaults to the service token.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", SERVICE_TOKEN)
 NODE_FETCH_TIMEOUT = int(os.environ.get("NODE_FETCH_TIMEOUT", "45"))
 CHUNK_UPSERT_URL = os.environ.get("CHUNK_UPSERT_URL", f"{NODE_BASE_URL}/api/search/internal/chunks/upsert")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+# Largest doc_ids list accepted by one /api/document/ask request.
+ASK_MAX_DOCS = int(os.environ.get("ASK_MAX_DOCS", "50"))
+# /api/document/ask-batch: questions per request and answers generated at once.
+ASK_BATCH_MAX_QUESTIONS = int(os.environ.get("ASK_BATCH_MAX_QUESTIONS", "50"))
+ASK_BATCH_CONCURRENCY = int(os.environ.get("ASK_BATCH_CONCURRENCY", "4"))
 
 TEXT_MODEL = os.environ.get("TEXT_MODEL", "models/gemini-2.5-flash")  
 EMBED_MODEL = os.environ.get("EMBED_MODEL", "models/text-embedding-004")
+# google.generativeai is imported on first attribute access (or by the warm-up thread), and
+# genai.configure() runs lazily in each process (see llm_client), never before a fork.
+genai = LazyModule("google.generativeai")
+init_llm_client(genai, TEXT_MODEL, EMBED_MODEL, GEMINI_API_KEY, genai_transport())
 
 CHROMA_DB_PATH = os.environ.get("CHROMA_DB_PATH", os.path.join(os.getcwd(), "chroma_db"))
 
@@ -74,6 +100,7 @@ def _ensure_dir(p: str) -> str:
         return ""
 
 def _init_chroma_client():
+    chromadb = import_timed("chromadb")
     env_path = os.path.abspath(CHROMA_DB_PATH)
     if _ensure_dir(env_path):
         try:
@@ -97,8 +124,102 @@ def _init_chroma_client():
     except Exception as e:
         raise e
 
-chroma_client = _init_chroma_client()
-collection = chroma_client.get_or_create_collection("documents")
+# ====== PER-PROCESS RESOURCES ======
+# Everything above (config, compiled patterns, guard word lists) is immutable and is loaded
+# at import, so with gunicorn --preload it is shared copy-on-write by all workers. Chroma's
+# SQLite handles, HTTP connection pools and thread pools must not cross a fork; they are
+# opened per process, in gunicorn's post_fork hook (init_worker) or on first use.
+_process_lock = threading.Lock()
+_process_state = {"pid": None, "chroma_client": None, "collection": None, "http": None}
+
+def _process_resources() -> dict:
+    if _process_state["pid"] != os.getpid():
+        with _process_lock:
+            if _process_state["pid"] != os.getpid():
+                _process_state.update(pid=os.getpid(), chroma_client=None, collection=None, http=None)
+    return _process_state
+
+def get_collection():
+    st = _process_resources()
+    if st["collection"] is None:
+        with _process_lock:
+            if st["collection"] is None:
+                client = _init_chroma_client()
+                st["chroma_client"] = client
+                st["collection"] = client.get_or_create_collection("documents")
+                if not is_warm("chroma"):
+                    mark_warm("chroma")
+    return st["collection"]
+
+def http_session() -> requests.Session:
+    """Per-process pooled session for Node API calls."""
+    st = _process_resources()
+    if st["http"] is None:
+        with _process_lock:
+            if st["http"] is None:
+                st["http"] = requests.Session()
+    return st["http"]
+
+def node_request(op: str, method: str, url: str, **kwargs) -> requests.Response:
+    """http_session().request() timed in smartdoc_node_request_seconds{op, outcome}."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        r = http_session().request(method, url, **kwargs)
+        outcome = "ok" if r.status_code < 300 else f"http_{r.status_code // 100}xx"
+        return r
+    except Exception as e:
+        outcome = outcome_of(e)
+        raise
+    finally:
+        NODE_REQUEST_SECONDS.observe(time.perf_counter() - start, op=op, outcome=outcome)
+
+# Collection methods whose latency is recorded in smartdoc_chroma_seconds{op=...}.
+_TIMED_CHROMA_OPS = {"add", "upsert", "query", "get", "delete", "update"}
+
+class _LazyCollection:
+    """Stands in for the Chroma collection and opens it on first use in each process.
+    The data-path methods are timed for /metrics."""
+
+    def __getattr__(self, name):
+        attr = getattr(get_collection(), name)
+        if name not in _TIMED_CHROMA_OPS:
+            return attr
+
+        def timed(*args, **kwargs):
+            with timed_stage(CHROMA_SECONDS, op=name):
+                return attr(*args, **kwargs)
+        return timed
+
+collection = _LazyCollection()
+
+def _warm_genai():
+    llm_client.get_model()
+
+# Warm-up order: the cheap imports first so extraction is ready early, then Chroma (opens the
+# SQLite store) and Gemini (imports the SDK and configures it).
+WARMUP_STEPS = [
+    ("pdf", lambda: import_timed("PyPDF2")),
+    ("docx", lambda: import_timed("docx")),
+    ("chroma", get_collection),
+    ("genai", _warm_genai),
+]
+# /readyz answers 200 once these are warm; the rest load on first use if warm-up is off.
+READY_SUBSYSTEMS = ("chroma", "genai")
+
+def init_worker():
+    """Set up per-process resources. gunicorn calls this from post_fork; safe to call repeatedly.
+    Heavy imports and the Chroma open run on a background thread (WARMUP=true) so the worker
+    starts answering /healthz immediately; with WARMUP=false they happen on first use."""
+    llm_client.reset_after_fork()
+    http_session()
+    if WARMUP_ENABLED:
+        start_warmup(WARMUP_STEPS)
+
+def create_app():
+    """App factory for non-gunicorn servers and scripts: returns the app with warm-up started."""
+    init_worker()
+    return app
 
 def contains_link(text):
     return bool(URL_REGEX.search(text))
@@ -106,37 +227,13 @@ def contains_link(text):
 
 NOISE_DISTANCE_THRESHOLD = 0.6
 
-# ====== GREETING/SMALL-TALK DETECTION & TOPIC SUGGESTIONS ======
-GREET_WORDS = {
-    "hi", "hello", "hey", "yo", "hola", "namaste",
-    "good morning", "good afternoon", "good evening",
-    "gm", "ge", "gn"
-}
-SMALL_TALK = {"how are you", "what's up", "sup", "howdy"}
-WISHES = {"have a nice day", "good day", "good night"}
-
+# ====== TOPIC SUGGESTIONS ======
 GENERIC_TOPICS = [
     "Introduction", "Overview", "Summary", "Background", "Objectives",
     "Methodology", "Approach", "Results", "Discussion", "Conclusion",
     "Features", "Requirements", "Limitations", "Future Work"
 ]
 
-def _norm(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip().lower())
-
-def is_greeting_or_smalltalk(text: str) -> bool:
-    s = _norm(text)
-    if not s:
-        return False
-    if len(s) <= 40 and "?" not in s:
-        for kw in list(GREET_WORDS) + list(SMALL_TALK) + list(WISHES):
-            if s == kw or re.search(rf"(^|\b){re.escape(kw)}(\b|$)", s):
-                return True
-    for kw in GREET_WORDS:
-        if re.search(rf"(^|\b){re.escape(kw)}(\b|$)", s):
-            return True
-    return False
-
 def extract_headings_from_text(text: str, limit: int = 6) -> list:
     if not text:
         return []
@@ -180,45 +277,48 @@ def suggest_topics_for_doc(doc_id: str) -> list:
         return GENERIC_TOPICS[:6]
 
 # ====== SENSITIVE DATA DETECTION STATE & PATTERNS ======
-# In-memory consent state per document. Persist in DB/Redis in production.
-# { doc_id: { "sensitive": bool, "confirmed": bool, "awaiting": bool, "last_scan": str, "summary": dict } }
-consent_state = {}
-general_fallback = {}
-
-SENSITIVE_PATTERNS = {
-    "email": re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b"),
-    "phone": re.compile(r"\b(?:\+?\d{1,3}[\s-]?)?(?:\d{3}[\s-]?){2}\d{4}\b"),
-    "credit_card": re.compile(r"\b(?:\d[ -]?){13,19}\b"),
-    "pan": re.compile(r"\b[A-Z]{5}\d{4}[A-Z]\b"),
-    "aadhaar": re.compile(r"\b\d{4}[\s-]?\d{4}[\s-]?\d{4}\b"),
-    "ssn_like": re.compile(r"\b\d{3}-\d{2}-\d{4}\b"),
-}
+# Per-document conversational state lives in the shared state store so every worker sees it.
+# consent_state: { doc_id: { "sensitive": bool, "confirmed": bool, "awaiting": bool, "last_scan": str, "summary": dict } }
+# general_fallback: { doc_id: { "awaiting": bool, "pending_question": str } }
+CONSENT_STATE_TTL_SEC = float(os.environ.get("CONSENT_STATE_TTL_SEC", str(7 * 24 * 3600)))
+GENERAL_FALLBACK_TTL_SEC = float(os.environ.get("GENERAL_FALLBACK_TTL_SEC", "1800"))
+consent_state = open_store("consent", CONSENT_STATE_TTL_SEC)
+general_fallback = open_store("general_fallback", GENERAL_FALLBACK_TTL_SEC)
+
+def record_scan(doc_id: str, scan: dict, confirmed: bool = False) -> dict:
+    """Store a fresh scan result, keeping any consent already given. Returns the new state."""
+    def _apply(prev):
+        return {
+            "sensitive": bool(scan.get("found")),
+            "confirmed": bool(confirmed or prev.get("confirmed", False)),
+            "awaiting": False,
+            "last_scan": "ok",
+            "summary": scan,
+        }
+    return update_state(consent_state, doc_id, _apply)
 
+@request_stage("sensitive_scan")
 def detect_sensitive(text: str) -> dict:
-    summary = {"found": False, "matches": {}}
+    """Single-pass scan with Luhn/Verhoeff validation, cached per content hash (see sensitive.py)."""
     if not text:
-        return summary
-    any_found = False
-    for name, pattern in SENSITIVE_PATTERNS.items():
-        try:
-            hits = pattern.findall(text)
-            if hits:
-                any_found = True
-                summary["matches"][name] = len(hits)
-        except Exception:
-            continue
-    summary["found"] = any_found
-    print("[Sensitive Check] Summary:", {"found": summary["found"], "matches": summary["matches"]})
+        return {"found": False, "matches": {}}
+    summary, cache_hit = cached_scan(text)
+    cache_lookup("sensitive_scan", cache_hit)
+    print("[Sensitive Check] Summary:", {"found": summary["found"], "matches": summary["matches"], "cached": cache_hit})
     return summary
 
 # ====== HELPERS ======
 def extract_text_from_pdf_bytes(data: bytes) -> str:
     text = ""
     try:
+        PyPDF2 = import_timed("PyPDF2")
         reader = PyPDF2.PdfReader(io.BytesIO(data))
         for page in reader.pages:
+            check_deadline("extract")
             content = page.extract_text() or ""
             text += content + "\n"
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print("PDF extraction error:", e)
     return text
@@ -226,6 +326,7 @@ def extract_text_from_pdf_bytes(data: bytes) -> str:
 def extract_text_from_docx_bytes(data: bytes) -> str:
     text = ""
     try:
+        DocxDocument = import_timed("docx").Document
         with io.BytesIO(data) as f:
             doc = DocxDocument(f)
             for p in doc.paragraphs:
@@ -241,15 +342,26 @@ def extract_text_from_txt_bytes(data: bytes) -> str:
         print("TXT extraction error:", e)
         return ""
 
-def extract_text_for_mimetype(filename: str, mimetype: str, data: bytes) -> str:
+def _extraction_kind(filename: str, mimetype: str) -> str:
     ext = (filename.rsplit(".", 1)[-1].lower() if "." in filename else "")
     if mimetype == "application/pdf" or ext == "pdf":
-        return extract_text_from_pdf_bytes(data)
+        return "pdf"
     elif mimetype in ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "application/msword") or ext in ("docx", "doc"):
-        return extract_text_from_docx_bytes(data)
+        return "docx"
     elif mimetype == "text/plain" or ext == "txt":
-        return extract_text_from_txt_bytes(data)
-    return ""
+        return "txt"
+    return "other"
+
+def extract_text_for_mimetype(filename: str, mimetype: str, data: bytes) -> str:
+    kind = _extraction_kind(filename, mimetype)
+    with timed_stage(EXTRACT_SECONDS, kind=kind):
+        if kind == "pdf":
+            return run_cpu_bound(extract_text_from_pdf_bytes, data)
+        elif kind == "docx":
+            return run_cpu_bound(extract_text_from_docx_bytes, data)
+        elif kind == "txt":
+            return extract_text_from_txt_bytes(data)
+        return ""
 
 def chunk_text(text, size=1000, overlap=200):
     """Paragraph-aware chunking with overlap.
@@ -286,6 +398,14 @@ def chunk_text(text, size=1000, overlap=200):
         windows.append("\n\n".join(buf))
     return windows
 
+def chunk_section(text):
+    """chunk_text() with its time and chunk count recorded for /metrics."""
+    start = time.perf_counter()
+    chunks = chunk_text(text)
+    CHUNKING_SECONDS.observe(time.perf_counter() - start)
+    CHUNKS_PER_SECTION.observe(len(chunks))
+    return chunks
+
 def split_sheet_sections(text: str):
     """Split text into sections by lines that start with '# Sheet: <name>'.
     Returns list of tuples (sheet_name, content_str). If no markers found, returns [(None, text)].
@@ -310,22 +430,15 @@ def split_sheet_sections(text: str):
         return [(None, text or "")]
     return [(name, body) for (name, body) in sections if (body or "").strip()]
 
-def _embed_call(text: str):
-    return genai.embed_content(
-        model=EMBED_MODEL,
-        content=text,
-        task_type="retrieval_document"
-    )
-
 def generate_embeddings(text, timeout_sec: int = 20):
-    """Generate embeddings with a timeout to avoid hanging requests."""
+    """Generate embeddings through the shared client (deadline, retries, circuit breaker)."""
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-            fut = ex.submit(_embed_call, text)
-            result = fut.result(timeout=timeout_sec)
-            return result.get("embedding") if isinstance(result, dict) else None
-    except concurrent.futures.TimeoutError:
-        print("Embedding timeout after", timeout_sec, "seconds")
+        result = llm_client.embed_content(text, task_type="retrieval_document", timeout=timeout_sec)
+        return result.get("embedding") if isinstance(result, dict) else None
+    except DeadlineExceeded:
+        raise
+    except LLMUnavailable as e:
+        print("Embedding unavailable:", e)
         return None
     except Exception as e:
         print("Embedding error:", e)
@@ -333,11 +446,109 @@ def generate_embeddings(text, timeout_sec: int = 20):
 
 # ====== ENDPOINTS ======
 
+@app.before_request
+def _start_request_deadline():
+    start_request_deadline(request.endpoint, request.headers.get(DEADLINE_HEADER))
+
+@app.before_request
+def _begin_request_trace():
+    # Per-stage seconds for the slow-request log; sampling only when asked for or sampled.
+    g.stage_times = {}
+    forced = request.headers.get(profiler.PROFILE_HEADER) == "1" and _is_admin_request()
+    g.trace = profiler.begin_request(forced)
+
+@app.after_request
+def _finish_request_trace(response):
+    trace = g.pop("trace", None)
+    if trace is None:
+        return response
+    args = (trace, request.endpoint, request.method, request.path, response.status_code, g.get("stage_times"))
+    if response.is_streamed:
+        # The body (and the LLM calls behind it) is produced after this hook returns: finish
+        # once the server has sent it. Headers are gone by then, so no X-Profile-Id.
+        response.call_on_close(lambda: profiler.finish_request(*args))
+        return response
+    entry_id = profiler.finish_request(*args)
+    if entry_id and trace.reason:
+        response.headers["X-Profile-Id"] = entry_id
+    return response
+
+@app.before_request
+def _attribute_request():
+    # Lets token accounting charge Gemini calls to the document being worked on.
+    g.doc_id = request_doc_id()
+
+@app.before_request
+def _admit_request():
+    pool = pool_for_endpoint(request.endpoint)
+    if pool is None:
+        return None
+    max_wait = min(ADMISSION_MAX_WAIT_SEC, g.deadline.remaining())
+    with request_stage("admission_wait"):
+        g.admission = (pool, pool.acquire(max_wait))
+    return None
+
+@app.teardown_request
+def _release_admission(exc=None):
+    slot = g.pop("admission", None)
+    if slot:
+        pool, started_at = slot
+        pool.release(started_at)
+
 # ---- HEALTHCHECK ----
 @app.route("/healthz", methods=["GET"]) 
 def healthz():
     return jsonify({"status": "ok"})
 
+# ---- READINESS ----
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    report = startup_report()
+    # With WARMUP=false everything loads on first request, so there is nothing to wait for.
+    ready = not WARMUP_ENABLED or all(is_warm(name) for name in READY_SUBSYSTEMS)
+    report["status"] = "ready" if ready else "warming"
+    return jsonify(report), (200 if ready else 503)
+
+# ---- METRICS ----
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return app.response_class(render_metrics(), content_type=CONTENT_TYPE)
+
+# ---- ADMIN: GEMINI USAGE ----
+def _is_admin_request() -> bool:
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+@app.route("/api/admin/usage", methods=["GET"])
+def admin_usage():
+    if not _is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        top = int(request.args.get("top", "50"))
+    except ValueError:
+        top = 50
+    return jsonify(usage_report(top_docs=max(1, min(top, 1000))))
+
+# ---- ADMIN: PROFILES / SLOW REQUESTS ----
+@app.route("/api/admin/profiles", methods=["GET"])
+def admin_profiles():
+    if not _is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        limit = int(request.args.get("limit", "50"))
+    except ValueError:
+        limit = 50
+    return jsonify({"entries": profiler.recent_entries(max(1, min(limit, profiler.PROFILE_RING_SIZE)))})
+
+@app.route("/api/admin/profiles/<entry_id>.collapsed", methods=["GET"])
+def admin_profile_stacks(entry_id):
+    if not _is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    path = profiler.stacks_path(entry_id)
+    if not path:
+        return jsonify({"error": "Not found"}), 404
+    return send_file(path, mimetype="text/plain", as_attachment=True, download_name=f"{entry_id}.collapsed")
+
 # ---- ROOT ----
 @app.route("/", methods=["GET", "HEAD"]) 
 def root():
@@ -362,15 +573,8 @@ def index_from_atlas():
         # Pull persisted consent meta from Node
         meta = fetch_doc_meta_from_node(doc_id) or {}
         scan = detect_sensitive(text)
-        prev = consent_state.get(doc_id) or {}
-        consent_state[doc_id] = {
-            "sensitive": bool(scan.get("found")),
-            "confirmed": bool(meta.get("consentConfirmed") or prev.get("confirmed", False)),
-            "awaiting": False,
-            "last_scan": "ok",
-            "summary": scan,
-        }
-        if scan.get("found") and not (meta.get("consentConfirmed") or prev.get("confirmed", False)):
+        state = record_scan(doc_id, scan, confirmed=bool(meta.get("consentConfirmed")))
+        if scan.get("found") and not state["confirmed"]:
             return jsonify({
                 "message": "Sensitive data detected; indexing deferred until consent.",
                 "requireConfirmation": True,
@@ -382,6 +586,8 @@ def index_from_atlas():
         if not indexed:
             return jsonify({"error": "Unsupported or empty document"}), 400
         return jsonify({"message": f"Indexed {added} chunks", "doc_id": doc_id, "requireConfirmation": False})
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -425,7 +631,7 @@ def convert_word_to_pdf():
             temp_pdf = os.path.join(td, "converted.pdf")
             
 
-            docx2pdf.convert(in_path, temp_pdf)
+            run_cpu_bound(docx2pdf.convert, in_path, temp_pdf)
           
             with open(temp_pdf, 'rb') as f:
                 pdf_data = f.read()
@@ -445,58 +651,27 @@ def convert_word_to_pdf():
 @app.route("/api/document/preview/<doc_id>.pdf", methods=["GET"])
 def preview_word_as_pdf(doc_id):
     try:
-      
-        cache_key = f"pdf_preview_{doc_id}"
-        if cache_key in pdf_cache:
-            cached_path = pdf_cache[cache_key]
-            if os.path.exists(cached_path):
-                return send_file(cached_path, mimetype="application/pdf", as_attachment=False, download_name="preview.pdf")
-            else:
-            
-                del pdf_cache[cache_key]
-        
+        store = preview_store()
+        cached_path = store.lookup(doc_id)
+        if cached_path:
+            return send_file(cached_path, mimetype="application/pdf", as_attachment=False, download_name="preview.pdf")
+
         ok, filename, mimetype, data = fetch_doc_from_node(doc_id)
         if not ok:
             return jsonify({"error": filename}), 404
-  
-        ext = (filename.rsplit('.',1)[-1].lower() if '.' in filename else '')
-        if mimetype not in ("application/msword", "application/vnd.openxmlformats-officedocument.wordprocessingml.document") and ext not in ("doc", "docx"):
+        if not is_word(filename, mimetype):
             return jsonify({"error": "Not a Word document"}), 415
-        
-   
-        try:
-            docx2pdf = importlib.import_module("docx2pdf")
-        except Exception:
-            return jsonify({"error": "docx2pdf not installed on server"}), 501
-        
-     
-        cache_dir = os.path.join(os.getcwd(), "pdf_cache")
-        os.makedirs(cache_dir, exist_ok=True)
-        
-       
-        content_hash = hashlib.md5(data).hexdigest()[:8]
-        cached_pdf = os.path.join(cache_dir, f"{doc_id}_{content_hash}.pdf")
-      
-        if os.path.exists(cached_pdf):
-            pdf_cache[cache_key] = cached_pdf
-            return send_file(cached_pdf, mimetype="application/pdf", as_attachment=False, download_name="preview.pdf")
-        
-        with tempfile.TemporaryDirectory() as td:
-            in_path = os.path.join(td, filename)
-
-            if not in_path.lower().endswith((".docx", ".doc")):
-                in_path += ".docx"
-            with open(in_path, 'wb') as f:
-                f.write(data)
-            temp_pdf = os.path.join(td, "preview.pdf")
 
-            docx2pdf.convert(in_path, temp_pdf)
-            
-            import shutil
-            shutil.copy2(temp_pdf, cached_pdf)
-            pdf_cache[cache_key] = cached_pdf
-            
-            return send_file(cached_pdf, mimetype="application/pdf", as_attachment=False, download_name="preview.pdf")
+        try:
+            # Joins the background conversion started at index time, if it is still running.
+            path = store.ensure(doc_id, filename, data, timeout=stage_timeout("preview_convert", 80.0))
+        except ConverterUnavailable as e:
+            return jsonify({"error": str(e)}), 501
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceeded("preview_convert")
+        return send_file(path, mimetype="application/pdf", as_attachment=False, download_name="preview.pdf")
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -538,6 +713,10 @@ def delete_doc(doc_id):
     to_delete = [i for i in all_ids if i.startswith(doc_id)]
     if to_delete:
         collection.delete(ids=to_delete)
+    invalidate_selection(doc_id)
+    invalidate_doc_caches(doc_id)
+    drop_bank(doc_id)
+    preview_store().drop(doc_id)
     return jsonify({"message": "Deleted successfully"})
 
 # ---- ASK ----
@@ -554,21 +733,111 @@ def handle_exception(e):
     return jsonify({"error": str(e)}), 500
 
 
+@app.errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(e):
+    print("Deadline exceeded:", request.endpoint, "stage:", e.stage)
+    return jsonify({"error": "Request timed out. Please try again.", "stage": e.stage}), 504
+
+
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(e):
+    resp = jsonify({"error": "Server is busy. Please retry shortly.", "pool": e.pool, "retryAfter": e.retry_after})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+
+@app.errorhandler(BudgetExceeded)
+def handle_budget_exceeded(e):
+    resp = jsonify({"error": str(e), "budget": e.scope})
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp, 429
+
 @app.errorhandler(413)
 def handle_request_entity_too_large(e):
     return jsonify({"error": "File too large. Max 25 MB."}), 413
 
 # ---- ASK (Chat-ready) ----
+_ASK_STOPWORDS = {"the","a","an","and","or","of","in","on","to","for","is","are","was","were","be","with","by","at","from","as","that","this","it","its","if","then","than","into","about","over","under","within","between"}
+
+
+def _ask_keywords(s: str):
+    toks = re.split(r"[^A-Za-z0-9]+", (s or "").lower())
+    return {t for t in toks if len(t) >= 3 and t not in _ASK_STOPWORDS and not t.isdigit()}
+
+
+def _rank_hits(question: str, docs: list, dists: list, metas: list, by_doc: bool = False) -> list:
+    """Retrieved chunks worth answering from, best first, as (position, text, tokens).
+    Score: 70% vector similarity, 30% keyword overlap with the question; chunks at distance
+    0.9 or more are dropped. With by_doc, positions are (doc_id, chunk) pairs."""
+    q_terms = _ask_keywords(question)
+    candidates = []
+    for doc_txt, dist, meta in zip(docs, dists, metas):
+        if not doc_txt:
+            continue
+        overlap = len(q_terms & _ask_keywords(doc_txt))
+        if dist is None:
+            dist = 0.5
+
+        sim = 1.0 - max(0.0, min(1.0, dist))
+        score = 0.7 * sim + 0.3 * (overlap / (len(q_terms) or 1))
+        meta = meta or {}
+        position = (meta.get("doc_id"), meta.get("chunk")) if by_doc else meta.get("chunk")
+        candidates.append((score, dist, position, meta.get("tokens"), doc_txt))
+
+    candidates.sort(key=lambda x: x[0], reverse=True)
+    return [(c[2], c[-1], c[3]) for c in candidates if c[1] < 0.9]
+
+
+def _ask_prompt(context: str, question: str) -> str:
+    return f"""
+You are a document assistant. Use ONLY the context below to answer the question.
+Do NOT include anything that is not in the context.
+
+Please format your response clearly with:
+- Proper line breaks between paragraphs
+- Use bullet points or numbered lists when appropriate
+- Break up long text into readable paragraphs
+- Add spacing for better readability
+
+Context:
+{context}
+
+Question: {question}
+
+Answer strictly from the context with proper formatting:
+"""
+
+
+def _ask_n_results(budget: int) -> int:
+    # Enough candidates to fill the token budget after ranking and filtering.
+    return max(12, 2 * budget // EST_CHUNK_TOKENS)
+
+
 @app.route("/api/document/ask", methods=["POST"])
 def ask_doc():
     data = request.get_json(silent=True) or {}
     question = data.get("question", "").strip()
     doc_id = data.get("doc_id", "").strip()
+    # Several documents: "doc_ids": [...]. "scope": "all" must come with the caller's own
+    # doc_ids (Node resolves the catalog); the collection holds every user's documents.
+    scope = str(data.get("scope") or "").strip().lower()
+    doc_ids = data.get("doc_ids")
+    if doc_ids is not None and not isinstance(doc_ids, list):
+        return jsonify({"error": "doc_ids must be a list"}), 400
+    doc_ids = list(dict.fromkeys(str(d).strip() for d in (doc_ids or []) if str(d).strip()))
+    if len(doc_ids) > ASK_MAX_DOCS:
+        return jsonify({"error": f"At most {ASK_MAX_DOCS} documents per question"}), 400
+    if scope == "all" and not doc_ids:
+        return jsonify({"error": "scope \"all\" requires doc_ids: the documents in the caller's catalog"}), 400
+    if len(doc_ids) == 1 and not doc_id:
+        doc_id = doc_ids[0]
 
     if not question:
         return jsonify({"error": "Missing question"}), 400
 
-    if is_greeting_or_smalltalk(question):
+    verdict = classify_question(question)
+    if verdict == GUARD_GREETING:
         topics = suggest_topics_for_doc(doc_id) if doc_id else GENERIC_TOPICS[:6]
 
         bullet = "\n".join(f"- {t}" for t in topics)
@@ -579,11 +848,14 @@ def ask_doc():
         )
         return jsonify({"answer": msg, "requireConfirmation": False})
     
-    if URL_REGEX.search(question):
+    if verdict == GUARD_LINK:
         return jsonify({"answer": "⚠️ No links allowed. Please ask using text only."}), 422
-    if profanity.contains_profanity(question):
+    if verdict == GUARD_PROFANITY:
         return jsonify({"answer": "⚠️ Please avoid using offensive words."}), 422
-    
+
+    if len(doc_ids) > 1:
+        return _ask_documents(question, doc_ids)
+
     if not doc_id:
         return jsonify({"error": "Missing doc_id"}), 400
 
@@ -593,23 +865,19 @@ def ask_doc():
         if state.get("sensitive") and not state.get("confirmed"):
             q_lower = question.lower().strip()
             if q_lower in ("y", "yes"):
-                state["confirmed"] = True
-                state["awaiting"] = False
-                consent_state[doc_id] = state
+                update_state(consent_state, doc_id, lambda st: dict(st, confirmed=True, awaiting=False), default=state)
                 return jsonify({
                     "answer": "Proceeding. You can now ask questions about this document.",
                     "requireConfirmation": False
                 })
             if q_lower in ("n", "no"):
-                state["awaiting"] = False
-                consent_state[doc_id] = state
+                update_state(consent_state, doc_id, lambda st: dict(st, awaiting=False), default=state)
                 return jsonify({
                     "answer": "Chat cancelled. Please re-upload a cleaned version of the document without sensitive data.",
                     "requireConfirmation": False
                 })
 
-            state["awaiting"] = True
-            consent_state[doc_id] = state
+            update_state(consent_state, doc_id, lambda st: dict(st, awaiting=True), default=state)
             return jsonify({
                 "answer": "⚠️ Sensitive or private information detected in this document (e.g., personal IDs, contact info, or financial data).\nDo you still want to proceed with chatting about it? (y/n)",
                 "requireConfirmation": True,
@@ -621,10 +889,14 @@ def ask_doc():
         if gf.get("awaiting"):
             q_lower = question.lower().strip()
             if q_lower in ("y", "yes"):
-         
-                orig_q = gf.get("pending_question") or ""
-              
-                general_fallback[doc_id] = {"awaiting": False}
+                # Claim the pending question atomically so only one worker answers it.
+                claimed = {}
+                def _claim(cur):
+                    claimed.clear()
+                    claimed.update(cur)
+                    return {"awaiting": False}
+                update_state(general_fallback, doc_id, _claim)
+                orig_q = (claimed.get("pending_question") or "") if claimed.get("awaiting") else ""
 
                 if not orig_q:
                     return jsonify({
@@ -636,20 +908,23 @@ You are a helpful assistant. Provide a clear, accurate answer to the user's ques
 
 Question: {orig_q}
 """
-                model = genai.GenerativeModel(TEXT_MODEL)
                 try:
-                    response = model.generate_content(prompt)
+                    response = llm_client.generate_content(prompt)
                     if response and response.text:
                         return jsonify({"answer": format_response(response.text.strip())})
                     else:
                         return jsonify({"answer": "⚠️ Could not generate a general answer."})
+                except (DeadlineExceeded, BudgetExceeded):
+                    raise
+                except LLMUnavailable as e:
+                    print("General fallback unavailable:", e)
+                    return jsonify({"answer": "⚠️ The answer service is busy right now. Please try again shortly."}), 503
                 except Exception as e:
                     print("General fallback error:", e)
                     return jsonify({"answer": "⚠️ Error generating a general answer. Please try again."})
 
             if q_lower in ("n", "no"):
-      
-                general_fallback[doc_id] = {"awaiting": False}
+                general_fallback.set(doc_id, {"awaiting": False})
                 return jsonify({
                     "answer": "Okay, I won't answer that. Please ask a question based on the uploaded document.",
                 })
@@ -674,45 +949,34 @@ Question: {orig_q}
             return jsonify({"error": "Failed to generate embedding"}), 500
 
 
+        budget = context_budget("ask")
+        check_deadline("vector_query")
         results = collection.query(
             query_embeddings=[q_emb],
-            n_results=12,
+            n_results=_ask_n_results(budget),
             where={"doc_id": doc_id},
-            include=["documents", "distances"]
+            include=["documents", "distances", "metadatas"]
         )
+        check_deadline("vector_query")
 
         docs = results.get("documents", [[]])[0] or []
         dists = results.get("distances", [[]])[0] or []
-
-        def _keywords(s: str):
-            stop = {"the","a","an","and","or","of","in","on","to","for","is","are","was","were","be","with","by","at","from","as","that","this","it","its","if","then","than","into","about","over","under","within","between"}
-            toks = re.split(r"[^A-Za-z0-9]+", (s or "").lower())
-            return {t for t in toks if len(t) >= 3 and t not in stop and not t.isdigit()}
-
-        q_terms = _keywords(question)
-        candidates = []
-        for doc_txt, dist in zip(docs, dists):
-            if not doc_txt:
-                continue
-            terms = _keywords(doc_txt)
-            overlap = len(q_terms & terms)
-            if dist is None:
-                dist = 0.5
-
-            sim = 1.0 - max(0.0, min(1.0, dist))
-            score = 0.7 * sim + 0.3 * (overlap / (len(q_terms) or 1))
-            candidates.append((score, dist, overlap, doc_txt))
-
-
-        candidates.sort(key=lambda x: x[0], reverse=True)
-        topk = [c[-1] for c in candidates[:5] if c[1] is None or c[1] < 0.9]
+        metas = results.get("metadatas", [[]])[0] or [{}] * len(docs)
+
+        hits = _rank_hits(question, docs, dists, metas)
+        # Best-ranked chunks (and then their neighbours) until the token budget is full;
+        # adjacent chunks become one span without the repeated overlap.
+        neighbors = []
+        if hits and CONTEXT_NEIGHBOR_EXPANSION:
+            neighbors = neighbor_chunks(collection, doc_id, [h[0] for h in hits])
+        topk = [text for _, _, text in assemble_context(hits, budget, neighbors)]
         filtered = [doc for doc, dist in zip(docs, dists) if (dist is None) or (dist < 0.6)]
         if not topk and not filtered:
 
-            general_fallback[doc_id] = {
+            general_fallback.set(doc_id, {
                 "awaiting": True,
                 "pending_question": question,
-            }
+            })
             return jsonify({
                 "answer": (
                     "I couldn't find relevant information about your question in the uploaded document.\n"
@@ -720,36 +984,18 @@ Question: {orig_q}
                 )
             })
 
-        context = "\n\n".join(topk or filtered)
-
-        prompt = f"""
-You are a document assistant. Use ONLY the context below to answer the question.
-Do NOT include anything that is not in the context.
+        context = "\n\n".join(topk or [text for _, text in pack(filtered, budget)])
 
-Please format your response clearly with:
-- Proper line breaks between paragraphs
-- Use bullet points or numbered lists when appropriate
-- Break up long text into readable paragraphs
-- Add spacing for better readability
-
-Context:
-{context}
-
-Question: {question}
-
-Answer strictly from the context with proper formatting:
-"""
-        model = genai.GenerativeModel(TEXT_MODEL)
-        response = model.generate_content(prompt, request_options={"timeout": 30})
+        response = llm_client.generate_content(_ask_prompt(context, question))
 
         if response and response.text:
             raw_text = (response.text or "").strip()
 
             if is_out_of_doc_answer(raw_text):
-                general_fallback[doc_id] = {
+                general_fallback.set(doc_id, {
                     "awaiting": True,
                     "pending_question": question,
-                }
+                })
                 appended = (
                     raw_text
                     + "\n\nDo you want me to answer using general knowledge instead? Reply \"y\" for yes or \"n\" for no."
@@ -761,10 +1007,266 @@ Answer strictly from the context with proper formatting:
         else:
             return jsonify({"answer": "⚠️ Could not generate answer."})
 
+    except (DeadlineExceeded, BudgetExceeded):
+        raise
+    except LLMUnavailable as e:
+        print("Ask unavailable:", e)
+        return jsonify({"error": "The answer service is busy right now. Please try again shortly."}), 503
     except Exception as e:
         print("Ask error:", e)
         return jsonify({"error": str(e)}), 500
 
+def _ask_documents(question: str, doc_ids: list):
+    """ask_doc over several documents: one question embedding, one Chroma query filtered with
+    $in, and one generate call whose context labels each span with its source. Documents
+    awaiting consent or still indexing are left out of the filter and listed under "skipped"."""
+    skipped = []
+
+    def _blocked(d: str) -> bool:
+        state = consent_state.get(d) or {}
+        return bool(state.get("sensitive") and not state.get("confirmed"))
+
+    try:
+        searchable = []
+        for d in doc_ids:
+            if _blocked(d):
+                skipped.append({"doc_id": d, "reason": "consent_required"})
+            elif not has_index(d):
+                _start_background_indexing(d)
+                skipped.append({"doc_id": d, "reason": "indexing"})
+            else:
+                searchable.append(d)
+        if not searchable:
+            return jsonify({
+                "answer": "None of the selected documents can be searched yet. Please try again shortly.",
+                "sources": [], "skipped": skipped, "requireConfirmation": False,
+            })
+        # Never query the whole collection: it holds every user's documents.
+        where = {"doc_id": {"$in": searchable}} if len(searchable) > 1 else {"doc_id": searchable[0]}
+
+        q_emb = generate_embeddings(question)
+        if not q_emb:
+            return jsonify({"error": "Failed to generate embedding"}), 500
+
+        budget = context_budget("ask")
+        check_deadline("vector_query")
+        results = collection.query(
+            query_embeddings=[q_emb],
+            n_results=_ask_n_results(budget),
+            where=where,
+            include=["documents", "distances", "metadatas"]
+        )
+        check_deadline("vector_query")
+
+        docs = results.get("documents", [[]])[0] or []
+        dists = results.get("distances", [[]])[0] or []
+        metas = results.get("metadatas", [[]])[0] or [{}] * len(docs)
+        hits = _rank_hits(question, docs, dists, metas, by_doc=True)
+        neighbors = []
+        if hits and CONTEXT_NEIGHBOR_EXPANSION:
+            neighbors = neighbor_chunks(collection, None, [h[0] for h in hits])
+        spans = assemble_context(hits, budget, neighbors)
+        if not spans:
+            return jsonify({
+                "answer": "I couldn't find relevant information about your question in the selected documents.",
+                "sources": [], "skipped": skipped, "requireConfirmation": False,
+            })
+
+        filenames = {(m or {}).get("doc_id"): (m or {}).get("filename") for m in metas}
+        sources, blocks = [], []
+        for i, (first, last, text) in enumerate(spans, 1):
+            label = f"S{i}"
+            name = filenames.get(first[0]) or first[0]
+            sources.append({"id": label, "doc_id": first[0], "filename": name, "chunks": [first[1], last[1]]})
+            blocks.append(f"[{label}] {name}\n{text}")
+        context = "\n\n".join(blocks)
+
+        prompt = f"""
+You are a document assistant. Use ONLY the context below, taken from several documents, to answer the question.
+Do NOT include anything that is not in the context.
+Each passage starts with a source label like [S1]; cite the labels of the passages you use, e.g. "... [S2]".
+
+Please format your response clearly with:
+- Proper line breaks between paragraphs
+- Use bullet points or numbered lists when appropriate
+- Break up long text into readable paragraphs
+- Add spacing for better readability
+
+Context:
+{context}
+
+Question: {question}
+
+Answer strictly from the context with proper formatting:
+"""
+        response = llm_client.generate_content(prompt)
+        if not (response and response.text):
+            return jsonify({"answer": "⚠️ Could not generate answer.", "sources": sources, "skipped": skipped})
+        return jsonify({
+            "answer": format_response(response.text.strip()),
+            "sources": sources,
+            "skipped": skipped,
+            "requireConfirmation": False,
+        })
+
+    except (DeadlineExceeded, BudgetExceeded):
+        raise
+    except LLMUnavailable as e:
+        print("Ask unavailable:", e)
+        return jsonify({"error": "The answer service is busy right now. Please try again shortly."}), 503
+    except Exception as e:
+        print("Ask error:", e)
+        return jsonify({"error": str(e)}), 500
+
+# ---- ASK (BATCH) ----
+@app.route("/api/document/ask-batch", methods=["POST"])
+def ask_batch():
+    """Answer several questions about one document.
+    Request JSON: { doc_id, questions: [str, ...] } (at most ASK_BATCH_MAX_QUESTIONS)
+    All questions share one embedding call and one multi-vector Chroma query; the answers are
+    generated in parallel (ASK_BATCH_CONCURRENCY at a time) and streamed as NDJSON (SSE with
+    `Accept: text/event-stream`) in completion order:
+      {"type": "answer", "index", "question", "answer", "found"} or
+      {"type": "answer", "index", "question", "error", "status"} per question, then
+      {"type": "done", "count"}.
+    """
+    data = request.get_json(silent=True) or {}
+    doc_id = str(data.get("doc_id") or "").strip()
+    questions = data.get("questions")
+    if not doc_id:
+        return jsonify({"error": "Missing doc_id"}), 400
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"error": "questions must be a non-empty list"}), 400
+    if len(questions) > ASK_BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"At most {ASK_BATCH_MAX_QUESTIONS} questions per batch"}), 400
+    questions = [str(q or "").strip() for q in questions]
+
+    # The y/n consent and general-knowledge dialogues need /api/document/ask.
+    state = consent_state.get(doc_id) or {}
+    if state.get("sensitive") and not state.get("confirmed"):
+        return jsonify({
+            "error": "Sensitive or private information detected in this document. Confirm it in the chat first.",
+            "requireConfirmation": True,
+            "sensitiveSummary": state.get("summary", {}),
+        }), 409
+    if not has_index(doc_id):
+        _start_background_indexing(doc_id)
+        return jsonify({"error": "Indexing this document in the background. Please try again in ~30–60 seconds."}), 202
+
+    early, pending = {}, []
+    for i, question in enumerate(questions):
+        verdict = classify_question(question) if question else None
+        if not question:
+            early[i] = {"error": "Missing question", "status": 400}
+        elif verdict == GUARD_LINK:
+            early[i] = {"error": "⚠️ No links allowed. Please ask using text only.", "status": 422}
+        elif verdict == GUARD_PROFANITY:
+            early[i] = {"error": "⚠️ Please avoid using offensive words.", "status": 422}
+        elif verdict == GUARD_GREETING:
+            early[i] = {"error": "Please ask a question about the document.", "status": 422}
+        else:
+            pending.append(i)
+
+    contexts = {}
+    if pending:
+        budget = context_budget("ask")
+        try:
+            result = llm_client.embed_content([questions[i] for i in pending], task_type="retrieval_document")
+            vectors = result.get("embedding") if isinstance(result, dict) else None
+            if not vectors or len(vectors) != len(pending):
+                return jsonify({"error": "Failed to generate embeddings"}), 500
+            check_deadline("vector_query")
+            results = collection.query(
+                query_embeddings=vectors,
+                n_results=_ask_n_results(budget),
+                where={"doc_id": doc_id},
+                include=["documents", "distances", "metadatas"]
+            )
+            check_deadline("vector_query")
+            built = _batch_contexts(doc_id, [questions[i] for i in pending], results, budget)
+        except (DeadlineExceeded, BudgetExceeded):
+            raise
+        except LLMUnavailable as e:
+            print("Ask batch unavailable:", e)
+            return jsonify({"error": "The answer service is busy right now. Please try again shortly."}), 503
+        except Exception as e:
+            print("Ask batch error:", e)
+            return jsonify({"error": str(e)}), 500
+        contexts = dict(zip(pending, built))
+
+    return event_stream_response(_ask_batch_events(questions, early, contexts))
+
+
+def _batch_contexts(doc_id: str, questions: list, results: dict, budget: int) -> list:
+    """Context per question from one multi-vector query result. Neighbour chunks for all of
+    them are fetched in a single get."""
+    hits_per_q = [
+        _rank_hits(question, docs or [], dists or [], metas or [{}] * len(docs or []))
+        for question, docs, dists, metas in zip(
+            questions, results.get("documents") or [], results.get("distances") or [], results.get("metadatas") or [],
+        )
+    ]
+    neighbors_per_q = [[] for _ in hits_per_q]
+    if CONTEXT_NEIGHBOR_EXPANSION:
+        known = {p: (text, tokens) for hits in hits_per_q for p, text, tokens in hits}
+        known.update({p: (text, tokens) for p, text, tokens in neighbor_chunks(collection, doc_id, list(known))})
+        for hits, neighbors in zip(hits_per_q, neighbors_per_q):
+            own = {p for p, _, _ in hits}
+            for p, _, _ in hits:
+                for q in (p - 1, p + 1):
+                    if q in known and q not in own:
+                        own.add(q)
+                        neighbors.append((q,) + known[q])
+    return [
+        "\n\n".join(text for _, _, text in assemble_context(hits, budget, neighbors))
+        for hits, neighbors in zip(hits_per_q, neighbors_per_q)
+    ]
+
+
+def _answer_from_context(context: str, question: str) -> dict:
+    if not context:
+        return {"answer": "I couldn't find relevant information about this question in the document.", "found": False}
+    response = llm_client.generate_content(_ask_prompt(context, question))
+    raw_text = (getattr(response, "text", "") or "").strip()
+    if not raw_text:
+        return {"error": "⚠️ Could not generate answer.", "status": 502}
+    return {"answer": format_response(raw_text), "found": not is_out_of_doc_answer(raw_text)}
+
+
+def _ask_batch_events(questions: list, early: dict, contexts: dict):
+    for i in sorted(early):
+        yield dict({"type": "answer", "index": i, "question": questions[i]}, **early[i])
+    queued = sorted(contexts)
+    running = {}
+    try:
+        while queued or running:
+            while queued and len(running) < ASK_BATCH_CONCURRENCY:
+                i = queued.pop(0)
+                running[llm_client.submit_in_context(
+                    lambda c=contexts[i], q=questions[i]: _answer_from_context(c, q))] = i
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                i = running.pop(fut)
+                event = {"type": "answer", "index": i, "question": questions[i]}
+                try:
+                    event.update(fut.result())
+                except (DeadlineExceeded, BudgetExceeded) as e:
+                    # Out of time or tokens for the whole batch: end the stream.
+                    yield error_event(e, "Answer")
+                    return
+                except Exception as e:
+                    print("Ask batch answer error:", e)
+                    failed = error_event(e, "Answer")
+                    event.update({"error": failed["error"], "status": failed["status"]})
+                yield event
+    finally:
+        # Client gone or batch aborted: drop what has not started.
+        for fut in running:
+            fut.cancel()
+    yield {"type": "done", "count": len(questions)}
+
+
+@request_stage("format_response")
 def format_response(text):
     """
     Improve the formatting of AI responses for better readability
@@ -825,11 +1327,12 @@ def fetch_doc_from_node(doc_id: str):
     """Fetch binary document from Node API /api/document/:id/download (requires user token in frontend).
     For server-side, assume Node allows local trusted call without auth or you can add a service token.
     """
+    timeout = stage_timeout("node_fetch", NODE_FETCH_TIMEOUT)
     try:
         url = f"{NODE_BASE_URL}/api/document/{doc_id}/download"
 
         headers = {"x-service-token": SERVICE_TOKEN}
-        r = requests.get(url, headers=headers, timeout=NODE_FETCH_TIMEOUT)
+        r = node_request("download", "GET", url, headers=headers, timeout=timeout)
         if r.status_code != 200:
             return False, f"Node returned {r.status_code}", None, None
    
@@ -840,18 +1343,21 @@ def fetch_doc_from_node(doc_id: str):
         mimetype = r.headers.get("Content-Type", "application/octet-stream")
         return True, filename, mimetype, r.content
     except Exception as e:
+        check_deadline("node_fetch")
         return False, str(e), None, None
 
 def fetch_doc_meta_from_node(doc_id: str):
     """Fetch document metadata (sensitiveFound/consentConfirmed) from Node for consent persistence."""
+    timeout = stage_timeout("node_meta", NODE_FETCH_TIMEOUT)
     try:
         url = f"{NODE_BASE_URL}/api/document/{doc_id}/_meta"
         headers = {"x-service-token": SERVICE_TOKEN}
-        r = requests.get(url, headers=headers, timeout=NODE_FETCH_TIMEOUT)
+        r = node_request("meta", "GET", url, headers=headers, timeout=timeout)
         if r.status_code != 200:
             return None
         return r.json()
     except Exception:
+        check_deadline("node_meta")
         return None
 
 # --- Background indexing support ---
@@ -860,25 +1366,19 @@ _indexing_lock = threading.Lock()
 
 def _background_index(doc_id: str):
     try:
-        ok, filename, mimetype, data_bytes = fetch_doc_from_node(doc_id)
-        if not ok:
-            return
-
-        text_for_scan = extract_text_for_mimetype(filename, mimetype, data_bytes)
-        if not text_for_scan:
-            return
-        scan = detect_sensitive(text_for_scan)
-        prev = consent_state.get(doc_id) or {}
-        consent_state[doc_id] = {
-            "sensitive": bool(scan.get("found")),
-            "confirmed": bool(prev.get("confirmed", False)),
-            "awaiting": False,
-            "last_scan": "ok",
-            "summary": scan,
-        }
-        if scan.get("found") and not prev.get("confirmed", False):
-            return
-        index_bytes(doc_id, filename, mimetype, data_bytes)
+        with usage_scope("indexing", doc_id):
+            ok, filename, mimetype, data_bytes = fetch_doc_from_node(doc_id)
+            if not ok:
+                return
+
+            text_for_scan = extract_text_for_mimetype(filename, mimetype, data_bytes)
+            if not text_for_scan:
+                return
+            scan = detect_sensitive(text_for_scan)
+            state = record_scan(doc_id, scan)
+            if scan.get("found") and not state["confirmed"]:
+                return
+            index_bytes(doc_id, filename, mimetype, data_bytes)
     finally:
         with _indexing_lock:
             _indexing_in_progress.discard(doc_id)
@@ -892,28 +1392,20 @@ def _start_background_indexing(doc_id: str):
     th.start()
 
 def has_index(doc_id: str) -> bool:
-    res = collection.get(where={"doc_id": doc_id})
+    res = collection.get(where={"doc_id": doc_id}, limit=1, include=[])
     ids = res.get("ids", [])
     return bool(ids)
 
+@without_deadline
 def index_bytes(doc_id: str, filename: str, mimetype: str, data: bytes):
-    text = ""
-    ext = (filename.rsplit(".", 1)[-1].lower() if "." in filename else "")
-    if mimetype == "application/pdf" or ext == "pdf":
-        text = extract_text_from_pdf_bytes(data)
-    elif mimetype in ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "application/msword") or ext in ("docx", "doc"):
-        text = extract_text_from_docx_bytes(data)
-    elif mimetype == "text/plain" or ext == "txt":
-        text = extract_text_from_txt_bytes(data)
-    else:
-        return False, 0
-
-    text = (text or "").strip()
+    text = (extract_text_for_mimetype(filename, mimetype, data) or "").strip()
     if not text:
         return False, 0
+    # Word documents get their PDF preview converted in the background meanwhile.
+    preview_store().schedule(doc_id, filename, mimetype, data)
 
     try:
-        existing = collection.get(where={"doc_id": doc_id}) or {}
+        existing = collection.get(where={"doc_id": doc_id}, include=[]) or {}
         existing_ids = existing.get("ids", []) or []
         if existing_ids:
             collection.delete(ids=existing_ids)
@@ -921,6 +1413,8 @@ def index_bytes(doc_id: str, filename: str, mimetype: str, data: bytes):
         pass
 
     sections = split_sheet_sections(text)
+    # Keeps estimate_tokens() close to the model's tokenizer; at most one count_tokens call per hour.
+    calibrate_estimator(text)
     added = 0
     chunk_records = []
 
@@ -948,7 +1442,7 @@ def index_bytes(doc_id: str, filename: str, mimetype: str, data: bytes):
 
     chunk_index = 0
     for (sheet_name, body) in sections:
-        chunks = chunk_text(body)
+        chunks = chunk_section(body)
         for i, chunk in enumerate(chunks):
             c = (chunk or "").strip()
             if not c:
@@ -958,7 +1452,7 @@ def index_bytes(doc_id: str, filename: str, mimetype: str, data: bytes):
                 continue
             batch_embeddings.append(emb)
             batch_documents.append(c)
-            meta = {"doc_id": doc_id, "chunk": chunk_index, "filename": filename}
+            meta = {"doc_id": doc_id, "chunk": chunk_index, "filename": filename, "tokens": estimate_tokens(c)}
             if sheet_name:
                 meta["sheet"] = sheet_name
             batch_metadatas.append(meta)
@@ -974,9 +1468,13 @@ def index_bytes(doc_id: str, filename: str, mimetype: str, data: bytes):
                 flush_batch()
 
     flush_batch()
+    invalidate_selection(doc_id)
+    invalidate_doc_caches(doc_id)
+    rebuild_bank(doc_id)
     _push_chunks_to_node(doc_id, filename, chunk_records)
     return True, added
 
+@without_deadline
 def index_text(doc_id: str, filename: str, text: str):
     """
     Index plain text content for a given document id by replacing existing chunks.
@@ -987,7 +1485,7 @@ def index_text(doc_id: str, filename: str, text: str):
         return False, 0
 
     try:
-        existing = collection.get(where={"doc_id": doc_id}) or {}
+        existing = collection.get(where={"doc_id": doc_id}, include=[]) or {}
         existing_ids = existing.get("ids", []) or []
         if existing_ids:
             collection.delete(ids=existing_ids)
@@ -995,6 +1493,8 @@ def index_text(doc_id: str, filename: str, text: str):
         pass
 
     sections = split_sheet_sections(text)
+    # Keeps estimate_tokens() close to the model's tokenizer; at most one count_tokens call per hour.
+    calibrate_estimator(text)
     added = 0
     chunk_records = []
 
@@ -1022,7 +1522,7 @@ def index_text(doc_id: str, filename: str, text: str):
 
     chunk_index = 0
     for (sheet_name, body) in sections:
-        chunks = chunk_text(body)
+        chunks = chunk_section(body)
         for i, chunk in enumerate(chunks):
             c = (chunk or "").strip()
             if not c:
@@ -1032,7 +1532,8 @@ def index_text(doc_id: str, filename: str, text: str):
                 continue
             batch_embeddings.append(emb)
             batch_documents.append(c)
-            meta = {"doc_id": doc_id, "chunk": chunk_index, "filename": filename or "document.txt"}
+            meta = {"doc_id": doc_id, "chunk": chunk_index, "filename": filename or "document.txt",
+                    "tokens": estimate_tokens(c)}
             if sheet_name:
                 meta["sheet"] = sheet_name
             batch_metadatas.append(meta)
@@ -1047,6 +1548,9 @@ def index_text(doc_id: str, filename: str, text: str):
                 flush_batch()
 
     flush_batch()
+    invalidate_selection(doc_id)
+    invalidate_doc_caches(doc_id)
+    rebuild_bank(doc_id)
     _push_chunks_to_node(doc_id, filename or "document.txt", chunk_records)
     return True, added
 
@@ -1061,7 +1565,7 @@ def _push_chunks_to_node(doc_id: str, filename: str, chunk_records: list):
             "chunks": chunk_records,
         }
         headers = {"Content-Type": "application/json", "x-service-token": SERVICE_TOKEN}
-        r = requests.post(CHUNK_UPSERT_URL, json=payload, headers=headers, timeout=NODE_FETCH_TIMEOUT)
+        r = node_request("chunk_upsert", "POST", CHUNK_UPSERT_URL, json=payload, headers=headers, timeout=NODE_FETCH_TIMEOUT)
         if r.status_code >= 300:
             print("[Chunks Upsert] Node returned", r.status_code, r.text[:200])
     except Exception as e:
@@ -1075,16 +1579,14 @@ def set_consent():
     consent = bool(body.get("consent", False))
     if not doc_id:
         return jsonify({"error": "Missing doc_id"}), 400
-    st = consent_state.get(doc_id) or {"sensitive": False, "confirmed": False}
-    st["confirmed"] = consent
-    st["awaiting"] = False
-    consent_state[doc_id] = st
+    update_state(consent_state, doc_id, lambda st: dict(st, confirmed=consent, awaiting=False),
+                 default={"sensitive": False, "confirmed": False})
     # Persist consent to Node for durability (best-effort)
     try:
-        requests.post(f"{NODE_BASE_URL}/api/document/{doc_id}/consent",
-                      json={"consent": consent},
-                      headers={"x-service-token": SERVICE_TOKEN},
-                      timeout=NODE_FETCH_TIMEOUT)
+        node_request("consent", "POST", f"{NODE_BASE_URL}/api/document/{doc_id}/consent",
+                     json={"consent": consent},
+                     headers={"x-service-token": SERVICE_TOKEN},
+                     timeout=NODE_FETCH_TIMEOUT)
     except Exception:
         pass
 
@@ -1123,15 +1625,8 @@ def replace_text_index():
     try:
 
         scan = detect_sensitive(text or "")
-        prev = consent_state.get(doc_id) or {}
-        consent_state[doc_id] = {
-            "sensitive": bool(scan.get("found")),
-            "confirmed": bool(prev.get("confirmed", False)),
-            "awaiting": False,
-            "last_scan": "ok",
-            "summary": scan,
-        }
-        if scan.get("found") and not prev.get("confirmed", False):
+        state = record_scan(doc_id, scan)
+        if scan.get("found") and not state["confirmed"]:
             return jsonify({
                 "message": "Sensitive data detected; indexing deferred until consent.",
                 "requireConfirmation": True,
@@ -1143,6 +1638,8 @@ def replace_text_index():
         if not indexed:
             return jsonify({"error": "Empty text or indexing failed"}), 400
         return jsonify({"message": f"Indexed {added} chunks", "doc_id": doc_id, "requireConfirmation": False})
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1153,7 +1650,6 @@ try:
         fetch_doc_from_node,
         extract_text_for_mimetype,
         TEXT_MODEL,
-        genai,
     )
     app.register_blueprint(quiz_bp)
 except Exception as _e:
@@ -1166,14 +1662,15 @@ try:
         fetch_doc_from_node,
         extract_text_for_mimetype,
         TEXT_MODEL,
-        genai,
     )
     app.register_blueprint(flashcard_bp)
 except Exception as _e:
     pass
 
+init_question_bank(collection, TEXT_MODEL)
+
 try:
-    app.register_blueprint(init_summarizer(TEXT_MODEL, genai))
+    app.register_blueprint(init_summarizer(TEXT_MODEL))
 except Exception as _e:
     pass
 
@@ -1181,4 +1678,5 @@ except Exception as _e:
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "5001"))
     debug = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
+    init_worker()
     app.run(host="0.0.0.0", port=port, debug=debug)
\ No newline at end of file
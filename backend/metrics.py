@@ -0,0 +1,247 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+# ====== STAGE METRICS ======
+# Minimal Prometheus-compatible counters and histograms (text exposition format 0.0.4).
+# Every observation is one dict lookup and a few additions under a per-metric lock, so
+# instrumenting hot paths costs microseconds. Values are per process: with several gunicorn
+# workers each /metrics scrape reports the worker that answered.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        return self._values.get(key, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, v in items:
+            lines.append(f"{self.name}{_labels_text(self.labelnames, key)} {_fmt(v)}")
+        return lines
+
+
+class Histogram:
+    """`stage` (and optionally `stage_label`) also adds each observation to the current
+    request's per-stage breakdown, e.g. stage="chroma", stage_label="op" -> "chroma:query"."""
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 stage: str = None, stage_label: str = None):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.stage = stage
+        self.stage_label = stage_label
+        self._series = {}  # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if self.stage:
+            note_stage(f"{self.stage}:{labels.get(self.stage_label, '')}" if self.stage_label else self.stage, value)
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        nb = len(self.buckets)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * nb + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[nb] += value
+            series[nb + 1] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        nb = len(self.buckets)
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series[:nb]):
+                cumulative += count
+                le = 'le="' + _fmt(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {_fmt(series[nb])}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {series[nb + 1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, doc: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, doc, labelnames))
+
+    def histogram(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                  stage: str = None, stage_label: str = None) -> Histogram:
+        return self.register(Histogram(name, doc, labelnames, buckets, stage, stage_label))
+
+    def add_collector(self, fn):
+        """fn() -> [(name, type, help, [(labels_dict, value), ...]), ...], called on every scrape."""
+        with self._lock:
+            self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics):
+            lines.extend(metric.render())
+        for fn in list(self._collectors):
+            try:
+                families = fn()
+            except Exception as e:
+                print("[Metrics] Collector failed:", e)
+                continue
+            for name, kind, doc, samples in families:
+                lines.append(f"# HELP {name} {doc}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels)
+                    lines.append(f"{name}{_labels_text(names, [labels[n] for n in names])} {_fmt(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# ---- Per-request stage breakdown ----
+# main.before_request puts an empty dict in g.stage_times; staged histograms and
+# request_stage() add their seconds to it so slow requests can be explained afterwards.
+def note_stage(stage: str, seconds: float):
+    if has_request_context():
+        stages = g.get("stage_times")
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def request_stage(stage: str):
+    """Time a block (or, used as a decorator, a function) into the request's stage breakdown."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        note_stage(stage, time.perf_counter() - start)
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ---- Stage metrics shared across modules ----
+NODE_REQUEST_SECONDS = REGISTRY.histogram(
+    "smartdoc_node_request_seconds", "Latency of calls to the Node API.", ("op", "outcome"),
+    stage="node", stage_label="op")
+EXTRACT_SECONDS = REGISTRY.histogram(
+    "smartdoc_extract_seconds", "Text extraction time per document type.", ("kind",),
+    stage="extract", stage_label="kind")
+CHUNKING_SECONDS = REGISTRY.histogram(
+    "smartdoc_chunking_seconds", "Time to split one section into chunks.", stage="chunking")
+CHUNKS_PER_SECTION = REGISTRY.histogram(
+    "smartdoc_chunks_per_section", "Chunks produced per section.", buckets=SIZE_BUCKETS)
+EMBED_SECONDS = REGISTRY.histogram(
+    "smartdoc_embed_seconds", "Embedding call latency including retries.", ("outcome",), stage="embed")
+EMBED_BATCH_SIZE = REGISTRY.histogram(
+    "smartdoc_embed_batch_size", "Texts per embedding call.", buckets=SIZE_BUCKETS)
+EMBED_FAILURES = REGISTRY.counter(
+    "smartdoc_embed_failures_total", "Embedding calls that failed, by reason.", ("reason",))
+CHROMA_SECONDS = REGISTRY.histogram(
+    "smartdoc_chroma_seconds", "Chroma collection operation latency.", ("op", "outcome"),
+    stage="chroma", stage_label="op")
+LLM_GENERATE_SECONDS = REGISTRY.histogram(
+    "smartdoc_llm_generate_seconds", "Gemini generate_content latency including retries.", ("endpoint", "outcome"),
+    stage="llm_generate")
+JSON_REPAIR = REGISTRY.counter(
+    "smartdoc_json_repair_total", "Second-pass JSON repair calls in quiz/flashcards.", ("endpoint", "outcome"))
+DEDUP_DROPPED = REGISTRY.counter(
+    "smartdoc_dedup_dropped_total", "Generated cards/questions dropped as near-duplicates.", ("endpoint", "method"))
+CACHE_REQUESTS = REGISTRY.counter(
+    "smartdoc_cache_requests_total", "Cache lookups by cache and result (hit/miss).", ("cache", "result"))
+
+
+def outcome_of(exc) -> str:
+    """Coarse outcome label for an exception raised by a stage (None = ok)."""
+    if exc is None:
+        return "ok"
+    if isinstance(exc, GeneratorExit):
+        # A streamed stage whose reader stopped early (client gone, or it had enough).
+        return "cancelled"
+    name = type(exc).__name__
+    if name in ("DeadlineExceeded", "TimeoutError", "Timeout", "ReadTimeout", "ConnectTimeout"):
+        return "timeout"
+    if name == "LLMUnavailable":
+        return "unavailable"
+    return "error"
+
+
+@contextmanager
+def timed_stage(histogram: Histogram, **labels):
+    """Observe the block on `histogram` with an outcome label derived from any exception."""
+    start = time.perf_counter()
+    exc = None
+    try:
+        yield
+    except BaseException as e:
+        exc = e
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, outcome=outcome_of(exc), **labels)
+
+
+def current_endpoint() -> str:
+    """Flask endpoint of the request being served, or "background" outside a request."""
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "background"
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,273 @@
+import concurrent.futures
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import cache_lookup
+from serving import run_cpu_bound
+from startup import import_timed
+from state_store import open_store
+
+# ====== WORD PREVIEW STORE ======
+# Word documents are previewed as PDFs converted with docx2pdf. Converted files live in
+# PREVIEW_CACHE_DIR as "<doc_id>_<sha256 of the Word bytes>.pdf", so a re-uploaded document
+# never serves a stale preview. Each process keeps an LRU index of the directory (rebuilt from
+# a scan at startup, file mtime = last use) and evicts the least recently used files once the
+# directory is over PREVIEW_CACHE_MAX_BYTES or a file is older than PREVIEW_CACHE_MAX_AGE_SEC.
+# The doc_id -> current content hash map is in the shared state store, so a preview request
+# finds the converted file without downloading the document again.
+#
+# Conversion runs ahead of time: indexing a Word document schedules it on a small converter
+# pool (PREVIEW_CONVERT_WORKERS), and a preview request that arrives meanwhile waits for that
+# conversion instead of starting its own.
+
+PREVIEW_CACHE_DIR = os.environ.get("PREVIEW_CACHE_DIR", os.path.join(os.getcwd(), "pdf_cache"))
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+PREVIEW_CACHE_MAX_AGE_SEC = float(os.environ.get("PREVIEW_CACHE_MAX_AGE_SEC", str(7 * 24 * 3600)))
+# docx2pdf drives Word/LibreOffice, which does not like parallel conversions.
+PREVIEW_CONVERT_WORKERS = int(os.environ.get("PREVIEW_CONVERT_WORKERS", "1"))
+PREVIEW_PRECONVERT = os.environ.get("PREVIEW_PRECONVERT", "true").lower() == "true"
+# Only touch a file's mtime on a hit when it is at least this old (saves a syscall per click).
+TOUCH_INTERVAL_SEC = 60.0
+
+WORD_MIMETYPES = ("application/msword", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+_FILE = re.compile(r"^(?P<doc_id>.+)_(?P<digest>[0-9a-f]{8,64})\.pdf$")
+
+
+class ConverterUnavailable(RuntimeError):
+    """docx2pdf is not installed on this server."""
+
+
+def is_word(filename: str, mimetype: str) -> bool:
+    ext = (filename or "").rsplit(".", 1)[-1].lower() if "." in (filename or "") else ""
+    return mimetype in WORD_MIMETYPES or ext in ("doc", "docx")
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data or b"").hexdigest()[:32]
+
+
+class PreviewStore:
+    def __init__(self, directory: str, max_bytes: int, max_age_sec: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self._index = OrderedDict()  # file name -> [size, last used (epoch)], least recent first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}  # file name -> Future
+        self._pool = None
+        self._hashes = open_store("pdf_preview", max_age_sec)
+        self._rebuild()
+
+    # ---- index ----
+    def _rebuild(self):
+        """Index the files already on disk, oldest use first; drop leftover partial writes."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".part"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            if _FILE.match(entry.name):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        with self._lock:
+            self._index.clear()
+            self._bytes = 0
+            for mtime, name, size in sorted(found):
+                self._index[name] = [size, mtime]
+                self._bytes += size
+        self._evict()
+        print(f"[Preview] Indexed {len(self._index)} cached previews ({self._bytes // 1024} KiB) in {self.directory}")
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _evict(self):
+        now = time.time()
+        doomed = []
+        with self._lock:
+            for name, (size, used) in list(self._index.items()):
+                over = self._bytes > self.max_bytes
+                if not over and now - used <= self.max_age_sec:
+                    break
+                del self._index[name]
+                self._bytes -= size
+                doomed.append(name)
+        for name in doomed:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+        if doomed:
+            print(f"[Preview] Evicted {len(doomed)} previews; {self._bytes // 1024} KiB kept")
+
+    def _touch(self, name: str):
+        path = self._path(name)
+        now = time.time()
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None:
+                # Written by another worker (or indexed before a restart of ours).
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    return None
+                entry = self._index[name] = [size, 0.0]
+                self._bytes += size
+            stale = now - entry[1] >= TOUCH_INTERVAL_SEC
+            entry[1] = now
+            self._index.move_to_end(name)
+        if stale:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                with self._lock:
+                    gone = self._index.pop(name, None)
+                    if gone:
+                        self._bytes -= gone[0]
+                return None
+        return path
+
+    def _add(self, name: str, size: int):
+        with self._lock:
+            old = self._index.pop(name, None)
+            if old:
+                self._bytes -= old[0]
+            self._index[name] = [size, time.time()]
+            self._bytes += size
+        self._evict()
+
+    # ---- lookups ----
+    @staticmethod
+    def _name(doc_id: str, digest: str) -> str:
+        return f"{doc_id}_{digest}.pdf"
+
+    def lookup(self, doc_id: str):
+        """Path of the preview for the document's current content, or None."""
+        digest = (self._hashes.get(doc_id) or {}).get("sha")
+        path = self._touch(self._name(doc_id, digest)) if digest else None
+        cache_lookup("pdf_preview", bool(path))
+        return path
+
+    def remember(self, doc_id: str, data: bytes) -> str:
+        """Record the document's current content hash; a preview of older content is deleted."""
+        digest = content_hash(data)
+        previous = (self._hashes.get(doc_id) or {}).get("sha")
+        if previous != digest:
+            self._hashes.set(doc_id, {"sha": digest})
+            if previous:
+                self._remove([self._name(doc_id, previous)])
+        return digest
+
+    def drop(self, doc_id: str):
+        """Forget the document and delete all of its previews."""
+        self._hashes.delete(doc_id)
+        # Scan the directory too: other workers may have written previews this index lacks.
+        try:
+            names = [n for n in os.listdir(self.directory)
+                     if _FILE.match(n) and _FILE.match(n).group("doc_id") == doc_id]
+        except OSError:
+            names = []
+        self._remove(names)
+
+    def _remove(self, names: list):
+        with self._lock:
+            for name in names:
+                entry = self._index.pop(name, None)
+                if entry:
+                    self._bytes -= entry[0]
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    # ---- conversion ----
+    def _convert(self, name: str, filename: str, data: bytes) -> str:
+        try:
+            docx2pdf = import_timed("docx2pdf")
+        except Exception as e:
+            raise ConverterUnavailable("docx2pdf not installed on server") from e
+        with tempfile.TemporaryDirectory() as td:
+            in_path = os.path.join(td, os.path.basename(filename or "document"))
+            if not in_path.lower().endswith((".docx", ".doc")):
+                in_path += ".docx"
+            with open(in_path, "wb") as f:
+                f.write(data)
+            out_path = os.path.join(td, "preview.pdf")
+            run_cpu_bound(docx2pdf.convert, in_path, out_path)
+            # Same filesystem rename, so other workers never see a half-written preview.
+            part = self._path(name + ".part")
+            with open(out_path, "rb") as src, open(part, "wb") as dst:
+                dst.write(src.read())
+            os.replace(part, self._path(name))
+        self._add(name, os.path.getsize(self._path(name)))
+        return self._path(name)
+
+    def _executor(self):
+        if self._pool is None:
+            with _store_lock:
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=max(1, PREVIEW_CONVERT_WORKERS), thread_name_prefix="preview-convert")
+        return self._pool
+
+    def _submit(self, name: str, filename: str, data: bytes) -> concurrent.futures.Future:
+        pool = self._executor()
+        with self._lock:
+            fut = self._inflight.get(name)
+            if fut is not None:
+                return fut
+            fut = pool.submit(self._convert, name, filename, data)
+            self._inflight[name] = fut
+
+        def _done(f, name=name):
+            with self._lock:
+                self._inflight.pop(name, None)
+            if f.exception() and not isinstance(f.exception(), ConverterUnavailable):
+                print(f"[Preview] Conversion of {name} failed:", f.exception())
+
+        fut.add_done_callback(_done)
+        return fut
+
+    def ensure(self, doc_id: str, filename: str, data: bytes, timeout: float = None) -> str:
+        """Path of the preview for these Word bytes, converting them (or joining a conversion
+        already running) when needed. Raises ConverterUnavailable or the conversion error."""
+        name = self._name(doc_id, self.remember(doc_id, data))
+        path = self._touch(name)
+        if path:
+            return path
+        return self._submit(name, filename, data).result(timeout=timeout)
+
+    def schedule(self, doc_id: str, filename: str, mimetype: str, data: bytes):
+        """Convert a Word document in the background so its first preview is a cache hit."""
+        if not PREVIEW_PRECONVERT or not data or not is_word(filename, mimetype):
+            return
+        name = self._name(doc_id, self.remember(doc_id, data))
+        if self._touch(name):
+            return
+        self._submit(name, filename, data)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def preview_store() -> PreviewStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = PreviewStore(PREVIEW_CACHE_DIR, PREVIEW_CACHE_MAX_BYTES, PREVIEW_CACHE_MAX_AGE_SEC)
+    return _store
@@ -0,0 +1,217 @@
+import collections
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from serving import SERVING_MODE
+
+# ====== ON-DEMAND REQUEST PROFILER ======
+# A single daemon thread samples the stacks of the threads serving profiled requests every
+# PROFILE_INTERVAL_MS via sys._current_frames(), so an unprofiled request pays nothing and a
+# profiled one pays only for the sampling ticks. A request is profiled when an admin sends
+# `X-Profile: 1` (with X-Admin-Token) or when it falls in PROFILE_SAMPLE_PCT of traffic.
+# Profiled and slow requests (over SLOW_REQUEST_MS) leave an entry in a bounded on-disk ring:
+# <id>.json with the per-stage breakdown, plus <id>.collapsed (flamegraph.pl / speedscope
+# input) for profiled ones.
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_SAMPLE_PCT = float(os.environ.get("PROFILE_SAMPLE_PCT", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+PROFILE_RING_SIZE = int(os.environ.get("PROFILE_RING_SIZE", "100"))
+PROFILE_MAX_DEPTH = 64
+# 0 disables the slow-request log.
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "5000"))
+
+_ENTRY_ID = re.compile(r"^\d{13}-\d+-\d+$")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame) -> str:
+    """Root-first "file:func;file:func" line as used by collapsed-stack flamegraph tools."""
+    parts = []
+    while frame is not None and len(parts) < PROFILE_MAX_DEPTH:
+        parts.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class _Sampler:
+    """Samples the registered threads' stacks on one shared daemon thread."""
+
+    def __init__(self, interval_sec: float):
+        self.interval = interval_sec
+        self._targets = {}  # thread ident -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self, ident: int) -> collections.Counter:
+        stacks = collections.Counter()
+        with self._lock:
+            self._targets[ident] = stacks
+            self._wake.set()
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return stacks
+
+    def stop(self, ident: int):
+        with self._lock:
+            return self._targets.pop(ident, None)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                idle = not self._targets
+                if idle:
+                    self._wake.clear()
+            if idle:
+                # Sleep until the next profiled request instead of ticking for nothing.
+                self._wake.wait()
+                continue
+            time.sleep(self.interval)
+            with self._lock:
+                frames = sys._current_frames()
+                for ident, stacks in self._targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None and ident != me:
+                        stacks[collapse_stack(frame)] += 1
+
+
+_sampler = _Sampler(PROFILE_INTERVAL_MS / 1000.0)
+
+
+def sampling_supported() -> bool:
+    # Under gevent every request shares the hub's OS thread, so a thread's stack cannot be
+    # attributed to one request; only the slow-request log is kept there.
+    return SERVING_MODE != "gevent"
+
+
+class RequestTrace:
+    def __init__(self, profiled: bool, reason: str = ""):
+        self.started = time.perf_counter()
+        self.started_wall = time.time()
+        self.reason = reason
+        self.ident = threading.get_ident()
+        self.stacks = _sampler.start(self.ident) if profiled else None
+
+    def stop(self):
+        if self.stacks is not None:
+            _sampler.stop(self.ident)
+
+
+def begin_request(forced: bool) -> RequestTrace:
+    """Start tracing the current request; sampling only when forced or sampled."""
+    reason = ""
+    if forced:
+        reason = "header"
+    elif PROFILE_SAMPLE_PCT > 0 and random.random() * 100.0 < PROFILE_SAMPLE_PCT:
+        reason = "sampled"
+    return RequestTrace(bool(reason) and sampling_supported(), reason)
+
+
+_seq = 0
+_seq_lock = threading.Lock()
+
+
+def _next_id() -> str:
+    global _seq
+    with _seq_lock:
+        _seq += 1
+        return f"{int(time.time() * 1000):013d}-{os.getpid()}-{_seq}"
+
+
+def _prune_ring():
+    try:
+        ids = sorted({name.split(".", 1)[0] for name in os.listdir(PROFILE_DIR) if _ENTRY_ID.match(name.split(".", 1)[0])})
+    except OSError:
+        return
+    for old in ids[:-PROFILE_RING_SIZE] if len(ids) > PROFILE_RING_SIZE else []:
+        for ext in (".json", ".collapsed"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old + ext))
+            except OSError:
+                pass
+
+
+def finish_request(trace: RequestTrace, endpoint: str, method: str, path: str, status: int, stages: dict):
+    """Stop sampling and, for profiled or slow requests, write an entry to the ring.
+    Returns the entry id, or None when nothing was written."""
+    trace.stop()
+    elapsed_ms = (time.perf_counter() - trace.started) * 1000.0
+    slow = SLOW_REQUEST_MS > 0 and elapsed_ms >= SLOW_REQUEST_MS
+    if not trace.reason and not slow:
+        return None
+
+    stage_ms = {k: round(v * 1000.0, 1) for k, v in sorted((stages or {}).items(), key=lambda kv: kv[1], reverse=True)}
+    accounted = sum(stage_ms.values())
+    entry = {
+        "ts": trace.started_wall,
+        "pid": os.getpid(),
+        "endpoint": endpoint,
+        "method": method,
+        "path": path,
+        "status": status,
+        "elapsed_ms": round(elapsed_ms, 1),
+        "slow": slow,
+        "profiled": trace.reason or None,
+        "stages_ms": stage_ms,
+        # Time spent outside instrumented stages (Flask, guards, prompt building, formatting).
+        "other_ms": round(max(0.0, elapsed_ms - accounted), 1),
+        "samples": sum(trace.stacks.values()) if trace.stacks is not None else 0,
+        "interval_ms": PROFILE_INTERVAL_MS,
+    }
+    entry_id = _next_id()
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if trace.stacks:
+            with open(os.path.join(PROFILE_DIR, entry_id + ".collapsed"), "w", encoding="utf-8") as f:
+                for stack, count in trace.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        with open(os.path.join(PROFILE_DIR, entry_id + ".json"), "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        _prune_ring()
+    except OSError as e:
+        print("[Profiler] Failed to write", entry_id, "=>", e)
+        return None
+    if slow:
+        print(f"[Slow Request] {method} {path} {elapsed_ms:.0f}ms stages={stage_ms} id={entry_id}")
+    return entry_id
+
+
+def recent_entries(limit: int = 50) -> list:
+    try:
+        names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)[:limit]
+    except OSError:
+        return []
+    out = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            continue
+        entry["id"] = name[:-5]
+        entry["has_stacks"] = os.path.exists(os.path.join(PROFILE_DIR, entry["id"] + ".collapsed"))
+        out.append(entry)
+    return out
+
+
+def stacks_path(entry_id: str):
+    """Path of an entry's collapsed-stack file, or None for unknown/malformed ids."""
+    if not _ENTRY_ID.match(entry_id or ""):
+        return None
+    path = os.path.join(PROFILE_DIR, entry_id + ".collapsed")
+    return path if os.path.exists(path) else None
@@ -0,0 +1,382 @@
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+
+from context_select import section_chunks
+from dedup import suppress_duplicates_with_vectors
+from llm_client import generate_content
+from metrics import cache_lookup
+from state_store import open_store, update_state
+from streaming import JsonArrayStream
+from token_budget import context_budget, trim_to_tokens
+from usage import usage_scope
+
+# ====== PER-DOCUMENT QUESTION BANK ======
+# After a document is indexed, a background job fills a bank of validated quiz questions (per
+# difficulty) and flashcards, each tagged with the chunk it came from. The bank lives in the
+# shared state store, so every worker serves from it. generate-quiz / generate-flashcards
+# sample from it when it holds enough matching items, preferring items served least and
+# spreading picks over chunks and question types. An item is retired after
+# QUESTION_BANK_MAX_SERVES servings, and the bank is topped up in the background once fresh
+# items for a kind fall below QUESTION_BANK_LOW_WATERMARK of its target. Reindexing bumps the
+# bank's generation, which discards the old items and makes in-flight builds drop their output.
+# Documents indexed before the bank existed get one on their first quiz/flashcard request.
+# The dedup embeddings of banked items are kept beside the bank ("vectors:<doc_id>"), so each
+# batch only embeds its own items.
+
+QUESTION_BANK_ENABLED = os.environ.get("QUESTION_BANK_ENABLED", "true").lower() == "true"
+QUESTION_BANK_QUESTIONS_PER_DIFFICULTY = int(os.environ.get("QUESTION_BANK_QUESTIONS_PER_DIFFICULTY", "24"))
+QUESTION_BANK_CARDS = int(os.environ.get("QUESTION_BANK_CARDS", "40"))
+QUESTION_BANK_MAX_SERVES = int(os.environ.get("QUESTION_BANK_MAX_SERVES", "3"))
+QUESTION_BANK_LOW_WATERMARK = float(os.environ.get("QUESTION_BANK_LOW_WATERMARK", "0.5"))
+QUESTION_BANK_BATCH = 12
+# Another worker's build is trusted for this long before this one may start its own.
+QUESTION_BANK_LEASE_SEC = float(os.environ.get("QUESTION_BANK_LEASE_SEC", "600"))
+
+DIFFICULTIES = ("easy", "medium", "hard")
+QUESTION_TYPES = ("mcq", "true_false", "short_answer")
+
+# Dependencies to be initialized from main.py
+collection = None
+TEXT_MODEL = None
+
+
+def init_question_bank(_collection, _TEXT_MODEL):
+    global collection, TEXT_MODEL
+    collection = _collection
+    TEXT_MODEL = _TEXT_MODEL
+
+
+_store = None
+_store_lock = threading.Lock()
+_building = set()
+_building_lock = threading.Lock()
+
+
+def _bank_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = open_store("question_bank")
+    return _store
+
+
+def _empty_bank(generation: str) -> dict:
+    return {"generation": generation, "updated_at": time.time(), "questions": [], "cards": []}
+
+
+def _new_generation() -> str:
+    return f"{time.time():.6f}-{os.getpid()}"
+
+
+def _vectors_key(doc_id: str) -> str:
+    return f"vectors:{doc_id}"
+
+
+def _item_id(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def _fresh(items: list) -> list:
+    return [it for it in items if it.get("served", 0) < QUESTION_BANK_MAX_SERVES]
+
+
+def _deficits(bank: dict) -> dict:
+    """Items still needed per kind ("questions:<difficulty>" / "cards") to reach the targets."""
+    out = {}
+    for difficulty in DIFFICULTIES:
+        have = sum(1 for q in _fresh(bank["questions"]) if q["difficulty"] == difficulty)
+        if have < QUESTION_BANK_QUESTIONS_PER_DIFFICULTY:
+            out[f"questions:{difficulty}"] = QUESTION_BANK_QUESTIONS_PER_DIFFICULTY - have
+    have = len(_fresh(bank["cards"]))
+    if have < QUESTION_BANK_CARDS:
+        out["cards"] = QUESTION_BANK_CARDS - have
+    return out
+
+
+def _is_low(bank: dict) -> bool:
+    for difficulty in DIFFICULTIES:
+        have = sum(1 for q in _fresh(bank["questions"]) if q["difficulty"] == difficulty)
+        if have < QUESTION_BANK_QUESTIONS_PER_DIFFICULTY * QUESTION_BANK_LOW_WATERMARK:
+            return True
+    return len(_fresh(bank["cards"])) < QUESTION_BANK_CARDS * QUESTION_BANK_LOW_WATERMARK
+
+
+# ---- Building ----
+def _labelled(chunks: list) -> str:
+    # The labels add a few tokens per chunk on top of the packed budget.
+    return trim_to_tokens("\n\n".join(f"[C{position}] {text}" for position, text in chunks),
+                          context_budget("question_bank") + 4 * len(chunks))
+
+
+def _generate_items(kind: str, difficulty: str, context: str, n: int) -> list:
+    """One generate call for n questions (of one difficulty) or cards; sanitized and tagged."""
+    from flashcard import FLASHCARD_GENERATION_CONFIG, FLASHCARD_SYS_INSTR, sanitize_card
+    from quiz import QUIZ_GENERATION_CONFIG, QUIZ_SYS_INSTR, sanitize_question
+
+    source_rule = "- Add \"source_chunk\": the number from the [C<n>] label of the chunk each item is based on.\n"
+    if kind == "questions":
+        prompt = [QUIZ_SYS_INSTR + source_rule,
+                  f"Difficulty: {difficulty}. Number of questions: {n}. Allowed types: {', '.join(QUESTION_TYPES)}.\n\n"
+                  "Document Context:\n" + context]
+        config, key, sanitize = QUIZ_GENERATION_CONFIG, "questions", sanitize_question
+    else:
+        prompt = [FLASHCARD_SYS_INSTR + source_rule,
+                  f"Number of flashcards to generate now: {n}.\n\nDocument Context:\n" + context]
+        config, key, sanitize = FLASHCARD_GENERATION_CONFIG, "flashcards", sanitize_card
+
+    resp = generate_content(prompt, TEXT_MODEL, config)
+    # The incremental parser also recovers the complete items of a truncated answer.
+    parsed = JsonArrayStream(key).feed((getattr(resp, "text", "") or "").strip())
+    out = []
+    for raw in parsed:
+        item = sanitize(raw)
+        if item is None:
+            continue
+        try:
+            item["source_chunk"] = int(raw.get("source_chunk"))
+        except (TypeError, ValueError):
+            item["source_chunk"] = None
+        if kind == "questions":
+            item["difficulty"] = difficulty
+        item["id"] = _item_id(item["question"] if kind == "questions" else item["front"])
+        item["served"] = 0
+        out.append(item)
+    return out
+
+
+def _fill(doc_id: str, generation: str) -> int:
+    """Generate items for every kind below target and append them to the bank, unless the
+    bank's generation changed meanwhile. Returns the number of items added."""
+    bank = _bank_store().get(doc_id)
+    if not bank or bank.get("generation") != generation:
+        return 0
+    deficits = _deficits(bank)
+    if not deficits:
+        return 0
+
+    calls = sum(math.ceil(n / QUESTION_BANK_BATCH) for n in deficits.values())
+    sections = section_chunks(collection, doc_id, context_budget("question_bank"), max(1, calls))
+    if not sections:
+        return 0
+
+    added = 0
+    call_no = 0
+    for kind_key, need in deficits.items():
+        kind, _, difficulty = kind_key.partition(":")
+        field = "questions" if kind == "questions" else "cards"
+        while need > 0:
+            n = min(QUESTION_BANK_BATCH, need)
+            # Rotate through the sections so every kind covers the whole document.
+            context = _labelled(sections[call_no % len(sections)])
+            call_no += 1
+            items = _generate_items(kind, difficulty, context, n)
+            need -= n
+
+            current = _bank_store().get(doc_id) or {}
+            if current.get("generation") != generation:
+                return added
+            text_of = (lambda it: it["question"]) if kind == "questions" else (lambda it: it["front"])
+            banked = current.get(field, [])
+            stored = (_bank_store().get(_vectors_key(doc_id)) or {})
+            stored = stored.get(field, {}) if stored.get("generation") == generation else {}
+            keep, embedded = suppress_duplicates_with_vectors(
+                [text_of(it) for it in items],
+                [text_of(it) for it in banked],
+                [stored.get(it["id"]) for it in banked],
+                "question_bank",
+            )
+            items = [items[i] for i in keep]
+            if embedded:
+                _store_vectors(doc_id, generation, field, {
+                    it["id"]: embedded[text_of(it)] for it in banked + items if text_of(it) in embedded})
+            if not items:
+                continue
+
+            def _append(st, items=items, field=field):
+                if st.get("generation") != generation:
+                    return st
+                ids = {it["id"] for it in st.get(field, [])}
+                st[field] = st.get(field, []) + [it for it in items if it["id"] not in ids]
+                st["updated_at"] = time.time()
+                return st
+
+            update_state(_bank_store(), doc_id, _append, default=_empty_bank(generation))
+            added += len(items)
+    return added
+
+
+def _store_vectors(doc_id: str, generation: str, field: str, vectors: dict):
+    """Keep dedup embeddings by item id (rounded; they are only compared by cosine)."""
+    rounded = {item_id: [round(x, 4) for x in vec] for item_id, vec in vectors.items()}
+
+    def _merge(st):
+        if st.get("generation") != generation:
+            st = {"generation": generation}
+        st[field] = dict(st.get(field, {}), **rounded)
+        return st
+
+    try:
+        update_state(_bank_store(), _vectors_key(doc_id), _merge)
+    except Exception as e:
+        print("[QuestionBank] Failed to store embeddings for", doc_id, "=>", e)
+
+
+def _ensure_bank(doc_id: str):
+    """The document's bank; an empty one is started for an indexed document that has none
+    (indexed before the bank existed, or its bank expired). None when it is not indexed."""
+    bank = _bank_store().get(doc_id)
+    if bank or collection is None:
+        return bank
+    try:
+        indexed = bool((collection.get(where={"doc_id": doc_id}, limit=1, include=[]) or {}).get("ids"))
+    except Exception as e:
+        print("[QuestionBank] Index check failed for", doc_id, "=>", e)
+        return None
+    if not indexed:
+        return None
+    # Only one worker starts it; the others see its bank.
+    _bank_store().compare_and_set(doc_id, None, _empty_bank(_new_generation()))
+    return _bank_store().get(doc_id)
+
+
+def _acquire_lease(doc_id: str) -> bool:
+    key = f"lease:{doc_id}"
+    return _bank_store().compare_and_set(key, None, {"pid": os.getpid(), "at": time.time()}, ttl=QUESTION_BANK_LEASE_SEC)
+
+
+def _run_build(doc_id: str):
+    try:
+        if not _acquire_lease(doc_id):
+            return
+        try:
+            with usage_scope("question_bank", doc_id):
+                bank = _ensure_bank(doc_id) or {}
+                generation = bank.get("generation")
+                if generation:
+                    started = time.monotonic()
+                    added = _fill(doc_id, generation)
+                    print(f"[QuestionBank] {doc_id}: added {added} items in {time.monotonic() - started:.1f}s")
+        finally:
+            _bank_store().delete(f"lease:{doc_id}")
+    except Exception as e:
+        print("[QuestionBank] Build failed for", doc_id, "=>", e)
+    finally:
+        with _building_lock:
+            _building.discard(doc_id)
+
+
+def schedule_fill(doc_id: str):
+    """Top the bank up in a background thread (at most one build per document per process,
+    and per cluster while the lease holds)."""
+    if not QUESTION_BANK_ENABLED or collection is None:
+        return
+    with _building_lock:
+        if doc_id in _building:
+            return
+        _building.add(doc_id)
+    threading.Thread(target=_run_build, args=(doc_id,), name="question-bank", daemon=True).start()
+
+
+def rebuild_bank(doc_id: str):
+    """Start a fresh bank for a (re)indexed document; older items and builds are discarded."""
+    if not QUESTION_BANK_ENABLED:
+        return
+    _bank_store().set(doc_id, _empty_bank(_new_generation()))
+    _bank_store().delete(_vectors_key(doc_id))
+    _bank_store().delete(f"lease:{doc_id}")
+    schedule_fill(doc_id)
+
+
+def drop_bank(doc_id: str):
+    if not QUESTION_BANK_ENABLED:
+        return
+    _bank_store().delete(doc_id)
+    _bank_store().delete(_vectors_key(doc_id))
+
+
+# ---- Serving ----
+def _spread_pick(items: list, n: int, group) -> list:
+    """n items, least served first, covering as many distinct groups as possible."""
+    items = list(items)
+    random.shuffle(items)
+    items.sort(key=lambda it: it.get("served", 0))
+    picked, picked_ids, groups = [], set(), set()
+    for distinct in (True, False):
+        for it in items:
+            if len(picked) >= n:
+                return picked
+            if it["id"] in picked_ids or (distinct and group(it) in groups):
+                continue
+            picked.append(it)
+            picked_ids.add(it["id"])
+            groups.add(group(it))
+    return picked
+
+
+def _serve(doc_id: str, field: str, n: int, match, group, public_fields: tuple):
+    if not QUESTION_BANK_ENABLED or n <= 0:
+        return None
+    bank = _bank_store().get(doc_id)
+    if not bank:
+        cache_lookup("question_bank", False)
+        if _ensure_bank(doc_id):
+            schedule_fill(doc_id)
+        return None
+    pool = [it for it in _fresh(bank.get(field, [])) if match(it)]
+    if len(pool) < n:
+        cache_lookup("question_bank", False)
+        schedule_fill(doc_id)
+        return None
+    picked = _spread_pick(pool, n, group)
+    picked_ids = {it["id"] for it in picked}
+    generation = bank["generation"]
+
+    def _mark(st):
+        if st.get("generation") != generation:
+            return st
+        items = []
+        for it in st.get(field, []):
+            if it["id"] in picked_ids:
+                it = dict(it, served=it.get("served", 0) + 1)
+            if it.get("served", 0) < QUESTION_BANK_MAX_SERVES:
+                items.append(it)
+        st[field] = items
+        return st
+
+    try:
+        bank = update_state(_bank_store(), doc_id, _mark, default=bank)
+    except Exception as e:
+        print("[QuestionBank] Failed to record servings for", doc_id, "=>", e)
+    if _is_low(bank):
+        schedule_fill(doc_id)
+    cache_lookup("question_bank", True)
+    return [{k: it[k] for k in public_fields if k in it} for it in picked]
+
+
+def sample_questions(doc_id: str, n: int, difficulty: str, qtypes: list):
+    """n banked questions of this difficulty and allowed types, or None when the bank cannot
+    serve the request (the caller generates live; a top-up is scheduled)."""
+    allowed = set(qtypes or QUESTION_TYPES)
+    if difficulty not in DIFFICULTIES or not allowed & set(QUESTION_TYPES):
+        return None
+    return _serve(
+        doc_id, "questions", n,
+        lambda q: q["difficulty"] == difficulty and q["type"] in allowed,
+        lambda q: (q["type"], q.get("source_chunk")),
+        ("type", "question", "options", "correct_answer", "explanation"),
+    )
+
+
+def sample_cards(doc_id: str, n: int):
+    """n banked flashcards, or None when the bank cannot serve the request."""
+    return _serve(
+        doc_id, "cards", n,
+        lambda c: True,
+        lambda c: c.get("source_chunk"),
+        ("front", "back", "category", "difficulty"),
+    )
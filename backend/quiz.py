@@ -1,5 +1,16 @@
 from flask import Blueprint, request, jsonify
+import json
 import re as _re
+from context_cache import cached_prompt
+from context_select import build_context
+from deadline import DeadlineExceeded
+from dedup import NearDuplicateFilter, suppress_duplicates
+from llm_client import LLMUnavailable, generate_content, generate_content_stream
+from streaming import JsonArrayStream, error_event, event_stream_response
+from usage import BudgetExceeded
+from metrics import JSON_REPAIR
+from question_bank import sample_questions
+from token_budget import context_budget, trim_to_tokens
 
 # Dependencies to be initialized from main.py
 collection = None
@@ -7,57 +18,194 @@ has_index = None
 fetch_doc_from_node = None
 extract_text_for_mimetype = None
 TEXT_MODEL = None
-genai = None
 
 
-def init_quiz(_collection, _has_index, _fetch_doc_from_node, _extract_text_for_mimetype, _TEXT_MODEL, _genai):
-    global collection, has_index, fetch_doc_from_node, extract_text_for_mimetype, TEXT_MODEL, genai
+def init_quiz(_collection, _has_index, _fetch_doc_from_node, _extract_text_for_mimetype, _TEXT_MODEL):
+    global collection, has_index, fetch_doc_from_node, extract_text_for_mimetype, TEXT_MODEL
     collection = _collection
     has_index = _has_index
     fetch_doc_from_node = _fetch_doc_from_node
     extract_text_for_mimetype = _extract_text_for_mimetype
     TEXT_MODEL = _TEXT_MODEL
-    genai = _genai
 
 
 quiz_bp = Blueprint("quiz", __name__)
 
-@quiz_bp.route("/api/document/generate-quiz", methods=["POST"])
-def generate_quiz():
-    """Generate a quiz based on the uploaded document content.
-    Request JSON:
-      - doc_id: string (required)
-      - num_questions: int (default 10)
-      - difficulty: str (easy|medium|hard)
-      - question_types: list[str] (subset of [mcq,true_false,short_answer])
-    Response JSON: { success, quiz: { questions: [...] } } or { success: false, error }
-    """
+QUIZ_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    # Tweakables (safe defaults)
+    "temperature": 0.4,
+    "max_output_tokens": 2048,
+}
+
+# Prompt the model to return a strict JSON quiz
+QUIZ_SYS_INSTR = (
+    "You are SmartDoc Quiz Generator. Given the document context, generate a quiz strictly about the content. "
+    "Return ONLY valid JSON with schema: {\n"
+    "  \"questions\": [\n"
+    "    {\n"
+    "      \"type\": \"mcq|true_false|short_answer\",\n"
+    "      \"question\": string,\n"
+    "      \"options\": [string, ...] (required for mcq only),\n"
+    "      \"correct_answer\": string,\n"
+    "      \"explanation\": string\n"
+    "    }\n"
+    "  ]\n"
+    "}\n"
+    "- Ensure there are exactly the requested number of questions.\n"
+    "- Ensure all questions are answerable using the context.\n"
+    "- For mcq, include 3-5 plausible options.\n"
+    "- For true_false, use the strings 'true' or 'false'.\n"
+    "- Keep explanations concise and factual.\n"
+)
+
+
+def _parse_json_safely(s: str):
+    if not s:
+        return None
+    try:
+        return json.loads(s)
+    except Exception:
+        # Try fenced code blocks ```json ... ```
+        m = _re.search(r"```(?:json)?\s*([\s\S]*?)```", s, _re.IGNORECASE)
+        if m:
+            inner = m.group(1).strip()
+            try:
+                return json.loads(inner)
+            except Exception:
+                pass
+        # Try last {...}
+        m2 = _re.search(r"\{[\s\S]*\}", s)
+        if m2:
+            try:
+                return json.loads(m2.group(0))
+            except Exception:
+                pass
+        return None
+
+
+def _repair_json(raw: str):
+    """Second pass asking the model to strictly convert its own output to JSON."""
+    try:
+        conv_prompt = (
+            "Convert the following content to valid JSON that matches this schema: "
+            "{\n  \"questions\": [\n    {\n      \"type\": \"mcq|true_false|short_answer\",\n      \"question\": string,\n      \"options\": [string] (for mcq only),\n      \"correct_answer\": string,\n      \"explanation\": string\n    }\n  ]\n}\n"
+            "Respond with JSON only, no extra text.\n\nContent to convert:\n" + (raw or "")
+        )
+        resp2 = generate_content(conv_prompt, TEXT_MODEL, QUIZ_GENERATION_CONFIG)
+        raw2 = (getattr(resp2, "text", "") or "").strip()
+        quiz = _parse_json_safely(raw2)
+        JSON_REPAIR.inc(endpoint="quiz", outcome="ok" if quiz is not None else "unparseable")
+        return quiz
+    except (LLMUnavailable, DeadlineExceeded, BudgetExceeded):
+        JSON_REPAIR.inc(endpoint="quiz", outcome="error")
+        raise
+    except Exception:
+        JSON_REPAIR.inc(endpoint="quiz", outcome="error")
+        return None
+
+
+def sanitize_question(q):
+    """Validate and normalise one model-produced question; None if it is unusable."""
+    if not isinstance(q, dict):
+        return None
+    qtype = str(q.get("type", "")).strip().lower()
+    if qtype not in ("mcq", "true_false", "short_answer"):
+        return None
+    question = str(q.get("question", "")).strip()
+    if not question:
+        return None
+    correct = q.get("correct_answer", "")
+    if qtype == "true_false":
+        correct = str(correct).strip().lower()
+        if correct not in ("true", "false"):
+            # Try to coerce booleans
+            if str(correct).strip().lower() in ("t", "yes", "y", "1"):
+                correct = "true"
+            elif str(correct).strip().lower() in ("f", "no", "n", "0"):
+                correct = "false"
+            else:
+                return None
+    else:
+        correct = str(correct).strip()
+        if not correct:
+            return None
+
+    item = {
+        "type": qtype,
+        "question": question,
+        "correct_answer": correct,
+        "explanation": str(q.get("explanation", "")).strip(),
+    }
+    if qtype == "mcq":
+        opts = q.get("options") or []
+        if not isinstance(opts, list):
+            opts = []
+        # Normalize options to strings and include the correct answer if missing
+        norm_opts = []
+        for o in opts:
+            s = str(o).strip()
+            if s:
+                norm_opts.append(s)
+        if str(correct) not in norm_opts:
+            norm_opts.append(str(correct))
+        # Ensure 3-5 options; dedupe while preserving order
+        seen = set()
+        dedup = []
+        for o in norm_opts:
+            if o not in seen:
+                dedup.append(o)
+                seen.add(o)
+        item["options"] = dedup[:5]
+        if len(item["options"]) < 3:
+            # Skip if insufficient options
+            return None
+
+    return item
+
+
+def _quiz_params():
     body = request.get_json(silent=True) or {}
     doc_id = (body.get("doc_id") or body.get("documentId") or "").strip()
-    if not doc_id:
-        return jsonify({"success": False, "error": "doc_id is required"}), 400
     try:
         num_questions = int(body.get("num_questions", 10))
     except Exception:
         num_questions = 10
     difficulty = (body.get("difficulty") or "medium").lower()
     qtypes = body.get("question_types") or ["mcq", "true_false", "short_answer"]
+    return doc_id, num_questions, difficulty, qtypes
+
+
+def _from_bank():
+    """Questions sampled from the document's pre-generated bank, or None to generate live
+    (bank not built yet, too few matching questions, or `"fresh": true` in the body)."""
+    body = request.get_json(silent=True) or {}
+    doc_id, num_questions, difficulty, qtypes = _quiz_params()
+    if not doc_id or body.get("fresh"):
+        return None
+    return sample_questions(doc_id, num_questions, difficulty, qtypes)
+
+
+def _prepare_quiz_request():
+    """Validate the request body and build the prompt. Returns a dict with num_questions,
+    contents and cached (see context_cache.cached_prompt), or an error response to return as is."""
+    doc_id, num_questions, difficulty, qtypes = _quiz_params()
+    if not doc_id:
+        return jsonify({"success": False, "error": "doc_id is required"}), 400
 
     # Build context from indexed chunks if available; else fetch raw text
     context = ""
     try:
         if has_index(doc_id):
-            res = collection.get(where={"doc_id": doc_id}, include=["documents"], limit=500)
-            docs = (res or {}).get("documents") or []
-            # flatten if nested
-            if docs and isinstance(docs[0], list):
-                docs = docs[0]
-            context = "\n\n".join(docs)
+            # One representative chunk per topic across the whole document, within budget.
+            context = build_context(collection, doc_id, context_budget("quiz"))
         else:
             ok, filename, mimetype, data_bytes = fetch_doc_from_node(doc_id)
             if not ok:
                 return jsonify({"success": False, "error": filename}), 404
-            context = extract_text_for_mimetype(filename, mimetype, data_bytes)
+            context = trim_to_tokens(extract_text_for_mimetype(filename, mimetype, data_bytes), context_budget("quiz"))
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"success": False, "error": f"Failed to load document: {e}"}), 500
 
@@ -65,50 +213,42 @@ def generate_quiz():
     if not context:
         return jsonify({"success": False, "error": "Document has no readable text"}), 400
 
-    # Prompt the model to return a strict JSON quiz
-    sys_instr = (
-        "You are SmartDoc Quiz Generator. Given the document context, generate a quiz strictly about the content. "
-        "Return ONLY valid JSON with schema: {\n"
-        "  \"questions\": [\n"
-        "    {\n"
-        "      \"type\": \"mcq|true_false|short_answer\",\n"
-        "      \"question\": string,\n"
-        "      \"options\": [string, ...] (required for mcq only),\n"
-        "      \"correct_answer\": string,\n"
-        "      \"explanation\": string\n"
-        "    }\n"
-        "  ]\n"
-        "}\n"
-        "- Ensure there are exactly the requested number of questions.\n"
-        "- Ensure all questions are answerable using the context.\n"
-        "- For mcq, include 3-5 plausible options.\n"
-        "- For true_false, use the strings 'true' or 'false'.\n"
-        "- Keep explanations concise and factual.\n"
-    )
-    user_instr = (
-        f"Difficulty: {difficulty}. Number of questions: {num_questions}. Allowed types: {', '.join(qtypes)}.\n\n"
-        "Document Context:\n" + context[:12000]
+    # The document block goes last and unchanged between requests so it can be served from the
+    # context cache; only the short request line differs per call.
+    contents, cached = cached_prompt(
+        doc_id,
+        QUIZ_SYS_INSTR,
+        "Document Context:\n" + context,
+        f"Difficulty: {difficulty}. Number of questions: {num_questions}. Allowed types: {', '.join(qtypes)}.",
+        TEXT_MODEL,
     )
+    return {"num_questions": num_questions, "contents": contents, "cached": cached}
 
-    try:
-        # Prefer structured JSON responses if supported by the SDK
-        model = None
-        try:
-            model = genai.GenerativeModel(
-                TEXT_MODEL,
-                generation_config={
-                    # Ask Gemini to return JSON only. If unsupported, fallback below.
-                    "response_mime_type": "application/json",
-                    # Tweakables (safe defaults)
-                    "temperature": 0.4,
-                    "max_output_tokens": 2048,
-                },
-            )
-        except Exception:
-            model = genai.GenerativeModel(TEXT_MODEL)
 
-        # Avoid hanging requests: limit to ~30s per generate
-        resp = model.generate_content([sys_instr, user_instr], request_options={"timeout": 30})
+@quiz_bp.route("/api/document/generate-quiz", methods=["POST"])
+def generate_quiz():
+    """Generate a quiz based on the uploaded document content.
+    Request JSON:
+      - doc_id: string (required)
+      - num_questions: int (default 10)
+      - difficulty: str (easy|medium|hard)
+      - question_types: list[str] (subset of [mcq,true_false,short_answer])
+      - fresh: bool (default false; skip the question bank)
+    Response JSON: { success, quiz: { questions: [...] }, source: "bank"|"live" } or { success: false, error }
+    """
+    banked = _from_bank()
+    if banked is not None:
+        return jsonify({"success": True, "quiz": {"questions": banked}, "source": "bank"})
+
+    prepared = _prepare_quiz_request()
+    if not isinstance(prepared, dict):
+        return prepared
+    num_questions = prepared["num_questions"]
+
+    try:
+        # Ask Gemini to return JSON only; the shared client falls back to a plain model if unsupported.
+        resp = generate_content(prepared["contents"], TEXT_MODEL, QUIZ_GENERATION_CONFIG,
+                                cached_context=prepared["cached"])
 
         # Extract text safely from response
         raw = ""
@@ -117,111 +257,98 @@ def generate_quiz():
         except Exception:
             raw = ""
 
-        import json
-
-        def _parse_json_safely(s: str):
-            if not s:
-                return None
-            try:
-                return json.loads(s)
-            except Exception:
-                # Try fenced code blocks ```json ... ```
-                m = _re.search(r"```(?:json)?\s*([\s\S]*?)```", s, _re.IGNORECASE)
-                if m:
-                    inner = m.group(1).strip()
-                    try:
-                        return json.loads(inner)
-                    except Exception:
-                        pass
-                # Try last {...}
-                m2 = _re.search(r"\{[\s\S]*\}", s)
-                if m2:
-                    try:
-                        return json.loads(m2.group(0))
-                    except Exception:
-                        pass
-                return None
-
         quiz = _parse_json_safely(raw)
         if quiz is None:
             # Fallback: attempt a second pass asking the model to strictly convert to JSON
-            try:
-                conv_prompt = (
-                    "Convert the following content to valid JSON that matches this schema: "
-                    "{\n  \"questions\": [\n    {\n      \"type\": \"mcq|true_false|short_answer\",\n      \"question\": string,\n      \"options\": [string] (for mcq only),\n      \"correct_answer\": string,\n      \"explanation\": string\n    }\n  ]\n}\n"
-                    "Respond with JSON only, no extra text.\n\nContent to convert:\n" + (raw or "")
-                )
-                resp2 = model.generate_content(conv_prompt, request_options={"timeout": 20})
-                raw2 = (getattr(resp2, "text", "") or "").strip()
-                quiz = _parse_json_safely(raw2)
-            except Exception:
-                quiz = None
+            quiz = _repair_json(raw)
 
         if not isinstance(quiz, dict) or "questions" not in quiz or not isinstance(quiz.get("questions"), list):
             return jsonify({"success": False, "error": "Model did not return valid JSON quiz. Please try again."}), 502
 
-        # Basic sanitize and trim
+        # Basic sanitize, drop near-duplicate questions, then trim
         qs = []
-        for q in quiz.get("questions", [])[: num_questions]:
-            if not isinstance(q, dict):
-                continue
-            qtype = str(q.get("type", "")).strip().lower()
-            if qtype not in ("mcq", "true_false", "short_answer"):
-                continue
-            question = str(q.get("question", "")).strip()
-            if not question:
-                continue
-            correct = q.get("correct_answer", "")
-            if qtype == "true_false":
-                correct = str(correct).strip().lower()
-                if correct not in ("true", "false"):
-                    # Try to coerce booleans
-                    if str(correct).strip().lower() in ("t", "yes", "y", "1"):
-                        correct = "true"
-                    elif str(correct).strip().lower() in ("f", "no", "n", "0"):
-                        correct = "false"
-                    else:
-                        continue
-            else:
-                correct = str(correct).strip()
-                if not correct:
-                    continue
-
-            item = {
-                "type": qtype,
-                "question": question,
-                "correct_answer": correct,
-                "explanation": str(q.get("explanation", "")).strip(),
-            }
-            if qtype == "mcq":
-                opts = q.get("options") or []
-                if not isinstance(opts, list):
-                    opts = []
-                # Normalize options to strings and include the correct answer if missing
-                norm_opts = []
-                for o in opts:
-                    s = str(o).strip()
-                    if s:
-                        norm_opts.append(s)
-                if str(correct) not in norm_opts:
-                    norm_opts.append(str(correct))
-                # Ensure 3-5 options; dedupe while preserving order
-                seen = set()
-                dedup = []
-                for o in norm_opts:
-                    if o not in seen:
-                        dedup.append(o)
-                        seen.add(o)
-                item["options"] = dedup[:5]
-                if len(item["options"]) < 3:
-                    # Skip if insufficient options
-                    continue
-
-            qs.append(item)
+        for q in quiz.get("questions", []):
+            item = sanitize_question(q)
+            if item is not None:
+                qs.append(item)
 
+        qs = [qs[i] for i in suppress_duplicates([q["question"] for q in qs], endpoint="quiz")][: num_questions]
         if not qs:
             return jsonify({"success": False, "error": "No valid questions could be constructed from the model output."}), 502
 
-        return jsonify({"success": True, "quiz": {"questions": qs}})
+        return jsonify({"success": True, "quiz": {"questions": qs}, "source": "live"})
+    except (DeadlineExceeded, BudgetExceeded):
+        raise
+    except LLMUnavailable as e:
+        return jsonify({"success": False, "error": f"Quiz generation unavailable: {e}"}), 503
     except Exception as e:
         return jsonify({"success": False, "error": f"Quiz generation failed: {e}"}), 500
+
+
+
+@quiz_bp.route("/api/document/generate-quiz/stream", methods=["POST"])
+def generate_quiz_stream():
+    """Streaming variant of generate-quiz (same request body). Each question is sent as soon
+    as the model has finished writing it, one JSON event per line (SSE when the client sends
+    `Accept: text/event-stream`):
+      {"type": "question", "index": i, "question": {...}}
+      {"type": "done", "count": n}  or  {"type": "error", "status": code, "error": msg}
+    Request errors (missing doc_id, unknown document) are plain JSON responses as before.
+    Banked questions (see generate-quiz) are all sent at once.
+    """
+    banked = _from_bank()
+    if banked is not None:
+        return event_stream_response(
+            [{"type": "question", "index": i, "question": q} for i, q in enumerate(banked)]
+            + [{"type": "done", "count": len(banked), "source": "bank"}]
+        )
+
+    prepared = _prepare_quiz_request()
+    if not isinstance(prepared, dict):
+        return prepared
+    return event_stream_response(_quiz_events(prepared))
+
+
+def _quiz_events(prepared: dict):
+    num_questions = prepared["num_questions"]
+    parser = JsonArrayStream("questions")
+    # Only the MinHash pass while streaming; the batch embedding pass would hold every line back.
+    seen = NearDuplicateFilter(endpoint="quiz")
+    sent = 0
+
+    def _accept(q):
+        item = sanitize_question(q)
+        if item is None or not seen.admit(item["question"]):
+            return None
+        return {"type": "question", "index": sent, "question": item}
+
+    try:
+        stream = generate_content_stream(prepared["contents"], TEXT_MODEL, QUIZ_GENERATION_CONFIG,
+                                         cached_context=prepared["cached"])
+        for fragment in stream:
+            for q in parser.feed(fragment):
+                event = _accept(q)
+                if event and sent < num_questions:
+                    yield event
+                    sent += 1
+            if sent >= num_questions or parser.done:
+                stream.close()
+                break
+
+        if sent == 0:
+            # Nothing usable came out incrementally: parse the whole output, repairing if needed.
+            quiz = _parse_json_safely(parser.text.strip())
+            if quiz is None:
+                quiz = _repair_json(parser.text)
+            for q in (quiz.get("questions") if isinstance(quiz, dict) else None) or []:
+                event = _accept(q)
+                if event and sent < num_questions:
+                    yield event
+                    sent += 1
+
+        if sent == 0:
+            yield {"type": "error", "status": 502, "error": "No valid questions could be constructed from the model output."}
+        else:
+            yield {"type": "done", "count": sent}
+    except Exception as e:
+        yield error_event(e, "Quiz generation")
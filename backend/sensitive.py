@@ -0,0 +1,139 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+# ====== SENSITIVE DATA SCANNER ======
+# One combined pattern walks the text once. Numeric runs are captured as a single
+# candidate and classified afterwards (ssn / aadhaar / card / phone), so the digits
+# are not re-scanned by one regex per category.
+#
+# Compared with the six independent regexes this replaced, these baseline matches are
+# intentionally no longer reported:
+# - A number counts once, in its first matching category (ssn_like, aadhaar, credit_card,
+#   phone). The old patterns counted e.g. every 12-digit run as aadhaar and as credit_card.
+# - Aadhaar numbers must pass the Verhoeff check and start with 2-9; card numbers must have
+#   13-19 digits and pass the Luhn check. Arbitrary 12-19 digit runs (order numbers, ISBNs,
+#   invoice ids) were flagged before.
+# - Digits may only be separated by a space or a hyphen, not by tabs or newlines, so numbers
+#   from adjacent table cells or lines no longer join into one match.
+# - A run is at most 19 digits, cut at its last word boundary. If the cut run is not an
+#   SSN, Aadhaar, card or phone number, nothing is reported and its remaining digits are not
+#   rescanned: "1234 5678 9012 3456 7890" was flagged (credit_card, aadhaar) and now is not.
+
+CATEGORIES = ("email", "phone", "credit_card", "pan", "aadhaar", "ssn_like")
+
+_SCANNER = re.compile(
+    r"(?P<email>\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b)"
+    r"|(?P<pan>\b[A-Z]{5}\d{4}[A-Z]\b)"
+    r"|(?P<num>(?<![\w+])\+?\d(?:[ -]?\d){8,18}\b)"
+)
+
+_SSN = re.compile(r"\d{3}-\d{2}-\d{4}")
+_AADHAAR = re.compile(r"[2-9]\d{3}[ -]?\d{4}[ -]?\d{4}")
+_CARD = re.compile(r"(?:\d[ -]?){12,18}\d")
+_PHONE = re.compile(r"(?:\+?\d{1,3}[ -]?)?(?:\d{3}[ -]?){2}\d{4}")
+
+_VERHOEFF_D = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 2, 3, 4, 0, 6, 7, 8, 9, 5),
+    (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7),
+    (4, 0, 1, 2, 3, 9, 5, 6, 7, 8),
+    (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2),
+    (7, 6, 5, 9, 8, 2, 1, 0, 4, 3),
+    (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0),
+)
+_VERHOEFF_P = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 5, 7, 6, 2, 8, 3, 0, 9, 4),
+    (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7),
+    (9, 4, 5, 3, 1, 2, 6, 8, 7, 0),
+    (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5),
+    (7, 0, 4, 6, 9, 1, 3, 2, 5, 8),
+)
+
+
+def luhn_valid(digits: str) -> bool:
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        n = ord(ch) - 48
+        if i % 2 == 1:
+            n *= 2
+            if n > 9:
+                n -= 9
+        total += n
+    return total % 10 == 0
+
+
+def verhoeff_valid(digits: str) -> bool:
+    c = 0
+    for i, ch in enumerate(reversed(digits)):
+        c = _VERHOEFF_D[c][_VERHOEFF_P[i % 8][ord(ch) - 48]]
+    return c == 0
+
+
+def _classify_number(run: str):
+    """Map a numeric run to a category, validating checksums where the format has one."""
+    if _SSN.fullmatch(run):
+        return "ssn_like"
+    digits = "".join(ch for ch in run if ch.isdigit())
+    if _AADHAAR.fullmatch(run) and verhoeff_valid(digits):
+        return "aadhaar"
+    if 13 <= len(digits) <= 19 and _CARD.fullmatch(run) and luhn_valid(digits):
+        return "credit_card"
+    if _PHONE.search(run):
+        return "phone"
+    return None
+
+
+def scan_sensitive(text: str, max_hits: int = 0) -> dict:
+    """Scan text once and count hits per category.
+    - max_hits > 0 stops the scan after that many hits in total (enough for a yes/no gate).
+    Returns { "found": bool, "matches": { category: count } }.
+    """
+    matches = {}
+    if text:
+        total = 0
+        for m in _SCANNER.finditer(text):
+            kind = m.lastgroup
+            if kind == "num":
+                kind = _classify_number(m.group(kind))
+                if not kind:
+                    continue
+            matches[kind] = matches.get(kind, 0) + 1
+            total += 1
+            if max_hits and total >= max_hits:
+                break
+    return {"found": bool(matches), "matches": matches}
+
+
+# ---- Result cache keyed by content hash ----
+SCAN_CACHE_SIZE = 256
+_scan_cache = OrderedDict()
+_scan_cache_lock = threading.Lock()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8", errors="ignore")).hexdigest()
+
+
+def cached_scan(text: str) -> tuple:
+    """Return (summary, cache_hit). Full scans only; the same text is never scanned twice."""
+    key = content_hash(text)
+    with _scan_cache_lock:
+        hit = _scan_cache.get(key)
+        if hit is not None:
+            _scan_cache.move_to_end(key)
+            return {"found": hit["found"], "matches": dict(hit["matches"])}, True
+    summary = scan_sensitive(text)
+    with _scan_cache_lock:
+        _scan_cache[key] = summary
+        _scan_cache.move_to_end(key)
+        while len(_scan_cache) > SCAN_CACHE_SIZE:
+            _scan_cache.popitem(last=False)
+    return {"found": summary["found"], "matches": dict(summary["matches"])}, False
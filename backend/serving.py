@@ -0,0 +1,43 @@
+import contextvars
+import os
+
+# ====== SERVING MODE ======
+# SERVING_MODE=threads (default): gunicorn gthread workers, one OS thread per in-flight request.
+# SERVING_MODE=gevent: gunicorn gevent workers. Sockets are monkey-patched, so every wait on
+# Gemini (REST transport) or the Node API yields to other requests and hundreds of in-flight
+# calls fit in one process. CPU-bound work (PDF/DOCX extraction, Word->PDF conversion) is
+# pushed to the hub's native thread pool so it cannot stall the event loop.
+
+SERVING_MODE = os.environ.get("SERVING_MODE", "threads").strip().lower()
+CPU_POOL_SIZE = int(os.environ.get("CPU_POOL_SIZE", "4"))
+
+
+def is_gevent_mode() -> bool:
+    if SERVING_MODE != "gevent":
+        return False
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched("socket")
+    except Exception:
+        return False
+
+
+def genai_transport():
+    """The gRPC transport blocks the gevent hub; REST goes through patched sockets."""
+    override = os.environ.get("GEMINI_TRANSPORT", "").strip().lower()
+    if override:
+        return override
+    return "rest" if SERVING_MODE == "gevent" else None
+
+
+def run_cpu_bound(fn, *args):
+    """Run fn(*args) on a native thread under gevent; call it inline otherwise."""
+    if not is_gevent_mode():
+        return fn(*args)
+    from gevent import get_hub
+    pool = get_hub().threadpool
+    if pool.maxsize < CPU_POOL_SIZE:
+        pool.maxsize = CPU_POOL_SIZE
+    # Carry the request context (Flask g, deadline) over to the native thread.
+    ctx = contextvars.copy_context()
+    return pool.apply(ctx.run, (fn,) + args)
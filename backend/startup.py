@@ -0,0 +1,92 @@
+import importlib
+import os
+import threading
+import time
+
+# ====== STARTUP / WARM-UP TRACKING ======
+# Heavy third-party modules (chromadb, google.generativeai, PyPDF2, python-docx) are imported
+# on first use or by a background warm-up thread, so importing main stays cheap and /healthz
+# answers immediately. Every timed import and warm-up step is recorded here and reported by
+# /readyz.
+
+PROCESS_START = time.time()
+WARMUP_ENABLED = os.environ.get("WARMUP", "true").lower() == "true"
+
+_lock = threading.Lock()
+IMPORT_TIMES = {}
+SUBSYSTEMS = {}
+_warmup_started_pid = None
+
+
+def import_timed(name: str):
+    """importlib.import_module that records how long the first import took."""
+    if name in IMPORT_TIMES:
+        return importlib.import_module(name)
+    start = time.perf_counter()
+    mod = importlib.import_module(name)
+    with _lock:
+        IMPORT_TIMES.setdefault(name, round(time.perf_counter() - start, 4))
+    return mod
+
+
+class LazyModule:
+    """Module stand-in that imports the real module on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._mod = None
+
+    def __getattr__(self, attr):
+        if self._mod is None:
+            self._mod = import_timed(self._name)
+        return getattr(self._mod, attr)
+
+
+def mark_warm(name: str, seconds: float = None, error: str = None):
+    with _lock:
+        SUBSYSTEMS[name] = {
+            "warm": error is None,
+            "seconds": round(seconds, 4) if seconds is not None else None,
+            "error": error,
+        }
+
+
+def is_warm(name: str) -> bool:
+    return bool(SUBSYSTEMS.get(name, {}).get("warm"))
+
+
+def run_step(name: str, fn):
+    start = time.perf_counter()
+    try:
+        fn()
+        mark_warm(name, time.perf_counter() - start)
+    except Exception as e:
+        mark_warm(name, time.perf_counter() - start, str(e))
+        print(f"[Startup] Warm-up step '{name}' failed:", e)
+
+
+def start_warmup(steps: list):
+    """Run [(name, fn), ...] once per process on a daemon thread."""
+    global _warmup_started_pid
+    with _lock:
+        if _warmup_started_pid == os.getpid():
+            return
+        _warmup_started_pid = os.getpid()
+
+    def _run():
+        for name, fn in steps:
+            run_step(name, fn)
+        print("[Startup] Warm-up finished:", startup_report())
+
+    threading.Thread(target=_run, name="warmup", daemon=True).start()
+
+
+def startup_report() -> dict:
+    with _lock:
+        imports = dict(sorted(IMPORT_TIMES.items(), key=lambda kv: kv[1], reverse=True))
+        subsystems = {k: dict(v) for k, v in SUBSYSTEMS.items()}
+    return {
+        "uptime_sec": round(time.time() - PROCESS_START, 3),
+        "imports_sec": imports,
+        "subsystems": subsystems,
+    }
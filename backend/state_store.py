@@ -0,0 +1,194 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# ====== SHARED STATE STORE ======
+# Small key/value store for per-document conversational state (consent y/n, general-knowledge
+# fallback, preview paths) that must be visible to every gunicorn worker and host that shares
+# the disk. STATE_STORE=sqlite (default) keeps it in a WAL-mode SQLite file; STATE_STORE=memory
+# keeps it in-process (tests, single-worker dev).
+
+STATE_STORE = os.environ.get("STATE_STORE", "sqlite").strip().lower()
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", os.path.join(os.getcwd(), "state_db", "state.sqlite3"))
+# Reads may be served from a per-process cache for this long; writes and CAS always go to the DB.
+STATE_LOCAL_CACHE_SEC = float(os.environ.get("STATE_LOCAL_CACHE_SEC", "1.0"))
+
+
+def _encode(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+class MemoryStateStore:
+    """In-process store with the same API as SqliteStateStore."""
+
+    def __init__(self, namespace: str, default_ttl: float = None):
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _expires(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._live(key)
+            return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (_encode(value), self._expires(ttl))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def compare_and_set(self, key: str, expected, new, ttl: float = None) -> bool:
+        """Write `new` only if the current value equals `expected` (None = key absent)."""
+        with self._lock:
+            current = self._live(key)
+            if current != (None if expected is None else _encode(expected)):
+                return False
+            self._data[key] = (_encode(new), self._expires(ttl))
+            return True
+
+    def invalidate(self, key: str):
+        pass
+
+
+class SqliteStateStore:
+    """SQLite (WAL) store shared by every process that opens the same file."""
+
+    _local = threading.local()
+
+    def __init__(self, namespace: str, path: str = STATE_DB_PATH, default_ttl: float = None):
+        self.namespace = namespace
+        self.path = os.path.abspath(path)
+        self.default_ttl = default_ttl
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " ns TEXT NOT NULL, k TEXT NOT NULL, v TEXT NOT NULL, expires_at REAL,"
+            " PRIMARY KEY (ns, k))"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread and process; a connection inherited across fork is unusable.
+        conns = getattr(self._local, "conns", None)
+        if conns is None or self._local.pid != os.getpid():
+            conns = self._local.conns = {}
+            self._local.pid = os.getpid()
+        conn = conns.get(self.path)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conns[self.path] = conn
+        return conn
+
+    def _expires(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def _cache_put(self, key, raw):
+        with self._cache_lock:
+            self._cache[key] = (raw, time.monotonic() + STATE_LOCAL_CACHE_SEC)
+
+    def _read_raw(self, key: str):
+        row = self._conn().execute(
+            "SELECT v FROM state WHERE ns=? AND k=? AND (expires_at IS NULL OR expires_at > ?)",
+            (self.namespace, key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get(self, key: str):
+        with self._cache_lock:
+            hit = self._cache.get(key)
+        if hit is not None and hit[1] > time.monotonic():
+            raw = hit[0]
+        else:
+            raw = self._read_raw(key)
+            self._cache_put(key, raw)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value, ttl: float = None):
+        raw = _encode(value)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO state (ns, k, v, expires_at) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, raw, self._expires(ttl)),
+        )
+        self._cache_put(key, raw)
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM state WHERE ns=? AND k=?", (self.namespace, key))
+        self._cache_put(key, None)
+
+    def compare_and_set(self, key: str, expected, new, ttl: float = None) -> bool:
+        """Write `new` only if the stored value equals `expected` (None = key absent or expired)."""
+        conn = self._conn()
+        raw_new = _encode(new)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = self._read_raw(key)
+            if current != (None if expected is None else _encode(expected)):
+                conn.execute("COMMIT")
+                self._cache_put(key, current)
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO state (ns, k, v, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, raw_new, self._expires(ttl)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._cache_put(key, raw_new)
+        return True
+
+    def invalidate(self, key: str):
+        """Drop the local cached copy so the next get() reads the database."""
+        with self._cache_lock:
+            self._cache.pop(key, None)
+
+    def purge_expired(self):
+        self._conn().execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+
+def open_store(namespace: str, default_ttl: float = None):
+    if STATE_STORE == "memory":
+        return MemoryStateStore(namespace, default_ttl)
+    try:
+        store = SqliteStateStore(namespace, STATE_DB_PATH, default_ttl)
+        store.purge_expired()
+        return store
+    except Exception as e:
+        print(f"[State] SQLite store unavailable at {STATE_DB_PATH} => {e}; using in-memory store for '{namespace}'")
+        return MemoryStateStore(namespace, default_ttl)
+
+
+def update_state(store, key: str, fn, default=None, ttl: float = None, attempts: int = 10):
+    """Atomic read-modify-write: new = fn(current or default), retried on concurrent change.
+    Returns the value that was written."""
+    for _ in range(attempts):
+        current = store.get(key)
+        new = fn(dict(current) if current is not None else (dict(default) if default is not None else {}))
+        if store.compare_and_set(key, current, new, ttl):
+            return new
+        # Someone else wrote in between; drop any cached copy and try again.
+        store.invalidate(key)
+    raise RuntimeError(f"State update for {store.namespace}:{key} kept conflicting")
@@ -0,0 +1,140 @@
+import json
+import re
+
+from flask import Response, request, stream_with_context
+
+from deadline import DeadlineExceeded
+from llm_client import LLMUnavailable
+from usage import BudgetExceeded
+
+# ====== STREAMED GENERATION ======
+# The streaming quiz/flashcard endpoints read the model's output as it is produced.
+# JsonArrayStream picks the objects of one JSON array ("questions" / "flashcards") out of the
+# partial text as soon as each object closes, so every item can be sanitized and sent to the
+# client while the rest is still being generated. Events go out as NDJSON lines, or as SSE
+# when the client sends `Accept: text/event-stream`.
+
+
+class JsonArrayStream:
+    """Incremental parser for the objects of the array under `key` in a streamed JSON document.
+
+    feed() takes the next text fragment and returns the objects completed by it (dicts).
+    A bare top-level array and ```json fences are accepted too. Objects that do not parse are
+    skipped and counted in `skipped`."""
+
+    def __init__(self, key: str):
+        self._opening = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self._buf = ""
+        self._pos = 0
+        self._in_array = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._start = None
+        self.text = ""  # everything fed so far, for the non-streaming fallback
+        self.emitted = 0
+        self.skipped = 0
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def _find_array(self) -> bool:
+        m = self._opening.search(self._buf)
+        if m:
+            self._pos = m.end()
+        else:
+            stripped = re.sub(r"^\s*```(?:json)?\s*", "", self._buf)
+            if not stripped.startswith("["):
+                return False
+            self._pos = len(self._buf) - len(stripped) + 1
+        self._in_array = True
+        return True
+
+    def feed(self, fragment: str) -> list:
+        if not fragment or self._done:
+            return []
+        self.text += fragment
+        self._buf += fragment
+        if not self._in_array and not self._find_array():
+            return []
+
+        out = []
+        buf = self._buf
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if self._depth == 0 and ch == "{":
+                    self._start = i
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 0:
+                    # The array itself closed.
+                    self._done = True
+                    break
+                self._depth -= 1
+                if self._depth == 0 and self._start is not None:
+                    try:
+                        obj = json.loads(buf[self._start:i + 1])
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        out.append(obj)
+                        self.emitted += 1
+                    else:
+                        self.skipped += 1
+                    self._start = None
+            i += 1
+
+        # Keep only what an unfinished object still needs.
+        keep_from = self._start if self._start is not None else i
+        self._buf = buf[keep_from:]
+        self._pos = i - keep_from
+        if self._start is not None:
+            self._start = 0
+        return out
+
+
+def error_event(e: Exception, what: str) -> dict:
+    """The error line ending a stream; mirrors the status codes of the non-streaming routes
+    (headers are already sent, so the status travels in the event)."""
+    if isinstance(e, DeadlineExceeded):
+        print("Deadline exceeded:", request.endpoint, "stage:", e.stage)
+        return {"type": "error", "status": 504, "error": "Request timed out. Please try again.", "stage": e.stage}
+    if isinstance(e, BudgetExceeded):
+        return {"type": "error", "status": 429, "error": str(e), "budget": e.scope, "retryAfter": e.retry_after}
+    if isinstance(e, LLMUnavailable):
+        return {"type": "error", "status": 503, "error": f"{what} unavailable: {e}"}
+    return {"type": "error", "status": 500, "error": f"{what} failed: {e}"}
+
+
+def wants_sse() -> bool:
+    return "text/event-stream" in (request.headers.get("Accept") or "")
+
+
+def event_stream_response(events) -> Response:
+    """Stream an iterable of event dicts as NDJSON (default) or SSE. The request context stays
+    open until the iterable is exhausted, so g.deadline and admission slots cover the stream."""
+    sse = wants_sse()
+
+    def _encode():
+        for event in events:
+            line = json.dumps(event, ensure_ascii=False)
+            yield f"data: {line}\n\n" if sse else line + "\n"
+
+    return Response(
+        stream_with_context(_encode()),
+        mimetype="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
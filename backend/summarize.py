@@ -1,6 +1,10 @@
 from flask import Blueprint, request, jsonify
 import re
-from typing import List, Tuple, Optional
+from typing import List
+from deadline import DeadlineExceeded
+from llm_client import LLMUnavailable, generate_content
+from token_budget import MIN_PARTIAL_TOKENS, SEPARATOR_TOKENS, context_budget, estimate_tokens, trim_to_tokens
+from usage import BudgetExceeded
 
 
 summarize_bp = Blueprint("summarize", __name__)
@@ -27,33 +31,54 @@ def _clean_selection_text(text: str) -> str:
     return t.strip()
 
 
-def _chunk_text(text: str, size: int = 1600, overlap: int = 200) -> List[str]:
+def _tail(text: str, budget_tokens: int) -> str:
+    """Trailing sentences of text within budget_tokens (the overlap carried into the next window)."""
+    out, used = [], 0
+    for sentence in reversed(re.split(r"(?<=[.!?])\s+", text)):
+        n = estimate_tokens(sentence)
+        if used + n > budget_tokens:
+            break
+        out.insert(0, sentence)
+        used += n
+    return " ".join(out)
+
+
+def _chunk_text(text: str, budget_tokens: int = None, overlap_tokens: int = 50) -> List[str]:
     """Chunk text with paragraph awareness, similar to main.chunk_text but self-contained.
-    Keeps a small overlap so map-reduce summaries retain continuity.
+    Windows are filled up to budget_tokens (the "summarize" context budget); a paragraph that
+    does not fit is split on a sentence boundary and continues in the next window. Keeps the
+    last sentences of each window as a small overlap so map-reduce summaries retain continuity.
     """
     text = (text or "").strip()
     if not text:
         return []
-    paras = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
-    if not paras:
-        paras = [text]
-    windows, buf, cur = [], [], 0
-    for p in paras:
-        plen = len(p) + 2
-        if not buf or cur + plen <= size:
-            buf.append(p)
-            cur += plen
-        else:
-            joined = "\n\n".join(buf)
-            windows.append(joined)
-            if overlap > 0 and len(joined) > overlap:
-                tail = joined[-overlap:]
-                buf = [tail, p]
-                cur = len(tail) + plen
-            else:
-                buf = [p]
-                cur = plen
-    if buf:
+    budget_tokens = budget_tokens or context_budget("summarize")
+    overlap_tokens = min(overlap_tokens, budget_tokens // 4)
+    windows, buf, cur, fresh = [], [], 0, False  # fresh: buf holds more than the overlap
+
+    def _flush():
+        joined = "\n\n".join(buf)
+        windows.append(joined)
+        tail = _tail(joined, overlap_tokens) if overlap_tokens > 0 else ""
+        return ([tail], estimate_tokens(tail)) if tail and tail != joined else ([], 0)
+
+    for p in re.split(r"\n\s*\n", text):
+        p = p.strip()
+        while p:
+            room = budget_tokens - cur - (SEPARATOR_TOKENS if buf else 0)
+            n = estimate_tokens(p)
+            if n <= room:
+                buf.append(p)
+                cur += n + (SEPARATOR_TOKENS if len(buf) > 1 else 0)
+                fresh = True
+                break
+            piece = trim_to_tokens(p, max(1, room)) if room >= MIN_PARTIAL_TOKENS or not fresh else ""
+            if piece:
+                buf.append(piece)
+                p = p[len(piece):].strip()
+            buf, cur = _flush()
+            fresh = False
+    if fresh:
         windows.append("\n\n".join(buf))
     return windows
 
@@ -75,16 +100,15 @@ Summary:
 """
 
 
-def _map_reduce_summary(genai, model_name: str, selection: str, style: str, bullets: bool) -> str:
-    model = genai.GenerativeModel(model_name)
+def _map_reduce_summary(model_name: str, selection: str, style: str, bullets: bool) -> str:
     chunks = _chunk_text(selection)
     if len(chunks) <= 1:
-        resp = model.generate_content(_build_prompt(selection, style, bullets), request_options={"timeout": 30})
+        resp = generate_content(_build_prompt(selection, style, bullets), model_name)
         return (getattr(resp, "text", "") or "").strip()
 
     partials = []
     for ch in chunks:
-        r = model.generate_content(_build_prompt(ch, style, bullets), request_options={"timeout": 30})
+        r = generate_content(_build_prompt(ch, style, bullets), model_name)
         partials.append((getattr(r, "text", "") or "").strip())
 
     # Reduce step
@@ -98,12 +122,12 @@ Partials:\n\n{combined}
 
 Final summary:
 """
-    final = model.generate_content(reduce_prompt, request_options={"timeout": 30})
+    final = generate_content(reduce_prompt, model_name)
     return (getattr(final, "text", "") or "").strip()
 
 
-def init_summarizer(TEXT_MODEL: str, genai_module):
-    """Initialize routes with provided model config. Call from main.py after genai.configure()."""
+def init_summarizer(TEXT_MODEL: str):
+    """Initialize routes with provided model config. Call from main.py after init_llm_client()."""
 
     @summarize_bp.route("/api/summarize", methods=["POST"])
     def summarize_endpoint():
@@ -120,7 +144,7 @@ def init_summarizer(TEXT_MODEL: str, genai_module):
 
         cleaned = _clean_selection_text(selection_text)
         try:
-            summary = _map_reduce_summary(genai_module, TEXT_MODEL, cleaned, style, bullets)
+            summary = _map_reduce_summary(TEXT_MODEL, cleaned, style, bullets)
             if not summary:
                 return jsonify({"error": "Failed to summarize"}), 500
             return jsonify({
@@ -129,6 +153,10 @@ def init_summarizer(TEXT_MODEL: str, genai_module):
                 "pages": pages,
                 "length": len(cleaned),
             })
+        except (DeadlineExceeded, BudgetExceeded):
+            raise
+        except LLMUnavailable as e:
+            return jsonify({"error": str(e)}), 503
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+
+# Modules under test import each other as top-level names (run from backend/).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STATE_STORE", "memory")
+
+
+class FakeCollection:
+    """In-memory stand-in for the Chroma collection: chunks are "{doc_id}_{chunk}" rows and
+    every query returns all rows that match its `where`, at distance 0.3, in chunk order."""
+
+    def __init__(self):
+        self.rows = {}  # id -> (text, metadata)
+        self.queries = []
+        self.gets = []
+
+    def add_doc(self, doc_id: str, chunks: list, filename: str = None):
+        for i, text in enumerate(chunks):
+            self.rows[f"{doc_id}_{i}"] = (text, {"doc_id": doc_id, "chunk": i, "filename": filename or doc_id})
+
+    def _matches(self, meta: dict, where) -> bool:
+        if not where:
+            return True
+        want = where["doc_id"]
+        return meta["doc_id"] in want["$in"] if isinstance(want, dict) else meta["doc_id"] == want
+
+    def get(self, ids=None, where=None, limit=None, include=None):
+        self.gets.append({"ids": ids, "where": where})
+        keys = [i for i in (ids or self.rows) if i in self.rows and self._matches(self.rows[i][1], where)]
+        keys = keys[:limit] if limit else keys
+        return {"ids": keys, "documents": [self.rows[k][0] for k in keys], "metadatas": [self.rows[k][1] for k in keys]}
+
+    def query(self, query_embeddings, n_results, where=None, include=None):
+        self.queries.append({"n": len(query_embeddings), "where": where})
+        keys = [k for k, (_, meta) in self.rows.items() if self._matches(meta, where)][:n_results]
+        columns = {
+            "ids": keys,
+            "documents": [self.rows[k][0] for k in keys],
+            "metadatas": [self.rows[k][1] for k in keys],
+            "distances": [0.3] * len(keys),
+        }
+        return {name: [list(values) for _ in query_embeddings] for name, values in columns.items()}
+
+
+class _Reply:
+    def __init__(self, text):
+        self.text = text
+
+
+@pytest.fixture
+def ask_env(monkeypatch):
+    """main with a FakeCollection, in-memory consent state, no background indexing and a
+    stubbed llm_client (one fixed vector per text; the answer echoes the prompt's question)."""
+    main = pytest.importorskip("main")
+    import llm_client
+    from state_store import MemoryStateStore
+
+    env = type("AskEnv", (), {})()
+    env.main = main
+    env.collection = FakeCollection()
+    env.indexing = []
+    env.prompts = []
+    env.embedded = []
+    env.fail = {}  # question -> exception raised by generate_content
+
+    monkeypatch.setitem(main._process_state, "pid", os.getpid())
+    monkeypatch.setitem(main._process_state, "collection", env.collection)
+    monkeypatch.setattr(main, "consent_state", MemoryStateStore("consent"))
+    monkeypatch.setattr(main, "general_fallback", MemoryStateStore("general_fallback"))
+    monkeypatch.setattr(main, "_start_background_indexing", env.indexing.append)
+
+    def embed_content(content, task_type="retrieval_document", model_name=None, timeout=None):
+        env.embedded.append(content)
+        if isinstance(content, list):
+            return {"embedding": [[0.1, 0.2] for _ in content]}
+        return {"embedding": [0.1, 0.2]}
+
+    def generate_content(prompt, *args, **kwargs):
+        env.prompts.append(prompt)
+        question = prompt.rsplit("Question:", 1)[-1].split("\n", 1)[0].strip()
+        if question in env.fail:
+            raise env.fail[question]
+        return _Reply(f"Answer to {question}")
+
+    monkeypatch.setattr(llm_client, "embed_content", embed_content)
+    monkeypatch.setattr(llm_client, "generate_content", generate_content)
+    env.client = main.app.test_client()
+    return env
@@ -0,0 +1,30 @@
+import time
+
+from admission import TokenBucket
+
+
+def test_unlimited_bucket_never_blocks():
+    bucket = TokenBucket(0, 1)
+    assert all(bucket.try_acquire() for _ in range(100))
+    assert bucket.acquire(0)
+
+
+def test_burst_then_empty():
+    bucket = TokenBucket(0.001, 3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_acquire_times_out_when_refill_is_too_slow():
+    bucket = TokenBucket(0.5, 1)
+    assert bucket.try_acquire()
+    start = time.monotonic()
+    assert not bucket.acquire(0.05)
+    assert time.monotonic() - start < 0.5
+
+
+def test_acquire_waits_for_refill():
+    bucket = TokenBucket(50, 1)
+    assert bucket.try_acquire()
+    start = time.monotonic()
+    assert bucket.acquire(1.0)
+    assert 0.01 <= time.monotonic() - start < 0.5
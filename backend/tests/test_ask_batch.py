@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from deadline import DeadlineExceeded
+from llm_client import LLMUnavailable
+
+CHUNKS = [
+    "Photosynthesis turns light into chemical energy.",
+    "Chlorophyll absorbs red and blue light.",
+    "Mitochondria release energy from glucose.",
+    "Cells store energy as ATP molecules.",
+]
+
+
+@pytest.fixture
+def env(ask_env):
+    ask_env.collection.add_doc("doc", CHUNKS)
+    return ask_env
+
+
+def _events(resp) -> list:
+    return [json.loads(line) for line in resp.get_data(as_text=True).splitlines() if line]
+
+
+def _batch(env, questions, **headers):
+    return env.client.post("/api/document/ask-batch", json={"doc_id": "doc", "questions": questions}, headers=headers)
+
+
+def test_one_embedding_and_one_query_for_all_questions(env):
+    questions = ["What does chlorophyll absorb?", "Where is energy stored?", "What do mitochondria do?"]
+    resp = _batch(env, questions)
+    assert resp.mimetype == "application/x-ndjson"
+    events = _events(resp)
+    assert env.embedded == [questions]
+    assert env.collection.queries == [{"n": 3, "where": {"doc_id": "doc"}}]
+    # Neighbours for every question come from a single get by id.
+    assert len([g for g in env.collection.gets if g["ids"]]) == 1
+
+    assert events[-1] == {"type": "done", "count": 3}
+    answers = sorted(events[:-1], key=lambda e: e["index"])
+    assert [e["index"] for e in answers] == [0, 1, 2]
+    for e, q in zip(answers, questions):
+        assert e == {"type": "answer", "index": e["index"], "question": q, "answer": f"Answer to {q}", "found": True}
+
+
+def test_early_errors_per_question(env):
+    questions = ["", "see http://example.com", "hello", "What does chlorophyll absorb?"]
+    events = _events(_batch(env, questions))
+    assert events[:3] == [
+        {"type": "answer", "index": 0, "question": "", "error": "Missing question", "status": 400},
+        {"type": "answer", "index": 1, "question": questions[1],
+         "error": "⚠️ No links allowed. Please ask using text only.", "status": 422},
+        {"type": "answer", "index": 2, "question": "hello",
+         "error": "Please ask a question about the document.", "status": 422},
+    ]
+    assert events[3]["index"] == 3 and events[3]["answer"]
+    assert events[4] == {"type": "done", "count": 4}
+    assert env.embedded == [[questions[3]]]
+
+
+def test_only_early_errors_skip_retrieval(env):
+    events = _events(_batch(env, ["", "hi"]))
+    assert [e.get("status") for e in events] == [400, 422, None]
+    assert env.embedded == [] and env.collection.queries == []
+
+
+def test_failed_answer_is_reported_in_its_event(env):
+    questions = ["What does chlorophyll absorb?", "Where is energy stored?"]
+    env.fail[questions[0]] = LLMUnavailable("circuit open")
+    events = {e.get("index"): e for e in _events(_batch(env, questions))}
+    assert events[0]["status"] == 503 and "unavailable" in events[0]["error"]
+    assert events[1]["answer"] == f"Answer to {questions[1]}"
+    assert events[None] == {"type": "done", "count": 2}
+
+
+def test_deadline_ends_the_stream(env, monkeypatch):
+    monkeypatch.setattr(env.main, "ASK_BATCH_CONCURRENCY", 1)
+    questions = ["What does chlorophyll absorb?", "Where is energy stored?"]
+    env.fail[questions[0]] = DeadlineExceeded("llm")
+    events = _events(_batch(env, questions))
+    assert events == [{"type": "error", "status": 504, "error": "Request timed out. Please try again.", "stage": "llm"}]
+    assert len(env.prompts) == 1
+
+
+def test_sse_when_asked(env):
+    resp = _batch(env, ["What does chlorophyll absorb?"], Accept="text/event-stream")
+    assert resp.mimetype == "text/event-stream"
+    lines = [line for line in resp.get_data(as_text=True).split("\n\n") if line]
+    assert all(line.startswith("data: ") for line in lines)
+    assert json.loads(lines[-1][len("data: "):]) == {"type": "done", "count": 1}
+
+
+@pytest.mark.parametrize("body, status", [
+    ({"questions": ["q?"]}, 400),
+    ({"doc_id": "doc"}, 400),
+    ({"doc_id": "doc", "questions": []}, 400),
+    ({"doc_id": "doc", "questions": "q?"}, 400),
+])
+def test_request_validation(env, body, status):
+    assert env.client.post("/api/document/ask-batch", json=body).status_code == status
+    assert env.collection.queries == []
+
+
+def test_too_many_questions(env, monkeypatch):
+    monkeypatch.setattr(env.main, "ASK_BATCH_MAX_QUESTIONS", 2)
+    assert _batch(env, ["a?", "b?", "c?"]).status_code == 400
+
+
+def test_consent_and_indexing_answer_before_streaming(env):
+    env.main.consent_state.set("doc", {"sensitive": True, "confirmed": False, "summary": {"email": 1}})
+    resp = _batch(env, ["What does chlorophyll absorb?"])
+    assert resp.status_code == 409
+    assert resp.get_json()["sensitiveSummary"] == {"email": 1}
+
+    resp = env.client.post("/api/document/ask-batch", json={"doc_id": "new", "questions": ["q?"]})
+    assert resp.status_code == 202
+    assert env.indexing == ["new"]
+    assert env.collection.queries == []
+
+
+def test_batch_contexts_share_neighbours(env):
+    main = env.main
+    results = env.collection.query([[0.1], [0.2]], 1, where={"doc_id": "doc"})
+    # Both questions hit chunk 0; expansion pulls in chunk 1 for each of them.
+    with main.app.test_request_context():
+        contexts = main._batch_contexts("doc", ["chlorophyll light", "light energy"], results, 2000)
+    assert len(contexts) == 2
+    for context in contexts:
+        assert CHUNKS[0] in context
+        assert CHUNKS[1] in context
+        assert CHUNKS[2] not in context
+    assert len([g for g in env.collection.gets if g["ids"]]) == 1
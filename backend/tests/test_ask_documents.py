@@ -0,0 +1,86 @@
+import pytest
+
+CHUNKS = {
+    "a": ["Photosynthesis turns light into chemical energy.", "Chlorophyll absorbs red and blue light."],
+    "b": ["Mitochondria release energy from glucose.", "Cells store energy as ATP molecules."],
+}
+
+
+@pytest.fixture
+def env(ask_env):
+    for doc_id, chunks in CHUNKS.items():
+        ask_env.collection.add_doc(doc_id, chunks, filename=f"{doc_id}.pdf")
+    return ask_env
+
+
+def _ask(env, **body):
+    return env.client.post("/api/document/ask", json=dict({"question": "How do cells get energy?"}, **body))
+
+
+def test_query_is_filtered_to_the_requested_documents(env):
+    resp = _ask(env, doc_ids=["a", "b", "a", " "])
+    data = resp.get_json()
+    assert resp.status_code == 200
+    assert env.collection.queries == [{"n": 1, "where": {"doc_id": {"$in": ["a", "b"]}}}]
+    assert data["answer"] == "Answer to How do cells get energy?"
+    assert data["skipped"] == []
+    assert {s["doc_id"] for s in data["sources"]} == {"a", "b"}
+    assert all(s["filename"] == s["doc_id"] + ".pdf" for s in data["sources"])
+    labels = [s["id"] for s in data["sources"]]
+    assert labels == [f"S{i}" for i in range(1, len(labels) + 1)]
+    assert all(f"[{label}]" in env.prompts[0] for label in labels)
+    # Only chunks of the requested documents reach the prompt.
+    env.collection.add_doc("c", ["Someone else's notes about energy."])
+    _ask(env, doc_ids=["a", "b"])
+    assert "Someone else" not in env.prompts[1]
+
+
+def test_skipped_documents_and_single_searchable_document(env):
+    env.main.consent_state.set("b", {"sensitive": True, "confirmed": False})
+    data = _ask(env, doc_ids=["a", "b", "new"]).get_json()
+    assert data["skipped"] == [
+        {"doc_id": "b", "reason": "consent_required"},
+        {"doc_id": "new", "reason": "indexing"},
+    ]
+    assert env.indexing == ["new"]
+    assert env.collection.queries == [{"n": 1, "where": {"doc_id": "a"}}]
+    assert {s["doc_id"] for s in data["sources"]} == {"a"}
+
+
+@pytest.mark.parametrize("body", [
+    {"doc_ids": ["unknown1", "unknown2"]},
+    {"doc_ids": ["unknown1", "unknown2"], "scope": "all"},
+])
+def test_unknown_documents_never_query(env, body):
+    data = _ask(env, **body).get_json()
+    assert data["sources"] == []
+    assert [s["reason"] for s in data["skipped"]] == ["indexing", "indexing"]
+    assert env.collection.queries == []
+    assert env.prompts == []
+
+
+@pytest.mark.parametrize("body, error", [
+    ({"doc_ids": []}, "Missing doc_id"),
+    ({"doc_ids": ["", "  "]}, "Missing doc_id"),
+    ({"doc_ids": [], "scope": "all"}, 'scope "all" requires doc_ids'),
+    ({"scope": "all"}, 'scope "all" requires doc_ids'),
+    ({"doc_ids": "a,b"}, "doc_ids must be a list"),
+])
+def test_empty_document_list_is_rejected(env, body, error):
+    resp = _ask(env, **body)
+    assert resp.status_code == 400
+    assert resp.get_json()["error"].startswith(error)
+    assert env.collection.queries == []
+
+
+def test_too_many_documents(env, monkeypatch):
+    monkeypatch.setattr(env.main, "ASK_MAX_DOCS", 2)
+    assert _ask(env, doc_ids=["a", "b", "c"]).status_code == 400
+
+
+def test_llm_unavailable_is_503(env):
+    from llm_client import LLMUnavailable
+
+    env.fail["How do cells get energy?"] = LLMUnavailable("circuit open")
+    resp = _ask(env, doc_ids=["a", "b"])
+    assert resp.status_code == 503
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+import context_cache as cc
+
+BLOCK = "x" * (cc.CONTEXT_CACHE_MIN_CHARS + 10)
+
+
+@pytest.fixture
+def local(monkeypatch):
+    monkeypatch.setattr(cc, "CONTEXT_CACHE", "local")
+    monkeypatch.setattr(cc, "CONTEXT_CACHE_MIN_USES", 2)
+    monkeypatch.setattr(cc, "_backend_instance", None)
+    monkeypatch.setattr(cc, "_registry", None)
+    monkeypatch.setattr(cc, "_failed_models", {})
+    backend = cc._backend()
+    return backend
+
+
+def _prompt():
+    return cc.cached_prompt("doc", "sys", BLOCK, "req", "model")
+
+
+def test_second_sighting_creates_and_third_hits(local):
+    assert _prompt()[1] is None
+    contents, ctx = _prompt()
+    assert contents == ["req"] and ctx is not None
+    assert _prompt()[1].name == ctx.name
+    assert cc._create_locks == {}
+
+
+def test_near_expiry_cache_is_extended_not_blanked(local):
+    _prompt()
+    ctx = _prompt()[1]
+    key = ctx.key
+    entry = cc._registry.get(key)
+    cc._registry.set(key, dict(entry, expires_at=time.time() + 5))
+    contents, again = _prompt()
+    assert again is not None and again.name == ctx.name
+    assert cc._registry.get(key)["expires_at"] > time.time() + 60
+
+
+def test_near_expiry_cache_that_cannot_be_extended_is_deleted(local, monkeypatch):
+    _prompt()
+    ctx = _prompt()[1]
+    cc._registry.set(ctx.key, dict(cc._registry.get(ctx.key), expires_at=time.time() + 5))
+    deleted = []
+
+    def fail(name):
+        raise RuntimeError("expired")
+
+    monkeypatch.setattr(local, "refresh", fail)
+    real_delete = local.delete
+    monkeypatch.setattr(local, "delete", lambda name: deleted.append(name) or real_delete(name))
+    contents, fresh = _prompt()
+    assert deleted == [ctx.name]
+    # uses were kept, so a replacement is created right away
+    assert fresh is not None and fresh.name != ctx.name
+
+
+def test_create_lock_outlives_registry_write(local, monkeypatch):
+    _prompt()
+    seen = []
+    real_set = cc._registry.set
+
+    def spy(key, value, ttl=None):
+        if value.get("name"):
+            seen.append(key in cc._create_locks)
+        return real_set(key, value, ttl=ttl)
+
+    monkeypatch.setattr(cc._registry, "set", spy)
+    assert _prompt()[1] is not None
+    assert seen == [True]
+    assert cc._create_locks == {}
@@ -0,0 +1,93 @@
+import pytest
+
+import token_budget
+from context_select import MIN_OVERLAP_CHARS, _overlap, assemble_context, merge_spans
+from token_budget import estimate_tokens
+
+DOC = " ".join(f"Sentence {i} explains part {i} of the topic." for i in range(80))
+
+
+@pytest.fixture(autouse=True)
+def unit_factor(monkeypatch):
+    monkeypatch.setattr(token_budget, "_factor", lambda model_name=None: 1.0)
+
+
+def _chunk(i: int, size: int = 300, overlap: int = 60) -> str:
+    """Chunk i of DOC as chunk_text cuts it: each window repeats the previous one's tail."""
+    start = i * (size - overlap)
+    return DOC[start:start + size]
+
+
+def _chunk_end(i: int) -> int:
+    return i * 240 + 300
+
+
+def test_overlap():
+    assert _overlap(_chunk(0), _chunk(1)) == 60
+    assert _overlap(_chunk(0), _chunk(2)) == 0
+    assert _overlap("abc", "abc") == 0  # shorter than MIN_OVERLAP_CHARS
+    tail = "x" * MIN_OVERLAP_CHARS
+    assert _overlap("head " + tail, tail + " more") == MIN_OVERLAP_CHARS
+
+
+def test_overlap_picks_the_longest_repeat():
+    a = "ab" * 30
+    assert _overlap(a, "ab" * 25 + "cd") == 50
+
+
+def test_adjacent_chunks_merge_without_duplication():
+    spans = merge_spans([(i, _chunk(i)) for i in range(4)])
+    assert spans == [(0, 3, DOC[:_chunk_end(3)])]
+
+
+def test_gaps_split_spans_and_rank_order_is_kept():
+    spans = merge_spans([(5, _chunk(5)), (0, _chunk(0)), (6, _chunk(6)), (1, _chunk(1)), (5, "dup")])
+    assert spans == [
+        (5, 6, DOC[5 * 240:_chunk_end(6)]),
+        (0, 1, DOC[:_chunk_end(1)]),
+    ]
+
+
+def test_adjacent_chunks_without_overlap_are_joined_whole():
+    assert merge_spans([(0, "First chunk of text."), (1, "Second chunk of text.")]) == [
+        (0, 1, "First chunk of text.\n\nSecond chunk of text."),
+    ]
+
+
+def test_positions_from_several_documents():
+    spans = merge_spans([(("b", 1), _chunk(1)), (("a", 0), _chunk(0)), (("b", 0), _chunk(0)), (("a", 1), "other")])
+    assert spans == [
+        (("b", 0), ("b", 1), DOC[:_chunk_end(1)]),
+        (("a", 0), ("a", 1), _chunk(0) + "\n\nother"),
+    ]
+
+
+def test_assemble_merges_hits_and_neighbors_in_full():
+    hits = [(2, _chunk(2), None), (4, _chunk(4), None)]
+    neighbors = [(3, _chunk(3), None), (9, _chunk(9), None), (1, _chunk(1), None)]
+    spans = assemble_context(hits, 10_000, neighbors)
+    assert spans == [(1, 4, DOC[240:_chunk_end(4)])]
+
+
+def test_assemble_counts_overlap_once():
+    hits = [(i, _chunk(i), None) for i in range(3)]
+    merged = DOC[:_chunk_end(2)]
+    # Just enough for the merged text plus one separator per chunk.
+    spans = assemble_context(hits, estimate_tokens(merged) + 6)
+    assert spans == [(0, 2, merged)]
+
+
+def test_assemble_stays_within_budget_and_cuts_the_last_hit():
+    hits = [(0, _chunk(0), None), (7, _chunk(7), None), (3, _chunk(3), None)]
+    budget = estimate_tokens(_chunk(0)) + 55
+    spans = assemble_context(hits, budget)
+    assert [(first, last) for first, last, _ in spans] == [(0, 0), (7, 7)]
+    assert spans[0][2] == _chunk(0)
+    part = spans[1][2]
+    assert _chunk(7).startswith(part) and part.endswith(".") and part != _chunk(7)
+    assert sum(estimate_tokens(text) + 1 for _, _, text in spans) <= budget
+
+
+def test_assemble_skips_empty_and_repeated_hits():
+    hits = [(0, "  ", None), (1, "Only chunk.", 3), (1, "Again.", 2)]
+    assert assemble_context(hits, 100) == [(1, 1, "Only chunk.")]
@@ -0,0 +1,83 @@
+import pytest
+from flask import Flask, g
+
+import deadline
+from deadline import DEADLINE_HEADER, DeadlineExceeded, current_deadline, start_request_deadline, without_deadline
+
+
+@pytest.fixture
+def ctx():
+    with Flask(__name__).app_context():
+        yield
+
+
+def test_endpoint_budget_and_default(ctx):
+    assert start_request_deadline("ask_doc").budget_sec == deadline.ENDPOINT_DEADLINES["ask_doc"]
+    assert start_request_deadline("unknown").budget_sec == deadline.REQUEST_DEADLINE_SEC
+    assert current_deadline() is g.deadline
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("20", 20.0),
+    ("0.01", 1.0),
+    ("-5", 1.0),
+    ("99999", deadline.REQUEST_DEADLINE_MAX_SEC),
+    ("soon", deadline.ENDPOINT_DEADLINES["ask_doc"]),
+])
+def test_header_is_clamped(ctx, header, expected):
+    assert start_request_deadline("ask_doc", header).budget_sec == expected
+
+
+@pytest.mark.parametrize("endpoint", sorted(deadline.INDEXING_ENDPOINTS))
+def test_indexing_endpoints_ignore_header(ctx, endpoint):
+    budget = start_request_deadline(endpoint, "2").budget_sec
+    assert budget == min(deadline.ENDPOINT_DEADLINES[endpoint], deadline.REQUEST_DEADLINE_MAX_SEC)
+
+
+def test_without_deadline_lifts_and_restores(ctx):
+    d = start_request_deadline("ask_doc", "5")
+    seen = []
+
+    @without_deadline
+    def index():
+        seen.append(current_deadline())
+        deadline.check_deadline("index")
+        return deadline.stage_timeout("embed", 30.0)
+
+    assert index() == 30.0
+    assert seen == [None]
+    assert current_deadline() is d
+
+
+def test_without_deadline_restores_after_error(ctx):
+    d = start_request_deadline("ask_doc")
+
+    @without_deadline
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        fail()
+    assert current_deadline() is d
+
+
+def test_without_deadline_outside_app_context():
+    assert without_deadline(lambda: "ok")() == "ok"
+
+
+def test_expired_deadline_raises(ctx):
+    d = start_request_deadline("ask_doc")
+    d.expires_at -= d.budget_sec + 1
+    with pytest.raises(DeadlineExceeded) as err:
+        deadline.stage_timeout("llm", 30.0)
+    assert err.value.stage == "llm"
+
+
+def test_main_reads_header_and_answers_504():
+    main = pytest.importorskip("main")
+    with main.app.test_request_context("/api/document/ask", method="POST", headers={DEADLINE_HEADER: "12"}):
+        main._start_request_deadline()
+        assert g.deadline.budget_sec == 12.0
+        resp = main.app.make_response(main.app.handle_user_exception(DeadlineExceeded("vector_query")))
+        assert resp.status_code == 504
+        assert resp.get_json() == {"error": "Request timed out. Please try again.", "stage": "vector_query"}
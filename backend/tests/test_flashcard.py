@@ -0,0 +1,38 @@
+import dedup
+from flashcard import merge_shards
+
+
+def _cards(*fronts):
+    return [{"front": f, "back": "b"} for f in fronts]
+
+
+def test_takes_from_shards_in_turn_and_keeps_document_order(monkeypatch):
+    monkeypatch.setattr(dedup, "DEDUP_EMBEDDINGS", False)
+    shards = [
+        _cards("alpha one", "alpha two", "alpha three"),
+        _cards("beta one"),
+        _cards("gamma one", "gamma two"),
+    ]
+    fronts = [c["front"] for c in merge_shards(shards, 4)]
+    assert fronts == ["alpha one", "alpha two", "beta one", "gamma one"]
+
+
+def test_drops_near_duplicates_across_shards_and_existing(monkeypatch):
+    monkeypatch.setattr(dedup, "DEDUP_EMBEDDINGS", False)
+    existing = _cards("What is photosynthesis in green plants")
+    shards = [
+        _cards("What is photosynthesis in green plants?", "Define osmosis across a membrane"),
+        _cards("Define osmosis across a membrane", "Explain the Krebs cycle steps"),
+    ]
+    merged = merge_shards(shards, 10, existing)
+    assert [c["front"] for c in merged] == [
+        "What is photosynthesis in green plants",
+        "Define osmosis across a membrane",
+        "Explain the Krebs cycle steps",
+    ]
+
+
+def test_limit_counts_existing_cards(monkeypatch):
+    monkeypatch.setattr(dedup, "DEDUP_EMBEDDINGS", False)
+    merged = merge_shards([_cards("one card here", "two cards here")], 2, _cards("zero cards here"))
+    assert len(merged) == 2
@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+import llm_client
+from admission import TokenBucket
+from llm_client import CircuitBreaker, LLMUnavailable
+
+
+class Transient(Exception):
+    pass
+
+
+Transient.__name__ = "ServiceUnavailable"
+
+
+def _opened(reset_sec: float = 0.05) -> CircuitBreaker:
+    breaker = CircuitBreaker("generate", threshold=1, reset_sec=reset_sec)
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_then_allows_one_trial():
+    breaker = _opened()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # only one trial at a time
+
+
+def test_trial_success_closes_and_failure_reopens():
+    breaker = _opened()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_release_trial_only_frees_own_trial():
+    breaker = _opened()
+    breaker.release_trial()  # nothing held: no effect
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release_trial()
+    assert breaker.allow()
+
+
+def test_half_open_rate_limit_timeout_does_not_wedge_breaker(monkeypatch):
+    breaker = _opened()
+    time.sleep(0.06)
+    bucket = TokenBucket(0.001, 1)
+    bucket._tokens = 0.0
+    monkeypatch.setitem(llm_client.rate_limiters, "generate", bucket)
+    with pytest.raises(LLMUnavailable, match="rate limit"):
+        llm_client._call_with_retries(breaker, 1.2, lambda t: "never", "llm_generate")
+    # The trial never reached the provider, so the next call may try again.
+    monkeypatch.setitem(llm_client.rate_limiters, "generate", TokenBucket(0, 1))
+    assert llm_client._call_with_retries(breaker, 5.0, lambda t: "ok", "llm_generate") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_transient_failures_retry_then_open(monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_MAX_RETRIES", 1)
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_BASE", 0.0)
+    monkeypatch.setitem(llm_client.rate_limiters, "generate", TokenBucket(0, 1))
+    breaker = CircuitBreaker("generate", threshold=2, reset_sec=60)
+    calls = []
+
+    def failing(timeout):
+        calls.append(timeout)
+        raise Transient("down")
+
+    with pytest.raises(LLMUnavailable, match="failed"):
+        llm_client._call_with_retries(breaker, 5.0, failing, "llm_generate")
+    assert len(calls) == 2
+    assert breaker.state == "open"
+    with pytest.raises(LLMUnavailable, match="circuit open"):
+        llm_client._call_with_retries(breaker, 5.0, failing, "llm_generate")
+    assert len(calls) == 2
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+def _stub_stream(monkeypatch, fragments):
+    monkeypatch.setattr(llm_client, "apply_budget", lambda model_name, config: (model_name, config))
+    monkeypatch.setattr(llm_client, "_resolve_cached", lambda contents, *args: (None, contents))
+    monkeypatch.setattr(llm_client, "_call_resolved", lambda *args: iter([_Chunk(f) for f in fragments]))
+    monkeypatch.setattr(llm_client, "record_generate", lambda resp, model_name: None)
+    observed = []
+    monkeypatch.setattr(llm_client.LLM_GENERATE_SECONDS, "observe",
+                        lambda value, **labels: observed.append(labels["outcome"]))
+    return observed
+
+
+def test_stream_outcomes(monkeypatch):
+    observed = _stub_stream(monkeypatch, ["a", "b", "c"])
+    assert list(llm_client.generate_content_stream("prompt", "model")) == ["a", "b", "c"]
+    stream = llm_client.generate_content_stream("prompt", "model")
+    assert next(stream) == "a"
+    stream.close()
+    assert observed == ["ok", "cancelled"]
@@ -0,0 +1,75 @@
+import os
+import time
+
+import pytest
+
+import preview_store
+from preview_store import PreviewStore
+
+
+def _write(store, name, size, age=0.0):
+    path = os.path.join(store.directory, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    if age:
+        os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "previews")
+
+
+def test_rebuild_orders_by_mtime_and_drops_partial_writes(directory):
+    os.makedirs(directory)
+    seed = PreviewStore(directory, 10_000, 3600)
+    _write(seed, "b_22222222.pdf", 100, age=10)
+    _write(seed, "a_11111111.pdf", 100, age=20)
+    _write(seed, "c_33333333.pdf.part", 100)
+    _write(seed, "notes.txt", 100)
+    store = PreviewStore(directory, 10_000, 3600)
+    assert list(store._index) == ["a_11111111.pdf", "b_22222222.pdf"]
+    assert store._bytes == 200
+    assert not os.path.exists(os.path.join(directory, "c_33333333.pdf.part"))
+
+
+def test_size_cap_evicts_least_recently_used(directory, monkeypatch):
+    monkeypatch.setattr(preview_store, "TOUCH_INTERVAL_SEC", 0.0)
+    store = PreviewStore(directory, 250, 3600)
+    for name in ("a_11111111.pdf", "b_22222222.pdf"):
+        _write(store, name, 100)
+        store._add(name, 100)
+    assert store._touch("a_11111111.pdf")  # a is now the most recent
+    _write(store, "c_33333333.pdf", 100)
+    store._add("c_33333333.pdf", 100)
+    assert list(store._index) == ["a_11111111.pdf", "c_33333333.pdf"]
+    assert not os.path.exists(os.path.join(directory, "b_22222222.pdf"))
+    assert store._bytes == 200
+
+
+def test_age_cap_evicts_stale_files(directory):
+    os.makedirs(directory)
+    seed = PreviewStore(directory, 10_000, 3600)
+    _write(seed, "old_11111111.pdf", 10, age=7200)
+    _write(seed, "new_22222222.pdf", 10)
+    store = PreviewStore(directory, 10_000, 3600)
+    assert list(store._index) == ["new_22222222.pdf"]
+    assert not os.path.exists(os.path.join(directory, "old_11111111.pdf"))
+
+
+def test_lookup_follows_content_hash_and_drop_removes_files(directory):
+    store = PreviewStore(directory, 10_000, 3600)
+    digest = store.remember("doc", b"v1")
+    name = f"doc_{digest}.pdf"
+    _write(store, name, 10)
+    assert store.lookup("doc") == os.path.join(directory, name)
+    # New content: the old preview is deleted and the lookup misses until converted.
+    store.remember("doc", b"v2")
+    assert store.lookup("doc") is None
+    assert not os.path.exists(os.path.join(directory, name))
+    digest = store.remember("doc", b"v3")
+    _write(store, f"doc_{digest}.pdf", 10)
+    store.drop("doc")
+    assert store.lookup("doc") is None
+    assert os.listdir(directory) == []
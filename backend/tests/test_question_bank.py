@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import dedup
+import question_bank as qb
+from state_store import MemoryStateStore
+
+
+class FakeCollection:
+    def __init__(self, doc_ids):
+        self.doc_ids = set(doc_ids)
+
+    def get(self, where=None, limit=None, include=None):
+        return {"ids": [f"{where['doc_id']}_0"] if where["doc_id"] in self.doc_ids else []}
+
+
+@pytest.fixture
+def bank(monkeypatch):
+    monkeypatch.setattr(qb, "_store", MemoryStateStore("question_bank"))
+    monkeypatch.setattr(qb, "collection", FakeCollection({"doc"}))
+    monkeypatch.setattr(qb, "QUESTION_BANK_ENABLED", True)
+    scheduled = []
+    monkeypatch.setattr(qb, "schedule_fill", scheduled.append)
+    return scheduled
+
+
+def test_indexed_document_without_bank_gets_one(bank):
+    assert qb.sample_cards("doc", 5) is None
+    assert qb._bank_store().get("doc")["generation"]
+    assert bank == ["doc"]
+
+
+def test_unindexed_document_gets_no_bank(bank):
+    assert qb.sample_cards("other", 5) is None
+    assert qb._bank_store().get("other") is None
+    assert bank == []
+
+
+def test_build_starts_generation_for_legacy_document(bank, monkeypatch):
+    filled = []
+    monkeypatch.setattr(qb, "_fill", lambda doc_id, generation: filled.append(generation) or 0)
+    qb._run_build("doc")
+    assert filled and filled[0] == qb._bank_store().get("doc")["generation"]
+
+
+def test_fill_embeds_each_item_once(bank, monkeypatch):
+    monkeypatch.setattr(qb, "QUESTION_BANK_QUESTIONS_PER_DIFFICULTY", 0)
+    monkeypatch.setattr(qb, "QUESTION_BANK_CARDS", 48)
+    monkeypatch.setattr(dedup, "DEDUP_EMBEDDINGS", True)
+    monkeypatch.setattr(qb, "section_chunks", lambda *a: [[(0, "text")]])
+    rng = random.Random(3)
+    counter = iter(range(10_000))
+
+    def generate(kind, difficulty, context, n):
+        cards = []
+        for _ in range(n):
+            k = next(counter)
+            front = f"term{k} " + " ".join(f"w{rng.randrange(10**6)}" for _ in range(6))
+            cards.append({"front": front, "back": "b", "id": qb._item_id(front), "served": 0, "source_chunk": 0})
+        return cards
+
+    embedded = []
+
+    def embed(texts, task_type=None):
+        embedded.append(len(texts))
+        return {"embedding": [[rng.gauss(0, 1) for _ in range(16)] for _ in texts]}
+
+    monkeypatch.setattr(qb, "_generate_items", generate)
+    monkeypatch.setattr(dedup, "embed_content", embed)
+    qb._bank_store().set("doc", qb._empty_bank("g1"))
+    assert qb._fill("doc", "g1") == 48
+    assert embedded == [qb.QUESTION_BANK_BATCH] * 4
+    vectors = qb._bank_store().get(qb._vectors_key("doc"))
+    assert vectors["generation"] == "g1" and len(vectors["cards"]) == 48
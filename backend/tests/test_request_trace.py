@@ -0,0 +1,28 @@
+import profiler
+
+
+def test_streamed_response_is_traced_after_its_body(ask_env, monkeypatch):
+    ask_env.collection.add_doc("doc", ["Chlorophyll absorbs red and blue light."])
+    finished = []
+    monkeypatch.setattr(profiler, "finish_request",
+                        lambda trace, endpoint, method, path, status, stages: finished.append((endpoint, dict(stages))))
+
+    resp = ask_env.client.post("/api/document/ask-batch", json={"doc_id": "doc", "questions": ["What is absorbed?"]})
+    assert resp.is_streamed and finished == []
+    assert "Answer to What is absorbed?" in resp.get_data(as_text=True)
+    resp.close()
+    assert len(finished) == 1
+    endpoint, stages = finished[0]
+    assert endpoint == "ask_batch"
+    # Recorded while the body was generated, after the after_request hook had run.
+    assert "format_response" in stages
+    assert "X-Profile-Id" not in resp.headers
+
+
+def test_plain_response_is_traced_in_after_request(ask_env, monkeypatch):
+    finished = []
+    monkeypatch.setattr(profiler, "finish_request", lambda *args: finished.append(args) or "entry-1")
+    monkeypatch.setattr(profiler, "begin_request", lambda forced: profiler.RequestTrace(False, "header"))
+    resp = ask_env.client.get("/healthz")
+    assert len(finished) == 1
+    assert resp.headers["X-Profile-Id"] == "entry-1"
@@ -0,0 +1,67 @@
+import sensitive
+from sensitive import cached_scan, luhn_valid, scan_sensitive, verhoeff_valid
+
+
+def _verhoeff_complete(prefix: str) -> str:
+    return next(prefix + d for d in "0123456789" if verhoeff_valid(prefix + d))
+
+
+def test_luhn():
+    assert luhn_valid("4111111111111111")
+    assert luhn_valid("79927398713")
+    assert not luhn_valid("4111111111111112")
+    assert not luhn_valid("79927398710")
+
+
+def test_verhoeff():
+    assert verhoeff_valid("2363")
+    assert not verhoeff_valid("2364")
+    number = _verhoeff_complete("23456789012")
+    assert verhoeff_valid(number)
+    assert not verhoeff_valid(number[:-1] + str((int(number[-1]) + 1) % 10))
+
+
+def test_counts_per_category():
+    text = (
+        "Mail alice@example.com or bob.smith@uni.edu. "
+        "SSNs 123-45-6789 and 987-65-4321. "
+        "Call 555-123-4567 or +1 555 123 4567. "
+        "Card 4111 1111 1111 1111, PAN ABCDE1234F."
+    )
+    result = scan_sensitive(text)
+    assert result["found"]
+    assert result["matches"] == {"email": 2, "ssn_like": 2, "phone": 2, "credit_card": 1, "pan": 1}
+
+
+def test_checksums_decide_card_and_aadhaar():
+    aadhaar = _verhoeff_complete("23456789012")
+    spaced = f"{aadhaar[:4]} {aadhaar[4:8]} {aadhaar[8:]}"
+    assert scan_sensitive(f"Aadhaar {spaced}")["matches"] == {"aadhaar": 1}
+    assert scan_sensitive("Card 4111 1111 1111 1112")["matches"] == {}
+    assert scan_sensitive("Order 1234 5678 9012 3456 7890")["matches"] == {}
+
+
+def test_clean_text():
+    assert scan_sensitive("The 2024 report covers 12 regions and 3,400 sites.") == {"found": False, "matches": {}}
+    assert scan_sensitive("") == {"found": False, "matches": {}}
+
+
+def test_max_hits_stops_early():
+    text = " ".join(f"user{i}@example.com" for i in range(10))
+    assert scan_sensitive(text)["matches"] == {"email": 10}
+    assert scan_sensitive(text, max_hits=2) == {"found": True, "matches": {"email": 2}}
+
+
+def test_cached_scan_hit_and_miss(monkeypatch):
+    monkeypatch.setattr(sensitive, "_scan_cache", type(sensitive._scan_cache)())
+    calls = []
+    real = sensitive.scan_sensitive
+    monkeypatch.setattr(sensitive, "scan_sensitive", lambda text: calls.append(text) or real(text))
+    text = "write to carol@example.com"
+    first, hit = cached_scan(text)
+    assert not hit and first == {"found": True, "matches": {"email": 1}}
+    first["matches"]["email"] = 99  # callers get copies
+    second, hit = cached_scan(text)
+    assert hit and second == {"found": True, "matches": {"email": 1}}
+    assert cached_scan("something else")[1] is False
+    assert len(calls) == 2
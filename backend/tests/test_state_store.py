@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from state_store import MemoryStateStore, SqliteStateStore, update_state
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateStore("test")
+    return SqliteStateStore("test", str(tmp_path / "state.sqlite3"))
+
+
+def test_get_set_delete(store):
+    assert store.get("k") is None
+    store.set("k", {"a": 1})
+    assert store.get("k") == {"a": 1}
+    store.delete("k")
+    assert store.get("k") is None
+
+
+def test_compare_and_set(store):
+    assert store.compare_and_set("k", None, {"v": 1})
+    assert not store.compare_and_set("k", None, {"v": 2})
+    assert not store.compare_and_set("k", {"v": 9}, {"v": 2})
+    assert store.compare_and_set("k", {"v": 1}, {"v": 2})
+    assert store.get("k") == {"v": 2}
+
+
+def test_expired_value_counts_as_absent(store):
+    store.set("k", {"v": 1}, ttl=0.05)
+    time.sleep(0.06)
+    store.invalidate("k")
+    assert store.get("k") is None
+    assert store.compare_and_set("k", None, {"v": 2})
+
+
+def test_update_state_is_atomic_across_threads(store):
+    def bump():
+        for _ in range(25):
+            update_state(store, "counter", lambda st: dict(st, n=st.get("n", 0) + 1), attempts=1000)
+
+    threads = [threading.Thread(target=bump) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    store.invalidate("counter")
+    assert store.get("counter") == {"n": 200}
+
+
+def test_sqlite_stores_share_one_file(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    a, b = SqliteStateStore("ns", path), SqliteStateStore("ns", path)
+    update_state(a, "k", lambda st: dict(st, n=1))
+    b.invalidate("k")
+    assert b.get("k") == {"n": 1}
+    assert SqliteStateStore("other", path).get("k") is None
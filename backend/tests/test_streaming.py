@@ -0,0 +1,60 @@
+from streaming import JsonArrayStream
+
+DOC = (
+    '{"questions": [\n'
+    '  {"q": "What is {x}?", "a": "a \\"quoted\\" ]brace["},\n'
+    '  {"q": "Second", "options": ["a", "b"]},\n'
+    '  {"q": "Third", "meta": {"page": 3}}\n'
+    ']}'
+)
+
+
+def _feed(stream, text, step):
+    out = []
+    for i in range(0, len(text), step):
+        out.extend(stream.feed(text[i:i + step]))
+    return out
+
+
+def test_objects_complete_at_any_fragment_size():
+    for step in (1, 2, 7, len(DOC)):
+        stream = JsonArrayStream("questions")
+        items = _feed(stream, DOC, step)
+        assert [it["q"] for it in items] == ["What is {x}?", "Second", "Third"]
+        assert items[0]["a"] == 'a "quoted" ]brace['
+        assert stream.done and stream.skipped == 0
+        assert DOC.startswith(stream.text) and "]" in stream.text[-step:]
+
+
+def test_fenced_bare_array():
+    text = '```json\n[{"front": "A", "back": "1"}, {"front": "B", "back": "2"}]\n```'
+    stream = JsonArrayStream("flashcards")
+    assert [c["front"] for c in _feed(stream, text, 5)] == ["A", "B"]
+    assert stream.done
+
+
+def test_fenced_object_with_key():
+    text = '```json\n{"flashcards": [{"front": "A"}]}\n```'
+    assert _feed(JsonArrayStream("flashcards"), text, 3) == [{"front": "A"}]
+
+
+def test_truncated_output_yields_only_closed_objects():
+    cut = DOC[:DOC.index('{"q": "Third"') + 12]
+    stream = JsonArrayStream("questions")
+    assert [it["q"] for it in _feed(stream, cut, 4)] == ["What is {x}?", "Second"]
+    assert not stream.done
+    assert stream.emitted == 2
+
+
+def test_malformed_object_is_skipped():
+    text = '{"questions": [{"q": "ok"}, {"q": bad}, {"q": "also ok"}]}'
+    stream = JsonArrayStream("questions")
+    assert [it["q"] for it in _feed(stream, text, 3)] == ["ok", "also ok"]
+    assert stream.skipped == 1
+
+
+def test_text_before_the_array_is_ignored_and_nothing_after_done():
+    stream = JsonArrayStream("questions")
+    assert stream.feed('Sure! {"note": "x", "questions"') == []
+    assert stream.feed(': [{"q": 1}]') == [{"q": 1}]
+    assert stream.feed(', "more": [{"q": 2}]}') == []
@@ -0,0 +1,80 @@
+import pytest
+
+import token_budget
+from token_budget import MIN_PARTIAL_TOKENS, SEPARATOR_TOKENS, estimate_tokens, pack, trim_to_tokens
+
+
+@pytest.fixture(autouse=True)
+def unit_factor(monkeypatch):
+    monkeypatch.setattr(token_budget, "_factor", lambda model_name=None: 1.0)
+
+
+def _sentences(n: int, start: int = 0) -> str:
+    return " ".join(f"Sentence {i} is about topic {i}." for i in range(start, start + n))
+
+
+def test_estimate_counts_words_digits_and_symbols():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Hello, world 42!") == 6
+    assert estimate_tokens("internationalization") == 3
+
+
+def test_trim_keeps_text_that_fits():
+    text = _sentences(3)
+    assert trim_to_tokens(text, estimate_tokens(text)) == text
+    assert trim_to_tokens(text, 0) == ""
+    assert trim_to_tokens("   ", 50) == ""
+
+
+def test_trim_cuts_on_sentence_boundary():
+    text = _sentences(20)
+    for budget in (10, 25, 60, 100):
+        part = trim_to_tokens(text, budget)
+        assert part and text.startswith(part)
+        assert part.endswith(".")
+        assert estimate_tokens(part) <= budget
+
+
+def test_trim_prefers_paragraph_breaks():
+    text = "First paragraph without an end mark\n\nSecond paragraph goes on and on " + "and on " * 40
+    assert trim_to_tokens(text, 10) == "First paragraph without an end mark"
+
+
+def test_trim_cuts_one_long_sentence_on_a_word():
+    text = " ".join(f"word{i}" for i in range(200))
+    part = trim_to_tokens(text, 50)
+    assert text.startswith(part) and not part.endswith(" ")
+    assert 0 < estimate_tokens(part) <= 50
+    assert text[len(part)] == " "
+
+
+def test_pack_takes_whole_texts_in_rank_order():
+    texts = [_sentences(2, 0), _sentences(2, 2), _sentences(2, 4)]
+    picked = pack(texts, 1000)
+    assert picked == list(enumerate(texts))
+
+
+def test_pack_stays_within_budget_and_cuts_the_first_misfit():
+    texts = [_sentences(5, 0), _sentences(30, 5), "Ok.", ""]
+    budget = estimate_tokens(texts[0]) + SEPARATOR_TOKENS + MIN_PARTIAL_TOKENS + 20
+    picked = pack(texts, budget)
+    assert [i for i, _ in picked] == [0, 1, 2]
+    assert picked[0][1] == texts[0]
+    assert texts[1].startswith(picked[1][1]) and picked[1][1] != texts[1]
+    assert picked[2][1] == texts[2]
+    assert sum(estimate_tokens(t) for _, t in picked) + SEPARATOR_TOKENS * (len(picked) - 1) <= budget
+
+
+def test_pack_cuts_a_first_text_that_is_over_budget_alone():
+    text = _sentences(40)
+    picked = pack([text], 60)
+    assert len(picked) == 1 and picked[0][0] == 0
+    assert text.startswith(picked[0][1]) and picked[0][1].endswith(".")
+    assert estimate_tokens(picked[0][1]) <= 60
+
+
+def test_pack_skips_small_remainders_and_uses_given_counts():
+    texts = [_sentences(5), _sentences(30, 5)]
+    assert pack(texts, estimate_tokens(texts[0]) + MIN_PARTIAL_TOKENS - 1) == [(0, texts[0])]
+    # Precomputed counts win over the estimate; None entries are estimated.
+    assert pack(texts, 10, tokens=[5, None]) == [(0, texts[0])]
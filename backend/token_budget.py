@@ -0,0 +1,176 @@
+import math
+import os
+import re
+import threading
+import time
+
+import llm_client
+from state_store import open_store, update_state
+
+# ====== TOKEN-BUDGETED CONTEXT PACKING ======
+# Prompt context is measured in model tokens instead of characters. estimate_tokens() is a
+# local count of word, digit and symbol pieces scaled by a per-model factor; the factor is
+# calibrated against the provider's count_tokens API now and then at index time and shared
+# through the state store. Chunk counts are stored in the chunk metadata ("tokens") when a
+# document is indexed, so packing a prompt costs no extra work per request. pack() fills an
+# endpoint's budget with chunks in rank order and cuts the last one on a sentence boundary.
+
+# Tokens of document context per prompt (per map window for summarize), overridable with
+# CONTEXT_TOKEN_BUDGETS="quiz=4000,ask=3000".
+CONTEXT_TOKEN_BUDGETS = {
+    "quiz": 3000,
+    "flashcard": 3000,
+    "question_bank": 3000,
+    "ask": 2000,
+    "summarize": 1500,
+}
+# Older deployments sized quiz/flashcard context in characters.
+if os.environ.get("CONTEXT_CHAR_BUDGET"):
+    for _name in ("quiz", "flashcard", "question_bank"):
+        CONTEXT_TOKEN_BUDGETS[_name] = max(1, int(os.environ["CONTEXT_CHAR_BUDGET"]) // 4)
+for _item in os.environ.get("CONTEXT_TOKEN_BUDGETS", "").split(","):
+    if "=" in _item:
+        _name, _val = _item.split("=", 1)
+        try:
+            CONTEXT_TOKEN_BUDGETS[_name.strip()] = int(_val)
+        except ValueError:
+            print("[Tokens] Ignoring invalid CONTEXT_TOKEN_BUDGETS entry:", _item)
+
+# Re-measure the estimator against count_tokens at most this often per model.
+TOKEN_CALIBRATION_INTERVAL_SEC = float(os.environ.get("TOKEN_CALIBRATION_INTERVAL_SEC", "3600"))
+# Characters of a document sent to count_tokens per calibration.
+CALIBRATION_SAMPLE_CHARS = 8000
+# A chunk cut to fit is only worth including with at least this many tokens left.
+MIN_PARTIAL_TOKENS = 48
+# "\n\n" between packed chunks.
+SEPARATOR_TOKENS = 1
+FACTOR_REFRESH_SEC = 60.0
+
+_PIECE = re.compile(r"[A-Za-z]+|\d|[^\sA-Za-z\d]")
+_WORD = re.compile(r"\S+")
+_SENTENCE_END = re.compile(r"[.!?…][\"')\]]*(?=\s)|\n\s*\n")
+
+_store = None
+_factors = {}  # model -> (fetched_at, factor)
+_lock = threading.Lock()
+
+
+def context_budget(name: str) -> int:
+    """Token budget for the document context of endpoint `name` (see CONTEXT_TOKEN_BUDGETS)."""
+    return CONTEXT_TOKEN_BUDGETS.get(name, CONTEXT_TOKEN_BUDGETS["quiz"])
+
+
+def _calibration_store():
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                _store = open_store("token_estimator")
+    return _store
+
+
+def _raw_count(text: str) -> int:
+    # Short words are one token; long and rare words split into several.
+    n = 0
+    for piece in _PIECE.findall(text or ""):
+        n += 1 + len(piece) // 8 if piece[0].isalpha() else 1
+    return n
+
+
+def _factor(model_name: str = None) -> float:
+    model_name = model_name or llm_client.TEXT_MODEL or ""
+    now = time.monotonic()
+    hit = _factors.get(model_name)
+    if hit and now - hit[0] < FACTOR_REFRESH_SEC:
+        return hit[1]
+    try:
+        factor = float((_calibration_store().get(model_name) or {}).get("factor", 1.0))
+    except Exception as e:
+        print("[Tokens] Could not read calibration:", e)
+        factor = hit[1] if hit else 1.0
+    _factors[model_name] = (now, factor)
+    return factor
+
+
+def estimate_tokens(text: str, model_name: str = None) -> int:
+    """Local estimate of the model's token count for text."""
+    if not text:
+        return 0
+    return math.ceil(_raw_count(text) * _factor(model_name))
+
+
+def calibrate_estimator(text: str, model_name: str = None):
+    """Compare the estimate with count_tokens on a sample of text and fold the ratio into the
+    model's shared factor. Rate-limited per model; failures leave the factor as it is."""
+    model_name = model_name or llm_client.TEXT_MODEL or ""
+    sample = (text or "")[:CALIBRATION_SAMPLE_CHARS]
+    raw = _raw_count(sample)
+    if raw < 200:
+        return
+    try:
+        state = _calibration_store().get(model_name) or {}
+        if time.time() - state.get("updated_at", 0) < TOKEN_CALIBRATION_INTERVAL_SEC:
+            return
+        actual = llm_client.count_tokens(sample, model_name)
+        ratio = min(2.5, max(0.5, actual / raw))
+
+        def _fold(st):
+            n = min(st.get("samples", 0), 9)
+            factor = (st.get("factor", 1.0) * n + ratio) / (n + 1) if n else ratio
+            return {"factor": round(factor, 4), "samples": st.get("samples", 0) + 1, "updated_at": time.time()}
+
+        state = update_state(_calibration_store(), model_name, _fold)
+    except Exception as e:
+        print("[Tokens] Calibration failed; keeping the current estimate:", e)
+        return
+    _factors[model_name] = (time.monotonic(), state["factor"])
+    print(f"[Tokens] Calibrated {model_name}: {actual} tokens vs {raw} pieces, factor {state['factor']}")
+
+
+def trim_to_tokens(text: str, budget: int, model_name: str = None) -> str:
+    """Longest prefix of text within budget tokens that ends on a sentence (or paragraph)
+    boundary; a single over-long first sentence is cut on a word boundary instead."""
+    text = (text or "").strip()
+    if budget <= 0 or not text:
+        return ""
+    # No token is anywhere near 16 characters, so nothing past that can fit.
+    text = text[:budget * 16]
+    factor = _factor(model_name)
+    if math.ceil(_raw_count(text) * factor) <= budget:
+        return text
+    used, prev, cut = 0, 0, 0
+    for m in _SENTENCE_END.finditer(text):
+        used += _raw_count(text[prev:m.end()])
+        if used * factor > budget:
+            break
+        cut = prev = m.end()
+    if cut:
+        return text[:cut].strip()
+    # No sentence fits whole: keep the share of words the budget allows.
+    words = list(_WORD.finditer(text))
+    keep = max(1, int(len(words) * budget / max(1.0, _raw_count(text) * factor)))
+    return text[:words[min(keep, len(words)) - 1].end()]
+
+
+def pack(texts: list, budget: int, tokens: list = None, model_name: str = None) -> list:
+    """Fill budget with texts taken in rank order. Returns (index, text) pairs in rank order:
+    whole texts while they fit, the first one that does not fit cut on a sentence boundary
+    (when at least MIN_PARTIAL_TOKENS remain), and later shorter ones that still fit whole.
+    `tokens` holds precomputed counts (None entries are estimated)."""
+    picked, used = [], 0
+    for i, text in enumerate(texts):
+        if not text or not text.strip():
+            continue
+        n = tokens[i] if tokens is not None and i < len(tokens) and tokens[i] else estimate_tokens(text, model_name)
+        cost = n + (SEPARATOR_TOKENS if picked else 0)
+        if used + cost <= budget:
+            picked.append((i, text))
+            used += cost
+            continue
+        room = budget - used - (SEPARATOR_TOKENS if picked else 0)
+        if room >= MIN_PARTIAL_TOKENS:
+            part = trim_to_tokens(text, room, model_name)
+            if part:
+                picked.append((i, part))
+                used += estimate_tokens(part, model_name) + (SEPARATOR_TOKENS if len(picked) > 1 else 0)
+    return picked
@@ -0,0 +1,282 @@
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+from metrics import REGISTRY
+from state_store import open_store, update_state
+
+# ====== GEMINI USAGE ACCOUNTING ======
+# Every generate/embed call is attributed to (endpoint, doc_id, model). Prompt/output tokens
+# come from the response's usage_metadata; embeddings are counted by input characters (the
+# embed API reports no usage) with a chars/4 token estimate. Breakdowns are kept per process;
+# budget windows are counted in the shared state store so every worker enforces the same limit.
+
+# USD per 1M tokens as "input/output", overridable with
+# MODEL_PRICES="models/gemini-2.5-flash=0.30/2.50,models/text-embedding-004=0.025/0".
+MODEL_PRICES = {
+    "models/gemini-2.5-flash": (0.30, 2.50),
+    "models/gemini-2.5-pro": (1.25, 10.00),
+    "models/text-embedding-004": (0.0, 0.0),
+}
+for _item in os.environ.get("MODEL_PRICES", "").split(","):
+    if "=" in _item and "/" in _item:
+        _name, _val = _item.split("=", 1)
+        try:
+            _in, _out = _val.split("/", 1)
+            MODEL_PRICES[_name.strip()] = (float(_in), float(_out))
+        except ValueError:
+            print("[Usage] Ignoring invalid MODEL_PRICES entry:", _item)
+# Prompt tokens served from a context cache (usage_metadata.cached_content_token_count) are
+# billed at this share of the input price.
+CACHED_INPUT_PRICE_RATIO = float(os.environ.get("CACHED_INPUT_PRICE_RATIO", "0.25"))
+
+# Token budgets per window (0 = unlimited). Embedding tokens are estimates and count too.
+USAGE_WINDOW_SEC = float(os.environ.get("USAGE_WINDOW_SEC", str(24 * 3600)))
+USAGE_GLOBAL_TOKEN_BUDGET = int(os.environ.get("USAGE_GLOBAL_TOKEN_BUDGET", "0"))
+USAGE_DOC_TOKEN_BUDGET = int(os.environ.get("USAGE_DOC_TOKEN_BUDGET", "0"))
+# reject: refuse generate calls with 429 once a budget is spent.
+# degrade: keep answering, but with USAGE_DEGRADED_MODEL (if set) and at most
+# USAGE_DEGRADED_MAX_OUTPUT_TOKENS output tokens.
+USAGE_BUDGET_ACTION = os.environ.get("USAGE_BUDGET_ACTION", "reject").strip().lower()
+USAGE_DEGRADED_MODEL = os.environ.get("USAGE_DEGRADED_MODEL", "").strip()
+USAGE_DEGRADED_MAX_OUTPUT_TOKENS = int(os.environ.get("USAGE_DEGRADED_MAX_OUTPUT_TOKENS", "512"))
+USAGE_MAX_DOCS = int(os.environ.get("USAGE_MAX_DOCS", "2000"))
+
+CHARS_PER_TOKEN = 4
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Gemini token budget exhausted for {scope}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+# ---- Attribution ----
+_scope = contextvars.ContextVar("usage_scope", default=None)
+
+
+@contextmanager
+def usage_scope(endpoint: str, doc_id: str = None):
+    """Attribute calls made inside the block (e.g. background indexing) to endpoint/doc_id."""
+    token = _scope.set((endpoint, doc_id or ""))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def current_attribution() -> tuple:
+    scope = _scope.get()
+    if scope is not None:
+        return scope
+    if has_request_context():
+        return request.endpoint or "unknown", g.get("doc_id") or ""
+    return "background", ""
+
+
+def request_doc_id() -> str:
+    """doc_id of the current request from the URL, JSON body or query string."""
+    doc_id = (request.view_args or {}).get("doc_id")
+    if not doc_id and request.is_json:
+        body = request.get_json(silent=True) or {}
+        if isinstance(body, dict):
+            doc_id = body.get("doc_id") or body.get("docId") or body.get("documentId")
+    if not doc_id:
+        doc_id = request.args.get("doc_id")
+    return str(doc_id).strip() if doc_id else ""
+
+
+# ---- Per-process breakdowns ----
+_lock = threading.Lock()
+_by_endpoint_model = {}
+_by_doc = OrderedDict()
+
+
+def _empty() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "embed_chars": 0, "cost_usd": 0.0}
+
+
+def _cost(model: str, prompt_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    fresh = prompt_tokens - cached_tokens
+    return (fresh * price_in + cached_tokens * price_in * CACHED_INPUT_PRICE_RATIO + output_tokens * price_out) / 1_000_000
+
+
+def _add(bucket: dict, prompt_tokens: int, output_tokens: int, embed_chars: int, cost: float, cached_tokens: int = 0):
+    bucket["calls"] += 1
+    bucket["prompt_tokens"] += prompt_tokens
+    bucket["cached_tokens"] += cached_tokens
+    bucket["output_tokens"] += output_tokens
+    bucket["embed_chars"] += embed_chars
+    bucket["cost_usd"] += cost
+
+
+def _record(model: str, prompt_tokens: int, output_tokens: int, embed_chars: int = 0, cached_tokens: int = 0):
+    endpoint, doc_id = current_attribution()
+    cost = _cost(model, prompt_tokens, output_tokens, cached_tokens)
+    with _lock:
+        _add(_by_endpoint_model.setdefault((endpoint, model), _empty()), prompt_tokens, output_tokens, embed_chars, cost,
+             cached_tokens)
+        if doc_id:
+            bucket = _by_doc.get(doc_id)
+            if bucket is None:
+                bucket = _by_doc[doc_id] = _empty()
+                while len(_by_doc) > USAGE_MAX_DOCS:
+                    _by_doc.popitem(last=False)
+            else:
+                _by_doc.move_to_end(doc_id)
+            _add(bucket, prompt_tokens, output_tokens, embed_chars, cost, cached_tokens)
+    _charge_budgets(doc_id, prompt_tokens + output_tokens)
+
+
+def record_generate(response, model: str):
+    meta = getattr(response, "usage_metadata", None)
+    prompt_tokens = int(getattr(meta, "prompt_token_count", 0) or 0)
+    output_tokens = int(getattr(meta, "candidates_token_count", 0) or 0)
+    # Part of prompt_token_count; only the price differs.
+    cached_tokens = min(prompt_tokens, int(getattr(meta, "cached_content_token_count", 0) or 0))
+    _record(model, prompt_tokens, output_tokens, cached_tokens=cached_tokens)
+
+
+def record_embed(content, model: str):
+    texts = content if isinstance(content, (list, tuple)) else [content]
+    chars = sum(len(t) for t in texts if isinstance(t, str))
+    _record(model, chars // CHARS_PER_TOKEN, 0, chars)
+
+
+# ---- Budgets (shared across workers) ----
+_budgets = None
+_budgets_lock = threading.Lock()
+
+
+def _budget_store():
+    global _budgets
+    if _budgets is None:
+        with _budgets_lock:
+            if _budgets is None:
+                _budgets = open_store("usage_budget", USAGE_WINDOW_SEC * 2)
+    return _budgets
+
+
+def _window() -> int:
+    return int(time.time() // USAGE_WINDOW_SEC)
+
+
+def _budget_keys(doc_id: str) -> list:
+    w = _window()
+    keys = []
+    if USAGE_GLOBAL_TOKEN_BUDGET > 0:
+        keys.append((f"global:{w}", USAGE_GLOBAL_TOKEN_BUDGET))
+    if USAGE_DOC_TOKEN_BUDGET > 0 and doc_id:
+        keys.append((f"doc:{doc_id}:{w}", USAGE_DOC_TOKEN_BUDGET))
+    return keys
+
+
+def _charge_budgets(doc_id: str, tokens: int):
+    if tokens <= 0:
+        return
+    for key, _limit in _budget_keys(doc_id):
+        try:
+            update_state(_budget_store(), key, lambda st: dict(st, tokens=st.get("tokens", 0) + tokens),
+                         default={"tokens": 0})
+        except Exception as e:
+            print("[Usage] Failed to charge budget", key, "=>", e)
+
+
+def budget_exhausted(doc_id: str = None):
+    """Name of the first spent budget ("global" or "doc") for this call, or None."""
+    if doc_id is None:
+        doc_id = current_attribution()[1]
+    for key, limit in _budget_keys(doc_id):
+        spent = (_budget_store().get(key) or {}).get("tokens", 0)
+        if spent >= limit:
+            return key.split(":", 1)[0]
+    return None
+
+
+def seconds_to_window_reset() -> int:
+    return max(1, int((_window() + 1) * USAGE_WINDOW_SEC - time.time()))
+
+
+def apply_budget(model_name: str, generation_config: dict):
+    """Check budgets before a generate call. Returns the (model_name, generation_config) to use,
+    degraded when a budget is spent and USAGE_BUDGET_ACTION=degrade; raises BudgetExceeded
+    when it is spent and the action is reject."""
+    scope = budget_exhausted()
+    if scope is None:
+        return model_name, generation_config
+    if USAGE_BUDGET_ACTION != "degrade":
+        raise BudgetExceeded(scope, seconds_to_window_reset())
+    config = dict(generation_config or {})
+    config["max_output_tokens"] = min(int(config.get("max_output_tokens") or USAGE_DEGRADED_MAX_OUTPUT_TOKENS),
+                                      USAGE_DEGRADED_MAX_OUTPUT_TOKENS)
+    return (USAGE_DEGRADED_MODEL or model_name), config
+
+
+# ---- Reporting ----
+def usage_report(top_docs: int = 50) -> dict:
+    with _lock:
+        by_pair = {k: dict(v) for k, v in _by_endpoint_model.items()}
+        docs = sorted(((d, dict(v)) for d, v in _by_doc.items()),
+                      key=lambda kv: kv[1]["prompt_tokens"] + kv[1]["output_tokens"], reverse=True)[:top_docs]
+
+    def _roll(key_index: int) -> dict:
+        out = {}
+        for key, v in by_pair.items():
+            bucket = out.setdefault(key[key_index], _empty())
+            for field in bucket:
+                bucket[field] += v[field]
+        return out
+
+    totals = _empty()
+    for v in by_pair.values():
+        for field in totals:
+            totals[field] += v[field]
+
+    w = _window()
+    budgets = {
+        "window_sec": USAGE_WINDOW_SEC,
+        "resets_in_sec": seconds_to_window_reset(),
+        "action": USAGE_BUDGET_ACTION,
+        "global_limit": USAGE_GLOBAL_TOKEN_BUDGET,
+        "doc_limit": USAGE_DOC_TOKEN_BUDGET,
+    }
+    if USAGE_GLOBAL_TOKEN_BUDGET > 0:
+        budgets["global_spent"] = (_budget_store().get(f"global:{w}") or {}).get("tokens", 0)
+    if USAGE_DOC_TOKEN_BUDGET > 0:
+        budgets["doc_spent"] = {d: (_budget_store().get(f"doc:{d}:{w}") or {}).get("tokens", 0) for d, _ in docs}
+
+    return {
+        "pid": os.getpid(),
+        "totals": totals,
+        "by_endpoint": _roll(0),
+        "by_model": _roll(1),
+        "by_doc": dict(docs),
+        "budgets": budgets,
+    }
+
+
+def _collect_metrics() -> list:
+    with _lock:
+        items = sorted((k, dict(v)) for k, v in _by_endpoint_model.items())
+    tokens, cost, chars = [], [], []
+    for (endpoint, model), v in items:
+        tokens.append(({"endpoint": endpoint, "model": model, "kind": "prompt"}, v["prompt_tokens"]))
+        tokens.append(({"endpoint": endpoint, "model": model, "kind": "cached"}, v["cached_tokens"]))
+        tokens.append(({"endpoint": endpoint, "model": model, "kind": "output"}, v["output_tokens"]))
+        cost.append(({"endpoint": endpoint, "model": model}, round(v["cost_usd"], 6)))
+        chars.append(({"endpoint": endpoint, "model": model}, v["embed_chars"]))
+    return [
+        ("smartdoc_llm_tokens_total", "counter", "Gemini tokens by endpoint, model and kind.", tokens),
+        ("smartdoc_llm_cost_usd_total", "counter", "Estimated Gemini spend in USD.", cost),
+        ("smartdoc_embed_input_chars_total", "counter", "Characters sent to the embedding model.", chars),
+    ]
+
+
+REGISTRY.add_collector(_collect_metrics)